@@ -1,13 +1,19 @@
 import json
 import mimetypes
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
 from time import time
-import jwt
-import music_tag
-from pytz import timezone
-import requests
+from urllib.parse import urlsplit
+from cache import LRUCache
+from columnar import ColumnarLibrary
+from http_cache import ResponseCache
+from library_stats import LibraryStats
+from play_history import PlayHistory
+from transport import PriorityLimiter, Transport, UpstreamError, in_context
 from data_types import Tag, Media, Segment, TagType, Live
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 # Constants
 
 
@@ -23,7 +29,51 @@ def is_valid_file(arg):
     return arg
 
 
+def _is_repeated(url: str) -> bool:
+    """Whether a GET is worth caching: not schedule windows, they start at
+    the current time or move with the page, so the same URL rarely comes
+    twice, and are large."""
+    return not urlsplit(url).path.endswith('/admin/schedule')
+
+
+def _is_lasting(url: str) -> bool:
+    """Whether a GET is worth keeping on disk: the library, media and tags,
+    not searches or schedule windows, which change with every call."""
+    parts = urlsplit(url)
+    return '/admin/library/' in parts.path and not parts.query
+
+
+def _write_private(path: str, data) -> None:
+    """Writes JSON readable by the owner only, replacing `path` atomically
+    so concurrent readers never see half a file."""
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as wr:
+        json.dump(data, wr)
+    os.replace(tmp_path, path)
+
+
+SEGMENT_TIME_FORMAT = r"%Y-%m-%dT%H:%M:%S.%f+00:00"
+
+
+def parse_time(value: str) -> datetime:
+    try:
+        # The server sends ISO 8601; fromisoformat is many times faster than
+        # strptime, which is left for what it does not take
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is not None:
+            return parsed
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(value, r'%Y-%m-%dT%H:%M:%S.%f%z')
+    except ValueError:
+        return datetime.strptime(value, r'%Y-%m-%dT%H:%M:%S%z')
+
+
 def extract_metadata_and_remove_artwork(file_path):
+    # music_tag pulls in mutagen, only uploads need it
+    import music_tag
     f = music_tag.load_file(file_path)
 
     # Extract author and track name
@@ -43,28 +93,85 @@ def extract_metadata_and_remove_artwork(file_path):
 
 class client:
     base_url = 'https://radiomipt.ru'
-
-    def __init__(self) -> None:
-        self.cache_dir = '.cache'
+    # Seconds a single media or segment read is reused for
+    media_ttl = 300
+    segment_ttl = 30
+    tag_ttl = 60
+    # Seconds before `exp` at which a token is no longer used
+    jwt_margin = 30
+
+    def __init__(self, base_url: str = None, cache_dir: str = '.cache') -> None:
+        # One client per radio backend; each keeps its token and caches apart
+        if base_url is not None:
+            self.base_url = base_url.rstrip('/')
+        self.cache_dir = cache_dir
         if not os.path.exists(self.cache_dir):
             os.makedirs(self.cache_dir)
+        # Upstream GETs are revalidated rather than downloaded again
+        self.http = Transport(cache=ResponseCache(directory=os.path.join(self.cache_dir, 'http'),
+                                                  persist=_is_lasting, cacheable=_is_repeated),
+                              limiter=PriorityLimiter())
         self.jwt = None
         self.auth_header = None
         self.user_info = self.__recover_user_info()
+        self.__login_lock = threading.Lock()
+        self.restore_session()
         self.library = None
+        self._library_version = None
+        self.media_cache = LRUCache(maxsize=2048, ttl=self.media_ttl)
+        self.segment_cache = LRUCache(maxsize=1024, ttl=self.segment_ttl)
+        self.tag_cache = LRUCache(maxsize=4, ttl=self.tag_ttl)
+        self.snapshot_time = None
+        # Aggregates over `library` and `schedule`, updated with every change
+        self.stats = LibraryStats()
+        # Segments that have aired, the server only returns upcoming ones
+        self.history = PlayHistory(os.path.join(self.cache_dir, 'play_history.bin'))
         self.schedule = None
         self.time_horizon = None
 
     def __add_token(self, token: str) -> None:
+        import jwt
         payload = jwt.decode(token, options={"verify_signature": False})
         timeout = payload['exp']
         self.jwt = JWT(token, timeout)
+        self.auth_header = {'Authorization': f'Bearer {self.jwt.token}'}
+
+    def __token_valid(self, timeout) -> bool:
+        return timeout is not None and time() < timeout - self.jwt_margin
 
     def __refresh_jwt_if_needed(self) -> None:
-        now = time()
-        if now > self.jwt.timeout:
+        if self.jwt is not None and self.__token_valid(self.jwt.timeout):
+            return
+        with self.__login_lock:
+            # Another thread, or another worker sharing .cache, may have
+            # logged in meanwhile
+            if self.restore_session():
+                return
+            if not self.user_info.get('login'):
+                raise ValueError(401, 'not logged in')
             self.login(self.user_info['login'], self.user_info['pass'])
 
+    def restore_session(self) -> bool:
+        """Takes over the token saved by the last login of any process using
+        the same cache directory and server, if it is still valid."""
+        try:
+            with open(os.path.join(self.cache_dir, 'session.json')) as rd:
+                saved = json.load(rd)
+        except FileNotFoundError:
+            return False
+        except ValueError as e:
+            print(f'Ignoring broken session file: {e}')
+            return False
+        if saved.get('base_url') != self.base_url or not self.__token_valid(saved.get('exp')):
+            return False
+        if self.jwt is None or self.jwt.token != saved['token']:
+            self.__add_token(saved['token'])
+        return True
+
+    def __save_session(self) -> None:
+        _write_private(os.path.join(self.cache_dir, 'session.json'),
+                       {'base_url': self.base_url, 'token': self.jwt.token, 'exp': self.jwt.timeout})
+
     def __recover_user_info(self) -> dict:
         try:
             r = open(self.cache_dir+'/users.json')
@@ -80,22 +187,21 @@ class client:
             'login': login,
             'pass': password
         }
-        with open(self.cache_dir+'/users.json', 'w') as wr:
-            json.dump(self.user_info, wr)
+        _write_private(os.path.join(self.cache_dir, 'users.json'), self.user_info)
 
     def login(self, login: str, password: str) -> bool:
         url = f'{self.base_url}/admin/login'
         data = {'login': login, 'pass': password}
 
         try:
-            api_response = requests.post(url, json=data)
+            api_response = self.http.post(url, json=data)
             self.__add_token(api_response.json()['token'])
-            self.auth_header = {'Authorization': f'Bearer {self.jwt.token}'}
             self.__save_user(login, password)
+            self.__save_session()
             return True
         except Exception as e:
             print("Exception when calling AuthApi->admin_login_post: %s\n" % e)
-            if e.status == 400:
+            if getattr(e, 'status', None) == 400:
                 return False
             return None
 
@@ -104,10 +210,16 @@ class client:
     def fetch_all_media(self) -> list[Media]:
         self.__refresh_jwt_if_needed()
         url = f'{self.base_url}/admin/library/media'
-        response = requests.get(url, headers=self.auth_header)
+        response = self.http.get(url, headers=self.auth_header)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
-        self.library = {int(item['id']): Media.from_dict(item) for item in response.json()['library']}
+        if (getattr(response, 'unchanged', False) and self.library is not None
+                and self.library.version == self._library_version):
+            # Same body as the library was built from and not changed since
+            return
+        self.library = ColumnarLibrary.from_dicts(response.json()['library'])
+        self._library_version = self.library.version
+        self.stats.set_library(self.library)
 
     def search_media_in_library(self, name: str = None, author: str = None, tags: list[Tag] = None, res_len: int = 5):
         self.__refresh_jwt_if_needed()
@@ -116,20 +228,64 @@ class client:
         #     tags = [Tag(id=tag['id'], name=tag['name'], type=TagType(id=tag['type']['id'], name=tag['type']['name']), meta=tag['meta']) for tag in tags]
         params = {'name': name, 'author': author,
                   'tags': tags, 'res_len': res_len}
-        response = requests.get(url, headers=self.auth_header, params=params)
+        response = self.http.get(url, headers=self.auth_header, params=params)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
         return response.json()['library']
 
     def get_media(self, media_id: int) -> Media:
+        media = self.media_cache.get(int(media_id))
+        if media is not None:
+            return media
+        return self.__request_media(media_id)
+
+    def __request_media(self, media_id: int) -> Media:
         self.__refresh_jwt_if_needed()
         url = f'{self.base_url}/admin/library/media/{media_id}'
-        response = requests.get(url, headers=self.auth_header)
+        response = self.http.get(url, headers=self.auth_header)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
         media = Media.from_dict(response.json()['media'])
+        self.media_cache.put(int(media.id), media)
         return media
 
+    def resolve_media(self, media_ids, max_workers: int = 8, bulk_threshold: int = 32) -> dict[int, Media]:
+        """Media for the given ids, from the cache or the library snapshot
+        when possible; the rest is requested concurrently, or with a single
+        library fetch when more than `bulk_threshold` are missing. Ids the
+        server does not know are left out of the result."""
+        resolved, missing = {}, []
+        for media_id in {int(media_id) for media_id in media_ids}:
+            media = self.media_cache.get(media_id)
+            if media is None and self.library is not None:
+                media = self.library.get(media_id)
+            if media is None:
+                missing.append(media_id)
+            else:
+                resolved[media_id] = media
+
+        def fetch(media_id):
+            try:
+                return self.__request_media(media_id)
+            except UpstreamError:
+                raise
+            except ValueError as e:
+                print("Exception when resolving media %s: %s\n" % (media_id, e))
+                return None
+
+        if len(missing) > bulk_threshold:
+            self.fetch_all_media()
+            for media_id in missing:
+                if media_id in self.library:
+                    resolved[media_id] = self.library[media_id]
+        elif missing:
+            self.__refresh_jwt_if_needed()
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
+                for media_id, media in zip(missing, executor.map(in_context(fetch), missing)):
+                    if media is not None:
+                        resolved[media_id] = media
+        return resolved
+
     def post_media_with_source(self, name: str, author: str, source: str, tags: list) -> int:
         self.__refresh_jwt_if_needed()
         url = f'{self.base_url}/admin/library/media'
@@ -146,8 +302,8 @@ class client:
         # https://requests.readthedocs.io/en/latest/user/advanced/#post-multiple-multipart-encoded-files
         files = [('source', (os.path.basename(source), open(source, 'rb'), 'audio/mpeg')),
                  ('media', (None, json.dumps(media.to_dict()), 'application/json'))]
-        response = requests.post(
-            url, headers=self.auth_header, files=files)
+        response = self.http.post(
+            url, headers=self.auth_header, files=files, timeout=(3.05, 300))
         if response.status_code != 200:
             if response.status_code >= 500:
                 raise ValueError(response.status_code, 'server error')
@@ -158,47 +314,85 @@ class client:
         self.__refresh_jwt_if_needed()
         media = Media(id=media_id, name=name, author=author, tags=tags)
         url = f'{self.base_url}/admin/library/media/{media_id}'
-        response = requests.put(url, headers=self.auth_header, json={
+        response = self.http.put(url, headers=self.auth_header, json={
                                 'media': media.to_dict()})
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
+        self.media_cache.pop(int(media_id))
+        if self.library is not None and int(media_id) in self.library:
+            updated = Media(id=int(media_id), name=name, author=author,
+                            duration=self.library[int(media_id)].duration, tags=tags)
+            self.library[int(media_id)] = updated
+            self.stats.put_media(updated)
         return response
 
     def delete_media_by_id(self, media_id: int):
         self.__refresh_jwt_if_needed()
         url = f'{self.base_url}/admin/library/media/{media_id}'
-        response = requests.delete(url, headers=self.auth_header)
+        response = self.http.delete(url, headers=self.auth_header)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
+        self.media_cache.pop(int(media_id))
+        if self.library is not None:
+            self.library.pop(int(media_id), None)
+        self.stats.remove_media(media_id)
         return response
 
+    def cache_stats(self) -> dict:
+        stats = {'media': self.media_cache.stats(), 'segment': self.segment_cache.stats(),
+                 'tag': self.tag_cache.stats()}
+        if self.http.flights is not None:
+            stats['single_flight'] = self.http.flights.stats()
+        if self.http.cache is not None:
+            stats['http'] = self.http.cache.stats()
+        if self.http.limiter is not None:
+            stats['limiter'] = self.http.limiter.stats()
+        return stats
+
     # Tag Handling
 
     def get_available_tag_types(self) -> list[TagType]:
+        tag_types = self.tag_cache.get('types')
+        if tag_types is not None:
+            return list(tag_types)
+        return self.__request_tag_types()
+
+    def __request_tag_types(self) -> list[TagType]:
         self.__refresh_jwt_if_needed()
         url = f'{self.base_url}/admin/library/tag/types'
-        response = requests.get(url, headers=self.auth_header)
+        response = self.http.get(url, headers=self.auth_header)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
-        return [TagType.from_dict(item) for item in response.json()['types']]
+        tag_types = [TagType.from_dict(item) for item in response.json()['types']]
+        self.tag_cache.put('types', tag_types)
+        return list(tag_types)
 
     def get_all_registered_tags(self) -> list[Tag]:
+        tags = self.tag_cache.get('tags')
+        if tags is not None:
+            return list(tags)
+        return self.__request_tags()
+
+    def __request_tags(self) -> list[Tag]:
         self.__refresh_jwt_if_needed()
         url = f'{self.base_url}/admin/library/tag'
-        response = requests.get(url, headers=self.auth_header)
+        response = self.http.get(url, headers=self.auth_header)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
-        return [Tag.from_dict(item) for item in response.json()['tags']]
+        tags = [Tag.from_dict(item) for item in response.json()['tags']]
+        self.tag_cache.put('tags', tags)
+        return list(tags)
 
     def register_new_tag(self, tag_name: str, tag_type: dict, meta: dict = {}):
         self.__refresh_jwt_if_needed()
         tag_type = TagType(id=tag_type['id'], name=tag_type['name'])
         tag = Tag(name=tag_name, type=tag_type, meta=meta)
         url = f'{self.base_url}/admin/library/tag'
-        response = requests.post(url, headers=self.auth_header, json={
+        response = self.http.post(url, headers=self.auth_header, json={
                                  'tag': tag.to_dict()})
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
+        self.tag_cache.clear()
         response = response.json()['id']
         return response
 
@@ -207,14 +401,18 @@ class client:
         url = f'{self.base_url}/admin/library/tag'
         tag_type = TagType(id=tag_type['id'], name=tag_type['name'])
         tag = Tag(id=tag_id, name=tag_name, type=tag_type, meta=meta)
-        response = requests.put(url, headers=self.auth_header, json={
+        response = self.http.put(url, headers=self.auth_header, json={
                                 'tag': tag.to_dict()})
+        self.tag_cache.clear()
         return response
 
     def get_tag_by_id(self, tag_id: int) -> Tag:
+        for tag in self.tag_cache.get('tags') or []:
+            if tag.id == int(tag_id):
+                return tag
         self.__refresh_jwt_if_needed()
         url = f'{self.base_url}/admin/library/tag/{tag_id}'
-        response = requests.get(url, headers=self.auth_header)
+        response = self.http.get(url, headers=self.auth_header)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
         tag = Tag.from_dict(response.json()['tag'])
@@ -223,11 +421,71 @@ class client:
     def delete_tag_by_id(self, tag_id: int):
         self.__refresh_jwt_if_needed()
         url = f'{self.base_url}/admin/library/tag/{tag_id}'
-        response = requests.delete(url, headers=self.auth_header)
+        response = self.http.delete(url, headers=self.auth_header)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
+        self.tag_cache.clear()
         return response
 
+    # Snapshots
+
+    def save_snapshot(self, path: str = None) -> None:
+        """Writes the library, tags, tag types and upcoming schedule to disk
+        for `load_snapshot` after a restart."""
+        path = path or os.path.join(self.cache_dir, 'snapshot.json')
+        snapshot = {
+            'saved': time(),
+            'base_url': self.base_url,
+            'library': [media.to_dict() for media in self.library.values()] if self.library is not None else None,
+            'tags': [tag.to_dict() for tag in self.tag_cache.get('tags') or []],
+            'tag_types': [tag_type.to_dict() for tag_type in self.tag_cache.get('types') or []],
+            'schedule': self.schedule,
+        }
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as wr:
+            json.dump(snapshot, wr)
+        os.replace(tmp_path, path)
+        self.snapshot_time = snapshot['saved']
+
+    def load_snapshot(self, path: str = None) -> bool:
+        """Restores what `save_snapshot` wrote, so the first pages after a
+        restart do not wait for the full library and tag downloads. The
+        data may be stale, `refresh_snapshot` replaces it."""
+        path = path or os.path.join(self.cache_dir, 'snapshot.json')
+        try:
+            with open(path) as rd:
+                snapshot = json.load(rd)
+        except FileNotFoundError:
+            return False
+        except ValueError as e:
+            print(f'Ignoring broken snapshot {path}: {e}')
+            return False
+        if snapshot.get('base_url') != self.base_url:
+            return False
+        if snapshot['library'] is not None:
+            self.library = ColumnarLibrary.from_dicts(snapshot['library'])
+            self._library_version = None
+            self.stats.set_library(self.library)
+        if snapshot['tags']:
+            self.tag_cache.put('tags', [Tag.from_dict(item) for item in snapshot['tags']])
+        if snapshot['tag_types']:
+            self.tag_cache.put('types', [TagType.from_dict(item) for item in snapshot['tag_types']])
+        self.schedule = snapshot['schedule']
+        if self.schedule is not None:
+            self.stats.set_schedule(self.schedule)
+        self.snapshot_time = snapshot['saved']
+        return True
+
+    def refresh_snapshot(self) -> None:
+        """Downloads the library, tags, tag types and schedule again and
+        saves them as the new snapshot."""
+        self.fetch_all_media()
+        self.__request_tags()
+        self.__request_tag_types()
+        self.get_schedule()
+        self.save_snapshot()
+        self.sync_history()
+
     # Schedule and Segment Management
 
     def get_schedule(self, start=None, stop=None):
@@ -240,46 +498,110 @@ class client:
             params['start'] = datetime.now().strftime('%s')
         if stop is not None:
             params['stop'] = stop
-        response = requests.get(url, headers=self.auth_header, params=params)
+        response = self.http.get(url, headers=self.auth_header, params=params)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
         self.schedule = response.json()['segments']
         if len(self.schedule) > 0:
-            try:
-                start = datetime.strptime(
-                    self.schedule[-1]['start'], r'%Y-%m-%dT%H:%M:%S.%f%z')
-            except Exception as e:
-                print(e)
-                start = datetime.strptime(
-                    self.schedule[-1]['start'], r'%Y-%m-%dT%H:%M:%S%z')
-            duration = timedelta(
-                microseconds=self.schedule[-1]['stopCut']*1e-3)
-            self.time_horizon = start + duration
-            self.fetch_all_media()
-            now = datetime.now(tz=timezone('UTC'))
-            for item in self.schedule:
-                duration = timedelta(
-                    microseconds=item['stopCut']*1e-3)
-                try:
-                    item['end'] = datetime.strftime(datetime.strptime(
-                        item['start'], r'%Y-%m-%dT%H:%M:%S.%f%z') + duration, r'%Y-%m-%dT%H:%M:%S.%f%z')
-                    # print(item['end'])
-                except Exception as e:
-                    print(e)
-                    item['end'] = datetime.strftime(datetime.strptime(
-                        item['start'], r'%Y-%m-%dT%H:%M:%S%z') + duration, r'%Y-%m-%dT%H:%M:%S.%f%z')
-            self.schedule = [item for item in self.schedule if datetime.strptime(
-                item['end'], r'%Y-%m-%dT%H:%M:%S.%f%z') > now]
-            for item in self.schedule:
-                item['mediaTitle'] = self.library[int(
-                    item['mediaID'])].author + ' - ' + self.library[int(item['mediaID'])].name
+            # Every start is parsed once, that is most of the time spent here
+            ends = self.__add_segment_ends(self.schedule)
+            self.time_horizon = ends[-1]
+            now = datetime.now(tz=timezone.utc)
+            ended = [item for item, end in zip(self.schedule, ends) if end <= now]
+            if ended:
+                self.history.record(ended)
+                self.schedule = [item for item, end in zip(self.schedule, ends) if end > now]
+            self.__add_media_titles(self.schedule)
+        self.stats.set_schedule(self.schedule, float(params['start']),
+                                float(params['stop']) if 'stop' in params else None)
         return self.schedule
 
+    def sync_history(self, days: int = 30) -> int:
+        """Records the segments that ended since the last one in the play
+        history, looking back at most `days`. Returns how many were new."""
+        self.__refresh_jwt_if_needed()
+        now = datetime.now(tz=timezone.utc)
+        start = now - timedelta(days=days)
+        last_end = self.history.last_end()
+        if last_end is not None:
+            start = max(start, last_end - timedelta(hours=1))
+        url = f'{self.base_url}/admin/schedule'
+        params = {'start': int(start.timestamp()), 'stop': ceil(now.timestamp())}
+        response = self.http.get(url, headers=self.auth_header, params=params)
+        if response.status_code != 200:
+            raise ValueError(response.status_code, response.json())
+        ended = [item for item in response.json()['segments']
+                 if parse_time(item['start']) + timedelta(microseconds=item['stopCut'] // 1000) <= now]
+        return self.history.record(ended)
+
+    def get_schedule_page(self, start: datetime, stop: datetime = None, limit: int = 100,
+                          window: timedelta = timedelta(hours=6),
+                          max_empty: timedelta = timedelta(days=7)) -> tuple[list, datetime]:
+        """Up to `limit` segments that end after `start`, fetched from upstream
+        in growing [start, stop) windows instead of all at once.
+
+        Returns the segments and the cursor to pass as `start` for the next
+        page, or None when `stop` was reached (or, without `stop`, nothing
+        was scheduled for `max_empty`)."""
+        self.__refresh_jwt_if_needed()
+        url = f'{self.base_url}/admin/schedule'
+        items, seen = [], set()
+        cursor, empty = start, timedelta(0)
+        while True:
+            window_stop = cursor + window if stop is None else min(cursor + window, stop)
+            params = {'start': int(cursor.timestamp()), 'stop': ceil(window_stop.timestamp())}
+            response = self.http.get(url, headers=self.auth_header, params=params)
+            if response.status_code != 200:
+                raise ValueError(response.status_code, response.json())
+            found = [item for item in response.json()['segments'] if item['id'] not in seen]
+            self.__add_segment_ends(found)
+            found = [item for item in found
+                     if parse_time(item['end']) > start and parse_time(item['start']) < window_stop]
+            seen.update(item['id'] for item in found)
+            items.extend(found)
+
+            if len(items) > limit:
+                break
+            if stop is not None and window_stop >= stop:
+                break
+            empty = empty + window if not found else timedelta(0)
+            if stop is None and empty >= max_empty:
+                break
+            cursor, window = window_stop, window * 2
+
+        items.sort(key=lambda item: parse_time(item['start']))
+        next_cursor = None
+        if len(items) > limit:
+            next_cursor = parse_time(items[limit]['start'])
+            items = items[:limit]
+        self.__add_media_titles(items)
+        return items, next_cursor
+
+    def __add_segment_ends(self, items: list) -> list[datetime]:
+        """Adds `end` to every item; returns the ends."""
+        ends = []
+        for item in items:
+            end = parse_time(item['start']) + timedelta(microseconds=item['stopCut']*1e-3)
+            item['end'] = datetime.strftime(end, r'%Y-%m-%dT%H:%M:%S.%f%z')
+            ends.append(end)
+        return ends
+
+    def __add_media_titles(self, items: list) -> None:
+        if not items:
+            return
+        media = self.resolve_media(item['mediaID'] for item in items)
+        for item in items:
+            found = media.get(int(item['mediaID']))
+            if found is None:
+                item['mediaTitle'] = f"Unknown media #{item['mediaID']}"
+            else:
+                item['mediaTitle'] = found.author + ' - ' + found.name
+
     def create_new_segment(self, media_id: int, *, time: datetime = None, stop_cut: int = None) -> int:
         self.__refresh_jwt_if_needed()
         self.get_schedule()
 
-        now = datetime.now(tz=timezone('UTC'))
+        now = datetime.now(tz=timezone.utc)
         if self.time_horizon is None or self.time_horizon < now:
             self.time_horizon = now
 
@@ -296,17 +618,18 @@ class client:
 
         segment = Segment(
             mediaID=media_id,
-            start=start.strftime(r"%Y-%m-%dT%H:%M:%S.%f+00:00"),
+            start=start.strftime(SEGMENT_TIME_FORMAT),
             beginCut=0,
             stopCut=stop_cut
         )
         url = f'{self.base_url}/admin/schedule'
         body = {'segment': segment.to_dict()}
-        response = requests.post(url, headers=self.auth_header, json=body)
+        response = self.http.post(url, headers=self.auth_header, json=body)
         if response.status_code == 200:
             self.time_horizon = start + \
                 timedelta(microseconds=media.duration*1e3)
             response = response.json()['id']
+            self.stats.put_segment(response, media_id, start, stop_cut)
             return response
         elif response.status_code == 400:
             try:
@@ -317,42 +640,77 @@ class client:
             except Exception as e:
                 raise ValueError(response.text, response.request.body)
 
+    def create_segments(self, segments: list[Segment], max_workers: int = 8) -> list[int]:
+        """Posts prepared segments as one batch, without refetching the
+        schedule and media for each of them like `create_new_segment` does.
+        Returns the new ids in order, -1 where the segment intersected."""
+        self.__refresh_jwt_if_needed()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(in_context(self.create_segment), segments))
+
+    def create_segment(self, segment: Segment) -> int:
+        """Posts one prepared segment; returns its id, or -1 if it intersected."""
+        self.__refresh_jwt_if_needed()
+        url = f'{self.base_url}/admin/schedule'
+        response = self.http.post(url, headers=self.auth_header,
+                                  json={'segment': segment.to_dict()})
+        if response.status_code == 200:
+            segment_id = response.json()['id']
+            self.stats.put_segment(segment_id, segment.media_id, segment.start, segment.stop_cut)
+            return segment_id
+        if response.status_code == 400 and response.json().get('error') == 'segment intersection':
+            return -1
+        raise ValueError(response.status_code, response.text)
+
     def clear_schedule_from_timestamp(self, timestamp: datetime):
         self.__refresh_jwt_if_needed()
         url = f'{self.base_url}/admin/schedule'
         params = {'from': timestamp}
-        response = requests.delete(
+        response = self.http.delete(
             url, headers=self.auth_header, params=params)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
+        self.segment_cache.clear()
+        self.stats.remove_segments_from(timestamp)
         return response
 
     def get_segment_by_id(self, segment_id: int) -> Segment:
+        segment = self.segment_cache.get(int(segment_id))
+        if segment is not None:
+            return segment
         self.__refresh_jwt_if_needed()
         url = f'{self.base_url}/admin/schedule/{segment_id}'
-        response = requests.get(url, headers=self.auth_header)
+        response = self.http.get(url, headers=self.auth_header)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
         segment_dict = response.json()['segment']
         segment_dict.pop('protected', None)
         segment = Segment.from_dict(segment_dict)
+        self.segment_cache.put(int(segment_id), segment)
         return segment
     
 
     def delete_segment_by_id(self, segment_id: int):
         self.__refresh_jwt_if_needed()
         url = f'{self.base_url}/admin/schedule/{segment_id}'
-        response = requests.delete(url, headers=self.auth_header)
+        response = self.http.delete(url, headers=self.auth_header)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
+        self.segment_cache.pop(int(segment_id))
+        self.stats.remove_segment(segment_id)
         return response
 
+    def delete_segments(self, segment_ids: list[int], max_workers: int = 8) -> None:
+        self.__refresh_jwt_if_needed()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(in_context(self.delete_segment_by_id), segment_ids))
+
     # Radio Control
 
     def start_radio(self):
         self.__refresh_jwt_if_needed()
         url = f'{self.base_url}/radio/start'
-        response = requests.get(url, headers=self.auth_header)
+        response = self.http.get(url, headers=self.auth_header)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
         return response
@@ -360,7 +718,7 @@ class client:
     def stop_radio(self):
         self.__refresh_jwt_if_needed()
         url = f'{self.base_url}/radio/stop'
-        response = requests.get(url, headers=self.auth_header)
+        response = self.http.get(url, headers=self.auth_header)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
         return response
@@ -371,7 +729,7 @@ class client:
         self.__refresh_jwt_if_needed()
         live = Live(name=name)
         url = f'{self.base_url}/admin/schedule/live/start'
-        response = requests.post(url, headers=self.auth_header, json={'live': live.to_dict()})
+        response = self.http.post(url, headers=self.auth_header, json={'live': live.to_dict()})
         if response.status_code != 200:
             print(response.status_code, response.text)
             raise ValueError(response.status_code, response.json())
@@ -380,7 +738,7 @@ class client:
     def stop_live(self):
         self.__refresh_jwt_if_needed()
         url = f'{self.base_url}/admin/schedule/live/stop'
-        response = requests.get(url, headers=self.auth_header)
+        response = self.http.get(url, headers=self.auth_header)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
         return response
@@ -388,7 +746,7 @@ class client:
     def get_live_status(self):
         self.__refresh_jwt_if_needed()
         url = f'{self.base_url}/admin/schedule/live/info'
-        response = requests.get(url, headers=self.auth_header)
+        response = self.http.get(url, headers=self.auth_header)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
         return response.json()
@@ -396,7 +754,7 @@ class client:
     def get_lives(self):
         self.__refresh_jwt_if_needed()
         url = f'{self.base_url}/admin/schedule/lives'
-        response = requests.get(url, headers=self.auth_header)
+        response = self.http.get(url, headers=self.auth_header)
         if response.status_code != 200:
             raise ValueError(response.status_code, response.json())
         return response.json()
@@ -416,14 +774,3 @@ class JWT:
 #     data = {'login': login, 'pass': password}
 #     response = requests.post(url, json=data)
 #     return response
-# Example Usage
-if __name__ == '__main__':
-
-    cl = client()
-    cl.login('fedorthewise', 'pyxSR73ZdCFX')
-    print(cl.get_available_tag_types())
-    song_tag = {'id': 1, 'name': 'song', 'type': {
-        'id': 1, 'name': 'format'}, 'meta': None}
-    print(cl.post_media_with_source('Sky', 'NAVIBAND',
-          '../tmp/downloaded/NAVIBAND - Мары.mp3', [song_tag]))
-    print(cl.search_media_in_library(name='O, Moda Moda').json())
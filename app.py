@@ -1,10 +1,29 @@
 from flask import request, jsonify
+import json
 import os
-from datetime import datetime, timedelta
-from flask import Flask, jsonify, request, render_template, redirect, url_for, session, flash
+import shutil
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from time import time
+from flask import Flask, Response, jsonify, request, render_template, redirect, url_for, session, flash, g
+from werkzeug.local import LocalProxy
 from werkzeug.utils import secure_filename
 # Assume your API client code is saved in a module
-from api_client import client
+from api_client import client, parse_time
+from autodj import AutoDJPlanner, find_gaps
+import page_data
+from responses import json_response
+from retag import apply_retag, describe_changes, plan_retag
+from data_types import AutoDJConfig
+from jobs import JobCancelled, JobQueue
+from uploads import CHUNK_SIZE, ChunkedUploads, UploadError
+from write_behind import WriteBehindQueue
+from transport import (DeadlineExceeded, PriorityLimiter, UpstreamError, deadline, priority, reset_deadline,
+                       set_deadline)
+from stations import StationRegistry
+from schedule_tools import (apply_moves, apply_sync, describe_moves, live_windows, parse_desired_schedule,
+                            parse_user_time, plan_compaction, plan_sync)
 
 # Create a Flask app
 app = Flask(__name__)
@@ -12,18 +31,152 @@ app.secret_key = 'your_secret_key'  # Necessary for session management
 
 UPLOAD_FOLDER = 'uploads'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# Seconds of upstream time one UI request may spend, across all its calls
+app.config['UPSTREAM_BUDGET'] = 15
+app.config['UPLOAD_UPSTREAM_BUDGET'] = 600
+# Uploads to the radio server that may run at the same time, the rest wait
+app.config['UPLOAD_CONCURRENCY'] = 2
+# Seconds after which the library/tag/schedule snapshot is downloaded again,
+# None to never download it in the background
+app.config['SNAPSHOT_REFRESH'] = 600
+app.config['SNAPSHOT_UPSTREAM_BUDGET'] = 120
+# Apply schedule and library edits locally and send them upstream in the
+# background (see write_behind.py) instead of waiting for the radio server
+app.config['WRITE_BEHIND'] = False
+app.config['WRITE_BEHIND_JOURNAL'] = os.path.join('.cache', 'write_behind.jsonl')
+# Bulk retagging: parallel updates and updates per second sent upstream
+app.config['RETAG_CONCURRENCY'] = 8
+app.config['RETAG_RATE'] = 20
+app.config['RETAG_UPSTREAM_BUDGET'] = 600
+# Schedule compaction moves one segment at a time, in a background job
+app.config['COMPACT_UPSTREAM_BUDGET'] = 300
+# Upstream calls in flight at once, and how many of them only UI requests
+# may use; background and bulk work (snapshot refresh, write-behind, AutoDJ
+# submission, uploads, bulk edits) is also limited to calls per second
+app.config['UPSTREAM_CONCURRENCY'] = 16
+app.config['UPSTREAM_INTERACTIVE_RESERVE'] = 4
+app.config['UPSTREAM_RATES'] = {'background': 50, 'bulk': 20}
+# Radio backends managed by this deployment, a list of {"name", "base_url",
+# "title"} dicts or, when None, read from STATIONS_FILE if it exists;
+# without either there is one station on the default server
+app.config['STATIONS'] = None
+app.config['STATIONS_FILE'] = 'stations.json'
 
 # Ensure the upload folder exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+chunked_uploads = ChunkedUploads(os.path.join(UPLOAD_FOLDER, 'chunks'))
+chunked_uploads.purge()
+upload_jobs = JobQueue(max_workers=app.config['UPLOAD_CONCURRENCY'])
+# Bulk edits run one at a time, next to uploads
+bulk_jobs = JobQueue(max_workers=1)
+job_queues = (upload_jobs, bulk_jobs)
+
+
+def configure_client(station_client: client) -> None:
+    """Every station's client gets its own upstream limiter and starts from
+    its last snapshot, so the first pages after a restart do not wait."""
+    station_client.http.limiter = PriorityLimiter(app.config['UPSTREAM_CONCURRENCY'],
+                                                  reserve=app.config['UPSTREAM_INTERACTIVE_RESERVE'],
+                                                  rates=app.config['UPSTREAM_RATES'])
+    station_client.load_snapshot()
+
+
+stations = StationRegistry.from_config(app.config['STATIONS'], app.config['STATIONS_FILE'],
+                                       configure=configure_client)
+# The client of the station selected in the session (see before_request);
+# code that runs outside the request must take `stations.current()` instead
+api_client = LocalProxy(stations.current)
+# The first station is connected at start, later ones when first selected
+stations.current()
+_snapshot_refresh = {name: threading.Lock() for name in stations.names()}
+_snapshot_attempt = {}
+
+
+def refresh_snapshot_in_background():
+    """Downloads a fresh snapshot of the current station on a thread,
+    unless one already is."""
+    name, station_client = stations.current_name(), stations.current()
+    if not _snapshot_refresh[name].acquire(blocking=False):
+        return
+    _snapshot_attempt[name] = time()
+
+    def run():
+        try:
+            with deadline(app.config['SNAPSHOT_UPSTREAM_BUDGET']), priority('background'):
+                station_client.refresh_snapshot()
+        except Exception as e:
+            print(f'Snapshot refresh of {name} failed: {e}')
+        finally:
+            _snapshot_refresh[name].release()
+
+    threading.Thread(target=run, name=f'snapshot-refresh-{name}', daemon=True).start()
+
 
-# Instantiate your API client
-api_client = client()
+_write_behind = {}
+_write_behind_lock = threading.Lock()
+
+
+def mutations():
+    """Where schedule and library edits of the current station go: its
+    client, or the write-behind queue in front of it when WRITE_BEHIND is on."""
+    name, station_client = stations.current_name(), stations.current()
+    if not app.config['WRITE_BEHIND']:
+        return station_client
+    with _write_behind_lock:
+        if name not in _write_behind:
+            journal = app.config['WRITE_BEHIND_JOURNAL']
+            if name != stations.default:
+                journal = os.path.join(station_client.cache_dir, 'write_behind.jsonl')
+            _write_behind[name] = WriteBehindQueue(station_client, journal, budget=app.config['UPSTREAM_BUDGET'])
+        else:
+            # The station's client may have been replaced (`stations.attach`);
+            # one queue per journal, a second worker would send edits twice
+            _write_behind[name].client = station_client
+    return _write_behind[name]
 
 
 @app.before_request
 def before_request_func():
-    if api_client.jwt is None:
+    g.station = stations.select(session.get('station'))
+    last_refresh = _snapshot_attempt.get(stations.current_name())
+    # The token of the last login is shared through .cache by restarts and workers
+    if api_client.jwt is None and not api_client.restore_session():
         logout()
+    elif app.config['SNAPSHOT_REFRESH'] is not None and (
+            last_refresh is None or time() - last_refresh > app.config['SNAPSHOT_REFRESH']):
+        # Once after start, then periodically; also after a failed attempt
+        refresh_snapshot_in_background()
+    g.upstream_deadline = set_deadline(app.config['UPSTREAM_BUDGET'])
+
+
+@app.teardown_request
+def teardown_request_func(exc):
+    token = g.pop('upstream_deadline', None)
+    if token is not None:
+        try:
+            reset_deadline(token)
+        except ValueError:
+            pass
+    token = g.pop('station', None)
+    if token is not None:
+        try:
+            stations.reset(token)
+        except ValueError:
+            pass
+
+
+@app.context_processor
+def inject_stations():
+    return {'stations': [station.to_dict() for station in stations.stations.values()],
+            'current_station': stations.current_name()}
+
+
+@app.errorhandler(UpstreamError)
+def upstream_error(e):
+    status = 504 if isinstance(e, DeadlineExceeded) else 503
+    if request.path.startswith('/api/'):
+        return jsonify({'error': f'Radio server unavailable: {e}'}), status
+    return f'Radio server unavailable: {e}', status
 
 @app.route('/')
 def index():
@@ -38,8 +191,15 @@ def login():
     if request.method == 'POST':
         login = request.form['login']
         password = request.form['password']
-        if api_client.login(login, password):
+        # One login for all stations, the others may still be switched to
+        # and logged in to again if theirs fails
+        logins = stations.fan_out(lambda station_client: station_client.login(login, password))
+        current = logins[stations.current_name()]
+        if current['ok'] and current['result']:
             session['jwt'] = api_client.jwt.token  # Store JWT token in session
+            for name, result in logins.items():
+                if not (result['ok'] and result['result']):
+                    print(f'Login to station {name} failed: {result.get("error")}')
             return redirect(url_for('media_library'))
         else:
             return render_template('login.html', error=True)
@@ -50,8 +210,8 @@ def login():
 def media_library():
     if 'jwt' not in session:
         return redirect(url_for('login'))
-    media_list = api_client.search_media_in_library()
-    return render_template('media_library.html', media_list=media_list)
+    data = page_data.load(api_client, 'media_list')
+    return render_template('media_library.html', media_list=data['media_list'])
 
 
 @app.route('/media/<int:media_id>', methods=['POST', 'DELETE'])
@@ -62,35 +222,11 @@ def delete_media_from_library_by_id(media_id):
     # Проверка, является ли запрос методом DELETE
     if request.method == 'DELETE':
         try:
-            api_client.delete_media_by_id(media_id)
+            mutations().delete_media_by_id(media_id)
             return '', 204
         except Exception as e:
             return f"Failed to delete media item: {e}", 500
 
-    
-def filter_format_tags(client):
-    tag_types = client.get_available_tag_types()
-    format_type_id = next(
-        (type.id for type in tag_types if type.name == 'format'), None)
-    if format_type_id is None:
-        raise Exception("Format type not found")
-
-    all_tags = client.get_all_registered_tags()
-    format_tags = [tag for tag in all_tags if tag.type.id == format_type_id]
-    return format_tags
-
-
-def filter_podcast_tags(client):
-    tag_types = client.get_available_tag_types()
-    format_type_id = next(
-        (type.id for type in tag_types if type.name == 'podcast'), None)
-    if format_type_id is None:
-        raise Exception("Format type not found")
-
-    all_tags = client.get_all_registered_tags()
-    format_tags = [tag for tag in all_tags if tag.type.id == format_type_id]
-    return format_tags
-
 
 @app.route('/upload', methods=['GET', 'POST'])
 def upload():
@@ -103,23 +239,179 @@ def upload():
         # Assuming tags are submitted as a list of tag IDs
         tags = list(map(int, request.form.getlist('format_tag')))
         podcast_tags = list(map(int, request.form.getlist('podcast_tag')))
-        tags = [api_client.get_tag_by_id(tag_id).to_dict() for tag_id in tags + podcast_tags]
         file = request.files['source']
 
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            # A directory per upload, files with the same name may be queued at once
+            job_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'jobs', uuid.uuid4().hex)
+            os.makedirs(job_dir)
+            file_path = os.path.join(job_dir, filename)
             file.save(file_path)
-            print(name, author, tags, file_path)
-            media_id = api_client.post_media_with_source(
-                    name, author, file_path, tags)
-            print(media_id)
-            flash(f'Media uploaded successfully! ID: {media_id}', 'success')
-            os.remove(file_path)
+
+            station_client = stations.current()
+
+            def run(job):
+                return post_media_job(job, station_client, name, author, tags + podcast_tags, file_path)
+
+            job = upload_jobs.submit('upload', run, description=f'{author} - {name}',
+                                     cleanup=lambda: shutil.rmtree(job_dir, ignore_errors=True))
+            flash(f'Upload queued, job {job.id}', 'success')
             return redirect(url_for('upload'))
-    tags = filter_format_tags(api_client)
-    podcast_tags = filter_podcast_tags(api_client)
-    return render_template('upload.html', tags=[tag.to_dict() for tag in tags], podcast_tags=[tag.to_dict() for tag in podcast_tags])
+    data = page_data.load(api_client, 'format_tags', 'podcast_tags')
+    return render_template('upload.html', tags=[tag.to_dict() for tag in data['format_tags']],
+                           podcast_tags=[tag.to_dict() for tag in data['podcast_tags']])
+
+
+@app.route('/api/uploads', methods=['POST'])
+def api_init_upload():
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    data = request.json or {}
+    filename = secure_filename(data.get('filename') or '')
+    if not allowed_file(filename):
+        return jsonify({'error': 'File type is not allowed'}), 400
+    try:
+        tag_ids = list(map(int, data.get('tags') or []))
+        upload = chunked_uploads.init(filename, int(data.get('size', 0)),
+                                      int(data.get('chunk_size') or CHUNK_SIZE),
+                                      meta={'name': data.get('name'), 'author': data.get('author'),
+                                            'tags': tag_ids})
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), getattr(e, 'status', 400)
+    return jsonify(chunked_uploads.status(upload['id'])), 201
+
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'DELETE'])
+def api_upload_status(upload_id):
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    try:
+        status = chunked_uploads.status(upload_id)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    if request.method == 'DELETE':
+        chunked_uploads.discard(upload_id)
+        return jsonify({'status': 'success'})
+    return jsonify(status)
+
+
+@app.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def api_upload_chunk(upload_id, index):
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    try:
+        chunked_uploads.put_chunk(upload_id, index, request.stream, request.headers.get('X-Chunk-CRC32'))
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    return '', 204
+
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+def api_finalize_upload(upload_id):
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    try:
+        status = chunked_uploads.status(upload_id)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    missing = sorted(set(range(status['total_chunks'])) - set(status['received']))
+    if missing:
+        return jsonify({'error': f'Missing chunks: {missing[:20]}'}), 409
+
+    station_client = stations.current()
+
+    def run(job):
+        job.report(0.05, 'assembling file')
+        path, manifest = chunked_uploads.assemble(upload_id)
+        meta = manifest['meta']
+        try:
+            result = post_media_job(job, station_client, meta['name'], meta['author'], meta['tags'], path)
+        except JobCancelled:
+            chunked_uploads.discard(upload_id)
+            raise
+        except Exception:
+            # Keep the chunks, finalizing again retries the upload
+            os.remove(path)
+            raise
+        chunked_uploads.discard(upload_id)
+        return result
+
+    meta = chunked_uploads.manifest(upload_id)['meta']
+    job = upload_jobs.submit('upload', run, description=f"{meta['author']} - {meta['name']}", key=upload_id)
+    return jsonify(job.to_dict()), 202
+
+
+def post_media_job(job, station_client: client, name: str, author: str, tag_ids: list, path: str) -> dict:
+    """Body of an upload job: sends a file that is complete on disk to the
+    radio server of `station_client`. A job cancelled while its file was
+    being sent deletes the media it created."""
+    with deadline(app.config['UPLOAD_UPSTREAM_BUDGET']):
+        job.report(0.1, 'resolving tags')
+        tags = [station_client.get_tag_by_id(tag_id).to_dict() for tag_id in tag_ids]
+        job.report(0.2, 'uploading to the radio server')
+        media_id = station_client.post_media_with_source(name, author, path, tags)
+        if media_id is None:
+            raise ValueError('File is not a valid audio file')
+        if job.cancelled:
+            station_client.delete_media_by_id(media_id)
+            raise JobCancelled()
+        return {'media_id': media_id}
+
+
+def find_job(job_id: str):
+    """The job and the queue it runs on, (None, None) if it is unknown."""
+    for queue in job_queues:
+        job = queue.get(job_id)
+        if job is not None:
+            return job, queue
+    return None, None
+
+
+@app.route('/api/jobs', methods=['GET'])
+def api_jobs():
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    jobs = sorted((job for queue in job_queues for job in list(queue.jobs.values())),
+                  key=lambda job: job.created, reverse=True)
+    return jsonify([job.to_dict() for job in jobs])
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job(job_id):
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    job, _ = find_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def api_cancel_job(job_id):
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    job, queue = find_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    queue.cancel(job_id)
+    return jsonify(job.to_dict())
+
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def api_job_events(job_id):
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    job, queue = find_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    def stream():
+        for state in queue.watch(job):
+            yield ': keepalive\n\n' if state is None else f'data: {json.dumps(state)}\n\n'
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/schedule')
@@ -128,10 +420,9 @@ def view_schedule():
         return redirect(url_for('login'))
 
     try:
-        schedule = api_client.get_schedule()
-        print(schedule)
-        tags = filter_format_tags(api_client)
-        return render_template('schedule.html', schedule=schedule, format_tags=[tag.to_dict() for tag in tags])
+        # Segments are loaded page by page from /api/schedule
+        data = page_data.load(api_client, 'format_tags')
+        return render_template('schedule.html', format_tags=[tag.to_dict() for tag in data['format_tags']])
     except Exception as e:
         print(e, type(e))
         return redirect(url_for('media_library'))
@@ -141,11 +432,25 @@ def raw_schedule():
     if 'jwt' not in session:
         return redirect(url_for('login'))
 
+    now = datetime.now(tz=timezone.utc)
     try:
-        schedule = api_client.get_schedule()
-        return schedule
+        start = parse_user_time(request.args.get('cursor') or request.args.get('from') or now.isoformat())
+        stop = parse_user_time(request.args['to']) if request.args.get('to') else None
+        limit = min(max(int(request.args.get('limit', 100)), 1), 500)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid parameters: {e}'}), 400
+
+    try:
+        segments, next_cursor = api_client.get_schedule_page(start, stop, limit)
     except Exception as e:
         return {'error': f"Failed to load schedule: {e}"}
+    writer = mutations()
+    if isinstance(writer, WriteBehindQueue):
+        segments = writer.overlay_schedule(segments, start, next_cursor or stop)
+    return json_response({
+        'segments': segments,
+        'next_cursor': next_cursor.isoformat() if next_cursor else None,
+    })
 
 
 @app.route('/api/search_media', methods=['GET'])
@@ -166,7 +471,70 @@ def api_search_media():
     res_len = int(request.args.get('res_len', 5))
     media_list = api_client.search_media_in_library(
         name=name, author=author, tags=tags, res_len=res_len)
-    return jsonify(media_list)
+    writer = mutations()
+    if isinstance(writer, WriteBehindQueue):
+        media_list = writer.overlay_media(media_list)
+    return json_response(media_list)
+
+
+@app.route('/api/media/retag', methods=['POST'])
+def api_retag_media():
+    """Adds, removes or replaces tags on the media in `ids` or found by
+    `query` (the parameters of /api/search_media). Without `dry_run` the
+    updates run as a job; the response lists the planned changes."""
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    data = request.json or {}
+    try:
+        add = [api_client.get_tag_by_id(int(tag_id)).to_dict() for tag_id in data.get('add', [])]
+        remove = [int(tag_id) for tag_id in data.get('remove', [])]
+        replace = None
+        if data.get('replace') is not None:
+            replace = [api_client.get_tag_by_id(int(tag_id)).to_dict() for tag_id in data['replace']]
+    except UpstreamError:
+        raise
+    except ValueError as e:
+        return jsonify({'error': f'Unknown tag: {e}'}), 400
+    if not add and not remove and replace is None:
+        return jsonify({'error': 'Nothing to change, give add, remove or replace'}), 400
+
+    if data.get('ids') is not None:
+        media_ids = [int(media_id) for media_id in data['ids']]
+    elif data.get('query') is not None:
+        query = data['query']
+        tags = [api_client.get_tag_by_id(int(tag_id)).to_dict() for tag_id in query.get('tags', [])]
+        found = api_client.search_media_in_library(
+            name=query.get('name'), author=query.get('author'), tags=tags,
+            res_len=int(query.get('res_len', 1000)))
+        media_ids = [int(item['id']) for item in found]
+    else:
+        return jsonify({'error': 'Give the media as ids or query'}), 400
+
+    media = api_client.resolve_media(media_ids)
+    plan = plan_retag([media[media_id] for media_id in media_ids if media_id in media],
+                      add=add, remove=remove, replace=replace)
+    result = {
+        'changes': describe_changes(plan['changes']),
+        'unchanged': plan['unchanged'],
+        'missing': [media_id for media_id in media_ids if media_id not in media],
+    }
+    if data.get('dry_run') or not plan['changes']:
+        return jsonify(result)
+
+    writer = mutations()
+    changes = plan['changes']
+
+    def run(job):
+        with deadline(app.config['RETAG_UPSTREAM_BUDGET']):
+            results = apply_retag(
+                writer, changes, max_workers=app.config['RETAG_CONCURRENCY'], rate=app.config['RETAG_RATE'],
+                progress=lambda done: job.report(done / len(changes), f'{done} of {len(changes)} updated'))
+        failed = [item for item in results if not item['ok']]
+        return {'updated': len(results) - len(failed), 'failed': failed}
+
+    job = bulk_jobs.submit('retag', run, description=f'Retag {len(changes)} media')
+    result['job'] = job.to_dict()
+    return jsonify(result), 202
 
 
 @app.route('/api/schedule_track', methods=['POST'])
@@ -174,25 +542,154 @@ def api_schedule_track():
     if 'jwt' not in session:
         return redirect(url_for('login'))
     data = request.json
-    try:
-        data['start_time'] = datetime.strptime(data['start_time'], r'%Y-%m-%d %H:%M:%S')
-    except ValueError:
-        data['start_time'] = datetime.strptime(
-            data['start_time'], r'%Y-%m-%dT%H:%M:%S.%f%z')
-    result = api_client.create_new_segment(
+    if not data.get('start_time'):
+        # Append to the end of the schedule
+        data['start_time'] = None
+    else:
+        try:
+            data['start_time'] = datetime.strptime(data['start_time'], r'%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            data['start_time'] = datetime.strptime(
+                data['start_time'], r'%Y-%m-%dT%H:%M:%S.%f%z')
+    result = mutations().create_new_segment(
         media_id=data['media_id'], time=data['start_time'], stop_cut=data.get('duration', None))
     if result == -1:
         return jsonify({'error': 'Failed to schedule track; perhaps - track instersection'}), 500
     return jsonify(result), 201
 
 
-@app.route('/delete_segment/<int:segment_id>', methods=['POST', 'DELETE'])
+@app.route('/api/autodj/fill', methods=['POST'])
+def api_autodj_fill():
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    data = request.json or {}
+    hours = float(data.get('hours', 24))
+    tags = [api_client.get_tag_by_id(int(tag_id)).to_dict() for tag_id in data.get('tags', [])]
+    config = AutoDJConfig(Tags=tags, Stub=data.get('stub'))
+
+    now = datetime.now(tz=timezone.utc)
+    stop = now + timedelta(hours=hours)
+    schedule = api_client.get_schedule(stop=int(stop.timestamp()))
+    if api_client.library is None or not schedule:
+        api_client.fetch_all_media()
+    # What aired last, then what is already coming, so neither repeats soon
+    recent = api_client.history.recent_media(50) + [item['mediaID'] for item in schedule]
+    planner = AutoDJPlanner(config, api_client.library, recent=recent)
+    segments = planner.plan(find_gaps(schedule, now + timedelta(minutes=1), stop))
+
+    result = {'segments': [segment.to_dict() for segment in segments]}
+    if data.get('apply'):
+        # Many segments at once, they must not hold up other operators' clicks
+        with priority('background'):
+            ids = api_client.create_segments(segments)
+        result['ids'] = ids
+        result['conflicts'] = ids.count(-1)
+    return jsonify(result)
+
+
+@app.route('/api/history', methods=['GET'])
+def play_history():
+    """Plays of one media (?media_id=) or the most played media over the
+    last `days`, from the local play history."""
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    days = request.args.get('days', 30, type=int)
+    media_id = request.args.get('media_id', type=int)
+    if media_id is None:
+        return jsonify(api_client.history.summary(days=days, top=request.args.get('top', 20, type=int)))
+    last_played = api_client.history.last_played(media_id)
+    since = datetime.now(tz=timezone.utc) - timedelta(days=days)
+    return jsonify({'mediaID': media_id, 'days': days,
+                    'plays': api_client.history.plays(media_id, since=since),
+                    'last_played': last_played.isoformat() if last_played else None})
+
+
+@app.route('/api/schedule/compact', methods=['POST'])
+def api_compact_schedule():
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    data = request.json or {}
+    now = datetime.now(tz=timezone.utc)
+    start = max(parse_time(data['from']), now) if data.get('from') else now
+
+    try:
+        barriers = live_windows(api_client.get_lives())
+    except Exception as e:
+        return jsonify({'error': f'Failed to load lives, not compacting: {e}'}), 502
+    schedule = api_client.get_schedule(start=int(start.timestamp()))
+    if not data.get('from') and schedule:
+        # Without an explicit time keep the first upcoming segment in place
+        start = max(start, parse_time(schedule[0]['start']))
+    moves = plan_compaction(schedule, start, barriers)
+
+    result = {'moves': describe_moves(moves)}
+    if not data.get('apply') or not moves:
+        return jsonify(result)
+
+    station_client = stations.current()
+
+    def run(job):
+        with deadline(app.config['COMPACT_UPSTREAM_BUDGET']), priority('background'):
+            results = apply_moves(
+                station_client, moves,
+                progress=lambda done: job.report(done / len(moves), f'{done} of {len(moves)} moved'))
+        failed = [item for item in results if not item['ok']]
+        return {'moved': len(results) - len(failed), 'failed': failed, 'results': results}
+
+    job = bulk_jobs.submit('compact', run, description=f'Move {len(moves)} segments')
+    result['job'] = job.to_dict()
+    return jsonify(result), 202
+
+
+@app.route('/api/schedule/sync', methods=['POST'])
+def api_sync_schedule():
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    options = request.form if request.files else request.args
+    try:
+        if 'file' in request.files:
+            file = request.files['file']
+            fmt = 'csv' if file.filename.lower().endswith('.csv') else 'json'
+            desired = parse_desired_schedule(file.read().decode('utf-8'), fmt)
+        else:
+            desired = parse_desired_schedule(request.get_data(as_text=True), 'json')
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({'error': f'Failed to read desired schedule: {e}'}), 400
+    if not desired:
+        return jsonify({'error': 'Desired schedule is empty'}), 400
+
+    start = parse_user_time(options['from']) if options.get('from') else desired[0]['start']
+    if options.get('to'):
+        stop = parse_user_time(options['to'])
+    else:
+        stop = max(item['start'] for item in desired) + timedelta(microseconds=1)
+    schedule = api_client.get_schedule(start=int(start.timestamp()), stop=int(stop.timestamp()) + 1)
+    if api_client.library is None and any(item['stopCut'] is None for item in desired):
+        api_client.fetch_all_media()
+    plan = plan_sync(schedule, desired, start, stop, api_client.library)
+
+    result = {
+        'deletes': [item['id'] for item in plan['deletes']],
+        'creates': [segment.to_dict() for segment in plan['creates']],
+        'unchanged': len(plan['keep']),
+        'errors': plan['errors'],
+    }
+    if options.get('dry_run', '').lower() not in ('1', 'true', 'yes'):
+        results = apply_sync(api_client, plan)
+        result['results'] = results
+        result['ids'] = [item['id'] for item in results if item['op'] == 'create']
+        result['conflicts'] = result['ids'].count(-1)
+        result['failed'] = [item for item in results if not item['ok'] and item.get('id') != -1]
+    return jsonify(result)
+
+
+@app.route('/delete_segment/<int(signed=True):segment_id>', methods=['POST', 'DELETE'])
 def delete_segment(segment_id):
     if 'jwt' not in session:
         return redirect(url_for('login'))
 
     try:
-        api_client.delete_segment_by_id(segment_id)
+        mutations().delete_segment_by_id(segment_id)
         return '', 204
     except Exception as e:
         return f'Failed to delete schedule item: {e}', 500
@@ -208,25 +705,26 @@ def move_segment():
     top_end_time = data.get('topEndTime')
 
     current_segment, adjacent_segment = None, None
+    writer = mutations()
 
     # Получаем сегменты из базы данных
     if current_segment_id is not None:
-        current_segment = api_client.get_segment_by_id(current_segment_id)
+        current_segment = writer.get_segment_by_id(current_segment_id)
     if adjacent_segment_id is not None:
-        adjacent_segment = api_client.get_segment_by_id(adjacent_segment_id)
+        adjacent_segment = writer.get_segment_by_id(adjacent_segment_id)
 
     if current_segment is not None:
         if adjacent_segment is None:
             if direction == 'down':
                 current_segment_new_start = datetime.strptime(
                     top_end_time, r'%Y-%m-%dT%H:%M:%S.%f%z') - timedelta(microseconds=current_segment.stop_cut // 1e3)
-                api_client.delete_segment_by_id(current_segment_id)
-                api_client.create_new_segment(
+                writer.delete_segment_by_id(current_segment_id)
+                writer.create_new_segment(
                     media_id=current_segment.media_id, time=current_segment_new_start, stop_cut=current_segment.stop_cut)
             elif direction == 'up':
                 current_segment_new_start = datetime.strptime(top_start_time, r'%Y-%m-%dT%H:%M:%S.%f%z')
-                api_client.delete_segment_by_id(current_segment_id)
-                api_client.create_new_segment(
+                writer.delete_segment_by_id(current_segment_id)
+                writer.create_new_segment(
                     media_id=current_segment.media_id, time=current_segment_new_start, stop_cut=current_segment.stop_cut)
             else:
                 return jsonify({'status': 'error', 'message': 'Direction is invalid'}), 404
@@ -239,13 +737,13 @@ def move_segment():
                     current_segment.start, r'%Y-%m-%dT%H:%M:%S.%f%z') + timedelta(microseconds=adjacent_segment.stop_cut // 1e3)
 
                 # Delete both initial segments
-                api_client.delete_segment_by_id(current_segment_id)
-                api_client.delete_segment_by_id(adjacent_segment_id)
+                writer.delete_segment_by_id(current_segment_id)
+                writer.delete_segment_by_id(adjacent_segment_id)
 
                 # Create new segments
-                api_client.create_new_segment(
+                writer.create_new_segment(
                     media_id=current_segment.media_id, time=current_segment_new_start, stop_cut=current_segment.stop_cut)
-                api_client.create_new_segment(
+                writer.create_new_segment(
                     media_id=adjacent_segment.media_id, time=datetime.strptime(
                         current_segment.start, r'%Y-%m-%dT%H:%M:%S.%f%z'), stop_cut=adjacent_segment.stop_cut)
             # Обмениваем времена начала и конца сегментов
@@ -256,14 +754,14 @@ def move_segment():
                     adjacent_segment.start, r'%Y-%m-%dT%H:%M:%S.%f%z') + timedelta(microseconds=current_segment.stop_cut // 1e3)
 
                 # Delete both initial segments
-                api_client.delete_segment_by_id(current_segment_id)
-                api_client.delete_segment_by_id(adjacent_segment_id)
+                writer.delete_segment_by_id(current_segment_id)
+                writer.delete_segment_by_id(adjacent_segment_id)
 
                 # Create new segments
-                api_client.create_new_segment(
+                writer.create_new_segment(
                     media_id=current_segment.media_id, time=datetime.strptime(
                         adjacent_segment.start, r'%Y-%m-%dT%H:%M:%S.%f%z'), stop_cut=current_segment.stop_cut)
-                api_client.create_new_segment(
+                writer.create_new_segment(
                     media_id=adjacent_segment.media_id, time=adjacent_segment_new_start, stop_cut=adjacent_segment.stop_cut)
 
             else:
@@ -313,7 +811,7 @@ def get_tag_types():
         return redirect(url_for('login'))
 
     tag_types = api_client.get_available_tag_types()
-    return jsonify([tag_type.to_dict() for tag_type in tag_types])
+    return json_response(tag_types)
 
 @app.route('/api/get_tags', methods=['GET'])
 def get_tags():
@@ -321,7 +819,111 @@ def get_tags():
         return redirect(url_for('login'))
 
     tags = api_client.get_all_registered_tags()
-    return jsonify([tag.to_dict() for tag in tags])
+    return json_response(tags)
+
+@app.route('/api/write_behind', methods=['GET'])
+def write_behind_status():
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    writer = mutations()
+    if not isinstance(writer, WriteBehindQueue):
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **writer.status()})
+
+
+@app.route('/stats')
+def view_stats():
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    return render_template('stats.html')
+
+
+@app.route('/api/stats', methods=['GET'])
+def library_stats():
+    """Durations (ns) and counts per tag, tag type and author, split into
+    scheduled and unscheduled media; see library_stats.py."""
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    page_data.load(api_client, 'library', 'schedule')
+    authors = request.args.get('authors', 50, type=int)
+    return json_response(api_client.stats.to_dict(authors=authors))
+
+
+@app.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    return jsonify(api_client.cache_stats())
+
+
+@app.route('/api/stations', methods=['GET'])
+def api_stations():
+    """The configured stations with per-station metrics; see stations.py."""
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    return jsonify({'current': stations.current_name(), 'stations': stations.stats()})
+
+
+@app.route('/api/stations/select', methods=['POST'])
+def api_select_station():
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    name = (request.json or {}).get('station')
+    if name not in stations:
+        return jsonify({'error': f'Unknown station {name!r}'}), 404
+    session['station'] = name
+    return jsonify({'current': name})
+
+
+@app.route('/api/stations/search', methods=['GET'])
+def api_search_stations():
+    """Searches the libraries of all (or ?stations=) stations at once."""
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    name = request.args.get('name') or None
+    author = request.args.get('author') or None
+    res_len = int(request.args.get('res_len', 5))
+    names = request.args.get('stations')
+    try:
+        results = stations.fan_out(
+            lambda station_client: station_client.search_media_in_library(name=name, author=author, res_len=res_len),
+            names.split(',') if names else None)
+    except KeyError as e:
+        return jsonify({'error': e.args[0]}), 404
+    return json_response(results)
+
+
+@app.route('/api/stations/schedule_track', methods=['POST'])
+def api_schedule_track_everywhere():
+    """Schedules one media per station, e.g. the same jingle, at the same
+    time (or at the end of each schedule) on all of them at once. Takes
+    {"media": {"station": media_id, ...}, "start_time": ISO time, UTC if naive}."""
+    if 'jwt' not in session:
+        return redirect(url_for('login'))
+    data = request.json or {}
+    media = {name: int(media_id) for name, media_id in (data.get('media') or {}).items()}
+    if not media:
+        return jsonify({'error': 'Give the media to schedule per station'}), 400
+    start = None
+    if data.get('start_time'):
+        try:
+            start = parse_user_time(data['start_time'])
+        except ValueError:
+            return jsonify({'error': 'Invalid start time format'}), 400
+
+    def schedule(station_client):
+        # Through the station's write-behind queue when that is on
+        segment_id = mutations().create_new_segment(media[stations.current_name()], time=start)
+        if segment_id == -1:
+            raise ValueError('segment intersection')
+        return segment_id
+
+    try:
+        results = stations.fan_out(schedule, media)
+    except KeyError as e:
+        return jsonify({'error': e.args[0]}), 404
+    status = 201 if all(result['ok'] for result in results.values()) else 207
+    return jsonify(results), status
 
 @app.route('/logout')
 def logout():
@@ -0,0 +1,135 @@
+import bisect
+import random
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+from api_client import SEGMENT_TIME_FORMAT, parse_time
+from columnar import ColumnarLibrary
+from data_types import AutoDJConfig, Media, Segment
+
+SECOND = 10**9  # durations are in nanoseconds
+
+
+def find_gaps(schedule: list, start: datetime, stop: datetime, min_gap: int = SECOND) -> list:
+    """Free (start, stop) intervals of at least `min_gap` ns between `start`
+    and `stop`, given segments as returned by `client.get_schedule`."""
+    gaps = []
+    cursor = start
+    for item in sorted(schedule, key=lambda item: parse_time(item['start'])):
+        item_start, item_end = parse_time(item['start']), parse_time(item['end'])
+        if item_start >= stop:
+            break
+        if item_start > cursor:
+            gaps.append((cursor, item_start))
+        cursor = max(cursor, item_end)
+    if cursor < stop:
+        gaps.append((cursor, stop))
+    return [(a, b) for a, b in gaps if (b - a) >= timedelta(microseconds=min_gap // 1000)]
+
+
+class AutoDJPlanner:
+    """Fills schedule gaps with tracks from a library snapshot.
+
+    A track is a candidate when, for every tag type present in
+    `config.Tags`, it carries at least one of the configured tags of that
+    type (e.g. format=song and genre in {rock, pop}). Tracks that were used
+    during the last `repeat_window` picks are skipped while there is anything
+    else to choose from.
+
+    The tail of a gap that is too short for a whole track is filled with the
+    longest candidate cut down with `stopCut`, as long as at least
+    `min_segment` ns remain. `config.Stub` may name a filler media
+    (`{'mediaID': ...}`) for shorter tails.
+    """
+
+    def __init__(self, config: AutoDJConfig, library: dict, *, min_segment: int = 30 * SECOND,
+                 repeat_window: int = 50, recent: list = None, seed: int = None) -> None:
+        self.config = config
+        self.min_segment = min_segment
+        self.random = random.Random(seed)
+        if not isinstance(library, ColumnarLibrary):
+            library = ColumnarLibrary(library.values())
+        candidates = library.mask(tag_groups=self._tag_groups(), min_duration=SECOND)
+        self.candidates = sorted(library.media(candidates), key=lambda media: media.duration)
+        self.durations = [media.duration for media in self.candidates]
+        window = min(repeat_window, max(0, len(self.candidates) - 1))
+        self.recent = deque(maxlen=window)
+        self.recent_ids = set()
+        for media_id in (recent or [])[-window:] if window else []:
+            self._remember(media_id)
+        stub = config.Stub or {}
+        self.stub = library.get(stub.get('mediaID')) if stub.get('mediaID') else None
+
+    def _tag_groups(self) -> list[set]:
+        """Configured tag ids grouped by tag type; a candidate needs one of
+        every group."""
+        if not self.config.Tags:
+            return []
+        required = {}
+        for tag in self.config.Tags.tags:
+            required.setdefault(tag.type.id if tag.type else None, set()).add(tag.id)
+        return list(required.values())
+
+    def _remember(self, media_id: int) -> None:
+        if self.recent.maxlen == 0:
+            return
+        if len(self.recent) == self.recent.maxlen:
+            self.recent_ids.discard(self.recent[0])
+        self.recent.append(media_id)
+        self.recent_ids.add(media_id)
+
+    def _pick(self, max_duration: int):
+        """A random fresh candidate no longer than `max_duration`."""
+        end = bisect.bisect_right(self.durations, max_duration)
+        if end == 0:
+            return None
+        for _ in range(8):
+            media = self.candidates[self.random.randrange(end)]
+            if media.id not in self.recent_ids:
+                return media
+        start = self.random.randrange(end)
+        for index in list(range(start, end)) + list(range(start)):
+            if self.candidates[index].id not in self.recent_ids:
+                return self.candidates[index]
+        return self.candidates[self.random.randrange(end)]
+
+    def _trimmed(self, length: int):
+        """A fresh candidate of at least `length` ns, to be cut down."""
+        start = bisect.bisect_left(self.durations, length)
+        for index in range(len(self.candidates) - 1, start - 1, -1):
+            if self.candidates[index].id not in self.recent_ids:
+                return self.candidates[index]
+        return self.candidates[-1] if start < len(self.candidates) else None
+
+    def _segment(self, media: Media, start: datetime, stop_cut: int) -> Segment:
+        self._remember(media.id)
+        return Segment(mediaID=media.id,
+                       start=start.astimezone(timezone.utc).strftime(SEGMENT_TIME_FORMAT),
+                       beginCut=0, stopCut=stop_cut)
+
+    def fill_gap(self, start: datetime, stop: datetime) -> list[Segment]:
+        segments = []
+        cursor = start
+        remaining = int((stop - start) / timedelta(microseconds=1)) * 1000
+        while remaining > 0 and self.candidates:
+            media = self._pick(remaining)
+            stop_cut = media.duration if media is not None else None
+            if media is None and remaining >= self.min_segment:
+                media = self._trimmed(remaining)
+                stop_cut = remaining
+            if media is None and self.stub is not None:
+                media, stop_cut = self.stub, min(remaining, self.stub.duration)
+            if media is None:
+                break
+            segments.append(self._segment(media, cursor, stop_cut))
+            cursor += timedelta(microseconds=stop_cut // 1000)
+            remaining -= stop_cut // 1000 * 1000
+            if media is self.stub:
+                break
+        return segments
+
+    def plan(self, gaps: list) -> list[Segment]:
+        segments = []
+        for start, stop in gaps:
+            segments.extend(self.fill_gap(start, stop))
+        return segments
@@ -0,0 +1,273 @@
+"""Benchmarks for the client hot paths against a local fake upstream.
+
+    python -m benchmarks.bench_client                 # run and compare to baseline
+    python -m benchmarks.bench_client --save-baseline # record a new baseline
+    python -m benchmarks.bench_client -k schedule     # only matching scenarios
+
+Each scenario reports its median and fastest wall time over the repeats,
+the number of upstream requests it made and its peak Python memory. Results
+are written as JSON and compared against `benchmarks/baseline.json`, wall
+time by the fastest repeat; the exit code is 1 on any regression.
+"""
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.fake_upstream import spawn  # noqa: E402
+
+BASELINE = Path(__file__).with_name('baseline.json')
+
+# A run regresses if its fastest repeat is slower than baseline *
+# TIME_TOLERANCE + TIME_SLACK, it uses more than baseline * MEMORY_TOLERANCE
+# memory, or it makes more upstream requests than the baseline at all (or
+# none where the baseline made some).
+TIME_TOLERANCE = 1.5
+TIME_SLACK = 0.005
+MEMORY_TOLERANCE = 1.25
+
+SCENARIOS = {}
+
+
+def scenario(name, media=1000, segments=100, **seed):
+    def register(func):
+        SCENARIOS[name] = {'func': func, 'seed': dict(media=media, segments=segments, **seed)}
+        return func
+    return register
+
+
+def checked(response):
+    """Fails the scenario unless the route answered 2xx; a route that errors
+    out early makes fewer upstream requests and would look like a win."""
+    if not 200 <= response.status_code < 300:
+        raise AssertionError(f'{response.request.method} {response.request.path} answered '
+                             f'{response.status_code}: {response.get_data(as_text=True)[:200]}')
+    return response
+
+
+# Scenarios. Each one gets a fresh, logged-in context and returns the callable
+# to measure; anything done before returning is not measured.
+
+@scenario('get_schedule_rotation_1k', media=50000, segments=1000, rotation=30)
+@scenario('get_schedule_10k', segments=10000)
+@scenario('get_schedule_1k', segments=1000)
+@scenario('get_schedule_100', segments=100)
+def bench_get_schedule(ctx):
+    return ctx.client.get_schedule
+
+
+@scenario('schedule_page_route_10k', segments=10000)
+def bench_schedule_page(ctx):
+    http = ctx.flask_client()
+    return lambda: checked(http.get('/api/schedule?limit=100'))
+
+
+@scenario('fetch_all_media_50k', media=50000, segments=0)
+@scenario('fetch_all_media_1k', media=1000)
+def bench_fetch_all_media(ctx):
+    return ctx.client.fetch_all_media
+
+
+@scenario('hydrate_media_50k', media=0, segments=0)
+def bench_hydrate_media(ctx):
+    from data_types import Media
+    tags = [{'id': 1, 'name': 'song', 'type': {'id': 1, 'name': 'format'}, 'meta': None}]
+    items = [{'id': i, 'name': f'Track {i}', 'author': f'Artist {i % 500}',
+              'duration': 180 * 10**9, 'tags': tags} for i in range(50000)]
+    return lambda: {item['id']: Media.from_dict(item) for item in items}
+
+
+@scenario('hydrate_segments_10k', media=0, segments=0)
+def bench_hydrate_segments(ctx):
+    from data_types import Segment
+    items = [{'id': i, 'mediaID': i % 1000, 'start': '2024-05-01T12:00:00.000000+00:00',
+              'beginCut': 0, 'stopCut': 180 * 10**9} for i in range(10000)]
+    return lambda: [Segment.from_dict(item) for item in items]
+
+
+@scenario('hydrate_tags_10k', media=0, segments=0)
+def bench_hydrate_tags(ctx):
+    from data_types import Tag
+    items = [{'id': i, 'name': f'tag {i}', 'type': {'id': i % 3, 'name': 'genre'}, 'meta': None}
+             for i in range(10000)]
+    return lambda: [Tag.from_dict(item) for item in items]
+
+
+@scenario('search_media_client', media=50000, segments=0)
+def bench_search_client(ctx):
+    return lambda: ctx.client.search_media_in_library(name='Track 1', res_len=20)
+
+
+@scenario('search_media_route', media=50000, segments=0)
+def bench_search_route(ctx):
+    http = ctx.flask_client()
+    return lambda: checked(http.get('/api/search_media?name=Track%201&tags=1&tags=4&res_len=20'))
+
+
+@scenario('create_new_segment_x20', media=1000, segments=100)
+def bench_create_segments(ctx):
+    ids = list(range(1, 21))
+    return lambda: [ctx.client.create_new_segment(media_id) for media_id in ids]
+
+
+@scenario('move_segment_x10', media=1000, segments=100)
+def bench_move_segment(ctx):
+    http = ctx.flask_client()
+    schedule = ctx.client.get_schedule()
+
+    def run():
+        for index in range(0, 20, 2):
+            current, adjacent = schedule[index], schedule[index + 1]
+            checked(http.post('/api/move_segment', json={
+                'currentSegmentId': current['id'],
+                'adjacentSegmentId': adjacent['id'],
+                'direction': 'down',
+                'topStartTime': adjacent['end'],
+            }))
+    return run
+
+
+# Runner
+
+class Context:
+    def __init__(self, upstream) -> None:
+        import app as flask_app
+        self.upstream = upstream
+        self.module = flask_app
+        self.app = flask_app.app
+        # A background snapshot download would run into the measurements
+        self.app.config['SNAPSHOT_REFRESH'] = None
+        self.reset()
+
+    def reset(self) -> None:
+        """A fresh logged-in client, so no scenario runs with warm caches;
+        each gets a cache directory of its own, the HTTP cache is on disk."""
+        from api_client import client
+        self.client = client(base_url=self.upstream.url, cache_dir=tempfile.mkdtemp(prefix='client-', dir='.'))
+        self.client.login('bench', 'bench')
+        # Routes use the client of the current station, `api_client` is a proxy to it
+        self.module.stations.attach(self.client)
+
+    def flask_client(self):
+        http = self.app.test_client()
+        with http.session_transaction() as session:
+            session['jwt'] = self.client.jwt.token
+        return http
+
+
+def run_scenario(ctx, name, repeat):
+    spec = SCENARIOS[name]
+    times = []
+    calls = {}
+    for _ in range(repeat):
+        ctx.upstream.seed(**spec['seed'])
+        ctx.reset()
+        func = spec['func'](ctx)
+        ctx.upstream.reset_calls()
+        started = perf_counter()
+        func()
+        times.append(perf_counter() - started)
+        calls = ctx.upstream.calls()
+
+    # Memory is measured on a separate run, tracemalloc slows everything down.
+    ctx.upstream.seed(**spec['seed'])
+    ctx.reset()
+    func = spec['func'](ctx)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'wall_s': round(statistics.median(times), 6),
+        'wall_min_s': round(min(times), 6),
+        'upstream_requests': sum(calls.values()),
+        'upstream_calls': calls,
+        'peak_mem_kb': round(peak / 1024, 1),
+    }
+
+
+def compare(results, baseline):
+    failures = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['upstream_requests'] > base['upstream_requests']:
+            failures.append(f"{name}: upstream requests {base['upstream_requests']} -> "
+                            f"{result['upstream_requests']}")
+        elif result['upstream_requests'] == 0 and base['upstream_requests'] > 0:
+            # Nothing reached the upstream: the scenario broke, it did not get faster
+            failures.append(f"{name}: upstream requests {base['upstream_requests']} -> 0")
+        # The fastest repeat is much less noisy than the median
+        if result['wall_min_s'] > base['wall_min_s'] * TIME_TOLERANCE + TIME_SLACK:
+            failures.append(f"{name}: wall time {base['wall_min_s']:.4f}s -> {result['wall_min_s']:.4f}s")
+        if result['peak_mem_kb'] > base['peak_mem_kb'] * MEMORY_TOLERANCE + 64:
+            failures.append(f"{name}: peak memory {base['peak_mem_kb']}KB -> {result['peak_mem_kb']}KB")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-k', dest='pattern', default='',
+                        help='only run scenarios whose name contains this')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--baseline', default=str(BASELINE))
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args(argv)
+    output = os.path.abspath(args.output)
+
+    names = [name for name in SCENARIOS if args.pattern in name]
+    results = {}
+    cwd = os.getcwd()
+    with spawn() as upstream, tempfile.TemporaryDirectory() as workdir, \
+            open(os.devnull, 'w') as devnull:
+        # The client keeps its cache and saved credentials in the working
+        # directory; keep the operator's own ones out of the benchmark.
+        os.chdir(workdir)
+        try:
+            with contextlib.redirect_stdout(devnull):
+                ctx = Context(upstream)
+            for name in names:
+                with contextlib.redirect_stdout(devnull):
+                    results[name] = run_scenario(ctx, name, args.repeat)
+                r = results[name]
+                print(f"{name:28} {r['wall_s'] * 1000:10.2f} ms {r['upstream_requests']:6} req "
+                      f"{r['peak_mem_kb']:12.1f} KB")
+        finally:
+            os.chdir(cwd)
+
+    report = {'created': datetime.now().isoformat(timespec='seconds'),
+              'python': sys.version.split()[0], 'results': results}
+    with open(output, 'w') as wr:
+        json.dump(report, wr, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as wr:
+            json.dump(report, wr, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline to compare against, run with --save-baseline')
+        return 0
+    with open(args.baseline) as r:
+        failures = compare(results, json.load(r)['results'])
+    for failure in failures:
+        print(f'REGRESSION {failure}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""Startup benchmark: how soon a freshly started app answers.
+
+    python -m benchmarks.bench_startup                 # run and compare to baseline
+    python -m benchmarks.bench_startup --save-baseline # record a new baseline
+
+Every run starts the app in a new process twice against a fake upstream:
+cold, in an empty working directory, and warm, in the directory the cold
+run left behind (saved credentials and the library/tag snapshot). For each
+it reports the time `import app` takes, the time from process start to the
+first response and the time of the first page that needs tags (`/upload`)
+right after logging in. Results are written as JSON and compared against
+`benchmarks/startup_baseline.json`; the exit code is 1 on a regression.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter, sleep
+
+import requests
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.fake_upstream import spawn  # noqa: E402
+
+BASELINE = Path(__file__).with_name('startup_baseline.json')
+
+# Process startup is noisy, a metric regresses only when it is slower than
+# baseline * TIME_TOLERANCE + TIME_SLACK_MS.
+TIME_TOLERANCE = 1.5
+TIME_SLACK_MS = 50
+
+# Runs in the child process; the upstream URL has to be set before `app`
+# is imported, the snapshot is only restored for the same upstream.
+SERVE = """
+import logging, os, sys
+from time import perf_counter
+from werkzeug.serving import make_server
+logging.getLogger('werkzeug').setLevel(logging.WARNING)
+out, sys.stdout = sys.stdout, open(os.devnull, 'w')
+started = perf_counter()
+import api_client
+api_client.client.base_url = sys.argv[1]
+import app
+imported = perf_counter() - started
+server = make_server('127.0.0.1', 0, app.app, threaded=True)
+print(server.port, imported * 1000, file=out, flush=True)
+server.serve_forever()
+"""
+
+
+def start_app(workdir: str, upstream_url: str) -> dict:
+    started = perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', SERVE, upstream_url], cwd=workdir,
+                               stdout=subprocess.PIPE, text=True,
+                               env=dict(os.environ, PYTHONPATH=str(ROOT)))
+    port, import_ms = process.stdout.readline().split()
+    base_url = f'http://127.0.0.1:{port}'
+    requests.get(f'{base_url}/login', timeout=30).raise_for_status()
+    first_response_ms = (perf_counter() - started) * 1000
+
+    http = requests.Session()
+    http.post(f'{base_url}/login', data={'login': 'bench', 'password': 'bench'},
+              allow_redirects=False, timeout=30)
+    page_started = perf_counter()
+    http.get(f'{base_url}/upload', timeout=30).raise_for_status()
+    first_page_ms = (perf_counter() - page_started) * 1000
+    return {
+        'process': process,
+        'import_ms': float(import_ms),
+        'first_response_ms': first_response_ms,
+        'first_page_ms': first_page_ms,
+    }
+
+
+def wait_for(path: Path, timeout: float = 30) -> None:
+    deadline = perf_counter() + timeout
+    while not path.exists() and perf_counter() < deadline:
+        sleep(0.05)
+
+
+def run(upstream, runs: int) -> dict:
+    samples = {'cold': [], 'warm': []}
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as workdir:
+            for mode in ('cold', 'warm'):
+                result = start_app(workdir, upstream.url)
+                if mode == 'cold':
+                    # Let the background refresh write the snapshot the warm start uses
+                    wait_for(Path(workdir, '.cache', 'snapshot.json'))
+                result.pop('process').terminate()
+                samples[mode].append(result)
+    return {mode: {metric: round(statistics.median(sample[metric] for sample in results), 2)
+                   for metric in ('import_ms', 'first_response_ms', 'first_page_ms')}
+            for mode, results in samples.items()}
+
+
+def compare(results, baseline):
+    failures = []
+    for mode, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline.get(mode, {}).get(metric)
+            if base is not None and value > base * TIME_TOLERANCE + TIME_SLACK_MS:
+                failures.append(f'{mode} {metric}: {base:.1f}ms -> {value:.1f}ms')
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--media', type=int, default=5000)
+    parser.add_argument('--upstream-latency', type=float, default=0.05,
+                        help='artificial delay of every upstream call, seconds')
+    parser.add_argument('--output', default='startup_output.json')
+    parser.add_argument('--baseline', default=str(BASELINE))
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args(argv)
+
+    with spawn(latency=args.upstream_latency) as upstream:
+        upstream.seed(media=args.media, segments=100)
+        results = run(upstream, args.runs)
+    for mode, metrics in results.items():
+        print(f"{mode:5} import {metrics['import_ms']:8.1f} ms  first response "
+              f"{metrics['first_response_ms']:8.1f} ms  first page {metrics['first_page_ms']:8.1f} ms")
+
+    report = {'created': datetime.now().isoformat(timespec='seconds'),
+              'python': sys.version.split()[0], 'results': results}
+    with open(args.output, 'w') as wr:
+        json.dump(report, wr, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as wr:
+            json.dump(report, wr, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline to compare against, run with --save-baseline')
+        return 0
+    with open(args.baseline) as r:
+        failures = compare(results, json.load(r)['results'])
+    for failure in failures:
+        print(f'REGRESSION {failure}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
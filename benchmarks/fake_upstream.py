@@ -0,0 +1,434 @@
+"""In-memory stand-in for the radiomipt.ru admin API.
+
+Only the endpoints used by `api_client.client` are implemented. Every request
+is counted per route so benchmarks can report upstream amplification. The
+`/_fake/*` control routes are not counted. With `etags` on, GETs answer
+with an ETag and honour If-None-Match like a caching-aware server would.
+
+Use `spawn()` to run it in a child process, so that its allocations and CPU
+do not show up in the measurements of the process under test.
+"""
+import bisect
+import json
+import logging
+import multiprocessing
+import random
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from time import time
+
+import jwt
+import requests
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+SECRET = 'fake-upstream-secret'
+ISO_FORMAT = r'%Y-%m-%dT%H:%M:%S.%f+00:00'
+NS_IN_US = 1000
+
+FORMAT_TAGS = ['song', 'jingle', 'podcast']
+GENRE_TAGS = ['rock', 'pop', 'jazz', 'electronic', 'classic', 'indie']
+PODCAST_TAGS = ['morning show', 'science hour']
+
+
+def _to_us(value: str) -> int:
+    start = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    return int(start.timestamp() * 1e6)
+
+
+def _from_us(value: int) -> str:
+    return datetime.fromtimestamp(value / 1e6, tz=timezone.utc).strftime(ISO_FORMAT)
+
+
+class FakeUpstream:
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.etags = False
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.tag_types = []
+        self.tags = {}
+        self.media = {}
+        self.segments = {}
+        self._starts = []
+        self.lives = []
+        self.live = None
+        self._next_id = 1
+        self.app = self._build_app()
+        self._server = None
+        self._thread = None
+
+    # Lifecycle
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> 'FakeUpstream':
+        self._server = make_server(host, port, self.app, threaded=True)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+    @property
+    def url(self) -> str:
+        return f'http://{self._server.host}:{self._server.port}'
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # Counters
+
+    def reset_calls(self) -> None:
+        with self._lock:
+            self.calls.clear()
+
+    def total_calls(self) -> int:
+        with self._lock:
+            return sum(self.calls.values())
+
+    # Data
+
+    def seed(self, media: int = 1000, segments: int = 100, rotation: int = 0,
+             seed: int = 42) -> 'FakeUpstream':
+        """Fill the store with `media` tracks and `segments` back-to-back
+        segments starting a minute from now. With `rotation` the segments
+        only use that many distinct tracks."""
+        rnd = random.Random(seed)
+        with self._lock:
+            self.tag_types = [{'id': 1, 'name': 'format'},
+                              {'id': 2, 'name': 'genre'},
+                              {'id': 3, 'name': 'podcast'}]
+            self.tags = {}
+            tag_id = 1
+            for type_id, names in ((1, FORMAT_TAGS), (2, GENRE_TAGS), (3, PODCAST_TAGS)):
+                for name in names:
+                    self.tags[tag_id] = {'id': tag_id, 'name': name,
+                                         'type': self.tag_types[type_id - 1], 'meta': None}
+                    tag_id += 1
+            format_ids = [t['id'] for t in self.tags.values() if t['type']['id'] == 1]
+            genre_ids = [t['id'] for t in self.tags.values() if t['type']['id'] == 2]
+
+            self.media = {}
+            for media_id in range(1, media + 1):
+                tags = [self.tags[rnd.choice(format_ids)],
+                        self.tags[rnd.choice(genre_ids)]]
+                self.media[media_id] = {
+                    'id': media_id,
+                    'name': f'Track {media_id}',
+                    'author': f'Artist {rnd.randint(1, max(1, media // 10))}',
+                    'duration': rnd.randint(90, 420) * 10**9,
+                    'tags': tags,
+                }
+            self._next_id = media + 1
+
+            self.segments = {}
+            self._starts = []
+            cursor = int((time() + 60) * 1e6)
+            for _ in range(segments):
+                media_id = rnd.randint(1, rotation or media)
+                stop_cut = self.media[media_id]['duration']
+                self._insert_segment(media_id, cursor, stop_cut)
+                cursor += stop_cut // NS_IN_US
+        return self
+
+    def _new_id(self) -> int:
+        new_id = self._next_id
+        self._next_id += 1
+        return new_id
+
+    def _insert_segment(self, media_id: int, start_us: int, stop_cut: int, protected: bool = False) -> int:
+        segment_id = self._new_id()
+        self.segments[segment_id] = {'id': segment_id, 'mediaID': media_id, 'start_us': start_us,
+                                     'beginCut': 0, 'stopCut': stop_cut, 'protected': protected}
+        bisect.insort(self._starts, (start_us, segment_id))
+        return segment_id
+
+    def _remove_segment(self, segment_id: int) -> None:
+        segment = self.segments.pop(segment_id)
+        self._starts.remove((segment['start_us'], segment_id))
+
+    def _intersects(self, start_us: int, stop_cut: int) -> bool:
+        end_us = start_us + stop_cut // NS_IN_US
+        index = bisect.bisect_left(self._starts, (start_us, -1))
+        if index > 0:
+            prev = self.segments[self._starts[index - 1][1]]
+            if prev['start_us'] + prev['stopCut'] // NS_IN_US > start_us:
+                return True
+        return index < len(self._starts) and self._starts[index][0] < end_us
+
+    @staticmethod
+    def _segment_json(segment: dict) -> dict:
+        return {'id': segment['id'], 'mediaID': segment['mediaID'],
+                'start': _from_us(segment['start_us']), 'beginCut': segment['beginCut'],
+                'stopCut': segment['stopCut'], 'protected': segment['protected']}
+
+    # HTTP
+
+    def _build_app(self) -> Flask:
+        app = Flask(__name__)
+        upstream = self
+
+        @app.before_request
+        def count():
+            if request.path.startswith('/_fake/'):
+                return None
+            rule = request.url_rule.rule if request.url_rule else request.path
+            with upstream._lock:
+                upstream.calls[f'{request.method} {rule}'] += 1
+            if upstream.latency:
+                threading.Event().wait(upstream.latency)
+
+        @app.after_request
+        def etag(response):
+            if (upstream.etags and request.method == 'GET' and response.status_code == 200
+                    and not request.path.startswith('/_fake/')):
+                response.add_etag()
+                response.make_conditional(request)
+            return response
+
+        @app.post('/_fake/seed')
+        def fake_seed():
+            upstream.seed(**request.json)
+            upstream.reset_calls()
+            return jsonify({})
+
+        @app.route('/_fake/calls', methods=['GET', 'DELETE'])
+        def fake_calls():
+            if request.method == 'DELETE':
+                upstream.reset_calls()
+            with upstream._lock:
+                return jsonify(dict(upstream.calls))
+
+        @app.post('/_fake/latency')
+        def fake_latency():
+            upstream.latency = float(request.json['latency'])
+            return jsonify({})
+
+        @app.post('/_fake/etags')
+        def fake_etags():
+            upstream.etags = bool(request.json['etags'])
+            return jsonify({})
+
+        @app.post('/admin/login')
+        def login():
+            payload = {'login': request.json.get('login'),
+                       'exp': int(time() + 3600)}
+            return jsonify({'token': jwt.encode(payload, SECRET, algorithm='HS256')})
+
+        @app.get('/admin/library/media')
+        def library():
+            name = request.args.get('name') or ''
+            author = request.args.get('author') or ''
+            tag_ids = {int(t) for t in request.args.getlist('tags') if t.isdigit()}
+            res_len = request.args.get('res_len', type=int)
+            with upstream._lock:
+                items = list(upstream.media.values())
+            if name or author or tag_ids:
+                items = [m for m in items
+                         if name.lower() in m['name'].lower()
+                         and author.lower() in m['author'].lower()
+                         and tag_ids <= {t['id'] for t in m['tags']}]
+            if res_len:
+                items = items[:res_len]
+            return jsonify({'library': items})
+
+        @app.post('/admin/library/media')
+        def post_media():
+            # The client sends the media part without a filename, so it is a form field
+            media = json.loads(request.form.get('media') or request.files['media'].read())
+            source = request.files['source'].read()
+            with upstream._lock:
+                media_id = upstream._new_id()
+                upstream.media[media_id] = {
+                    'id': media_id, 'name': media['name'], 'author': media['author'],
+                    'duration': max(1, len(source)) * 10**5, 'tags': media.get('tags') or []}
+            return jsonify({'id': media_id})
+
+        @app.route('/admin/library/media/<int:media_id>', methods=['GET', 'PUT', 'DELETE'])
+        def media_by_id(media_id):
+            with upstream._lock:
+                media = upstream.media.get(media_id)
+                if media is None:
+                    return jsonify({'error': 'media not found'}), 404
+                if request.method == 'GET':
+                    return jsonify({'media': media})
+                if request.method == 'DELETE':
+                    del upstream.media[media_id]
+                    return jsonify({})
+                body = request.json['media']
+                media.update({k: body[k] for k in ('name', 'author', 'tags') if k in body})
+                return jsonify({})
+
+        @app.get('/admin/library/tag/types')
+        def tag_types():
+            return jsonify({'types': upstream.tag_types})
+
+        @app.route('/admin/library/tag', methods=['GET', 'POST', 'PUT'])
+        def tags():
+            with upstream._lock:
+                if request.method == 'GET':
+                    return jsonify({'tags': list(upstream.tags.values())})
+                tag = dict(request.json['tag'])
+                if request.method == 'POST':
+                    tag['id'] = upstream._new_id()
+                upstream.tags[tag['id']] = tag
+                return jsonify({'id': tag['id']})
+
+        @app.route('/admin/library/tag/<int:tag_id>', methods=['GET', 'DELETE'])
+        def tag_by_id(tag_id):
+            with upstream._lock:
+                tag = upstream.tags.get(tag_id)
+                if tag is None:
+                    return jsonify({'error': 'tag not found'}), 404
+                if request.method == 'DELETE':
+                    del upstream.tags[tag_id]
+                    return jsonify({})
+                return jsonify({'tag': tag})
+
+        @app.route('/admin/schedule', methods=['GET', 'POST', 'DELETE'])
+        def schedule():
+            with upstream._lock:
+                if request.method == 'GET':
+                    start_us = int(request.args.get('start', 0)) * 10**6
+                    stop = request.args.get('stop')
+                    stop_us = int(stop) * 10**6 if stop is not None else None
+                    index = bisect.bisect_left(upstream._starts, (start_us, -1))
+                    if index > 0:
+                        prev = upstream.segments[upstream._starts[index - 1][1]]
+                        if prev['start_us'] + prev['stopCut'] // NS_IN_US > start_us:
+                            index -= 1
+                    segments = []
+                    for seg_start, segment_id in upstream._starts[index:]:
+                        if stop_us is not None and seg_start >= stop_us:
+                            break
+                        segments.append(upstream._segment_json(upstream.segments[segment_id]))
+                    return jsonify({'segments': segments})
+                if request.method == 'DELETE':
+                    start_us = _to_us(str(request.args['from']))
+                    for seg_start, segment_id in list(upstream._starts):
+                        if seg_start >= start_us and not upstream.segments[segment_id]['protected']:
+                            upstream._remove_segment(segment_id)
+                    return jsonify({})
+                body = request.json['segment']
+                start_us = _to_us(body['start'])
+                if body['mediaID'] not in upstream.media:
+                    return jsonify({'error': 'media not found'}), 400
+                if upstream._intersects(start_us, body['stopCut']):
+                    return jsonify({'error': 'segment intersection'}), 400
+                segment_id = upstream._insert_segment(
+                    body['mediaID'], start_us, body['stopCut'])
+                return jsonify({'id': segment_id})
+
+        @app.route('/admin/schedule/<int:segment_id>', methods=['GET', 'DELETE'])
+        def segment_by_id(segment_id):
+            with upstream._lock:
+                segment = upstream.segments.get(segment_id)
+                if segment is None:
+                    return jsonify({'error': 'segment not found'}), 404
+                if request.method == 'DELETE':
+                    upstream._remove_segment(segment_id)
+                    return jsonify({})
+                return jsonify({'segment': upstream._segment_json(segment)})
+
+        @app.get('/radio/start')
+        @app.get('/radio/stop')
+        def radio():
+            return jsonify({})
+
+        @app.post('/admin/schedule/live/start')
+        def live_start():
+            upstream.live = dict(request.json['live'])
+            return jsonify({})
+
+        @app.get('/admin/schedule/live/stop')
+        def live_stop():
+            upstream.live = None
+            return jsonify({})
+
+        @app.get('/admin/schedule/live/info')
+        def live_info():
+            return jsonify({'live': upstream.live})
+
+        @app.get('/admin/schedule/lives')
+        def lives():
+            return jsonify({'lives': upstream.lives})
+
+        return app
+
+
+def _serve(latency: float, port: int, conn) -> None:
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    upstream = FakeUpstream(latency=latency)
+    server = make_server('127.0.0.1', port, upstream.app, threaded=True)
+    conn.send(server.port)
+    server.serve_forever()
+
+
+class RemoteUpstream:
+    """Handle to a `FakeUpstream` running in a child process."""
+
+    def __init__(self, process, port: int) -> None:
+        self.process = process
+        self.url = f'http://127.0.0.1:{port}'
+
+    def seed(self, **kwargs) -> 'RemoteUpstream':
+        requests.post(f'{self.url}/_fake/seed', json=kwargs).raise_for_status()
+        return self
+
+    def calls(self) -> dict:
+        return requests.get(f'{self.url}/_fake/calls').json()
+
+    def total_calls(self) -> int:
+        return sum(self.calls().values())
+
+    def reset_calls(self) -> None:
+        requests.delete(f'{self.url}/_fake/calls')
+
+    def set_latency(self, latency: float) -> None:
+        requests.post(f'{self.url}/_fake/latency', json={'latency': latency})
+
+    def set_etags(self, etags: bool) -> None:
+        requests.post(f'{self.url}/_fake/etags', json={'etags': etags})
+
+    def stop(self) -> None:
+        self.process.terminate()
+        self.process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def spawn(latency: float = 0.0, port: int = 0) -> RemoteUpstream:
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=_serve, args=(latency, port, child), daemon=True)
+    process.start()
+    return RemoteUpstream(process, parent.recv())
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the fake radio upstream.')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--media', type=int, default=1000)
+    parser.add_argument('--segments', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='artificial delay per request, seconds')
+    args = parser.parse_args()
+    upstream = FakeUpstream(latency=args.latency).seed(
+        media=args.media, segments=args.segments)
+    print(f'Fake upstream on http://127.0.0.1:{args.port}')
+    make_server('127.0.0.1', args.port, upstream.app, threaded=True).serve_forever()
@@ -0,0 +1,265 @@
+"""Multi-operator load generator for the Flask UI.
+
+    python -m benchmarks.load_test --operators 20 --duration 30
+
+By default both the app and a fake upstream are started in child processes.
+Every simulated operator logs in and then loops over a weighted mix of the
+things people do in the UI: open the library, search, look at the schedule,
+add a track to its end, move a segment, poll the live status.
+
+Reports throughput, p50/p95/p99 latency per route and upstream amplification
+(upstream calls per UI request), both overall and per route from a short
+sequential calibration pass.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+from collections import defaultdict
+from pathlib import Path
+from time import perf_counter, time
+
+import requests
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.fake_upstream import spawn  # noqa: E402
+
+SEARCH_TERMS = ['Track 1', 'Track 2', 'Artist 3', 'Track 4', 'Artist 5', '']
+
+
+def _serve_app(upstream_url: str, conn) -> None:
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    os.chdir(tempfile.mkdtemp())
+    sys.stdout = open(os.devnull, 'w')
+    # The app's only station is built from the default server at import
+    import api_client
+    api_client.client.base_url = upstream_url
+    import app as flask_app
+    server = make_server('127.0.0.1', 0, flask_app.app, threaded=True)
+    conn.send(server.port)
+    server.serve_forever()
+
+
+def spawn_app(upstream_url: str):
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=_serve_app, args=(upstream_url, child), daemon=True)
+    process.start()
+    return process, f'http://127.0.0.1:{parent.recv()}'
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Operator:
+    """One browser session going through the UI."""
+
+    def __init__(self, base_url: str, rnd: random.Random, stats) -> None:
+        self.base_url = base_url
+        self.rnd = rnd
+        self.stats = stats
+        self.http = requests.Session()
+        self.schedule = []
+
+    def call(self, route: str, method: str, path: str, **kwargs):
+        started = perf_counter()
+        try:
+            response = self.http.request(method, self.base_url + path,
+                                         allow_redirects=False, timeout=60, **kwargs)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            response, ok = None, False
+        self.stats.record(route, perf_counter() - started, ok)
+        return response
+
+    def login(self):
+        self.call('POST /login', 'POST', '/login',
+                  data={'login': 'operator', 'password': 'operator'})
+
+    def browse_library(self):
+        self.call('GET /media_library', 'GET', '/media_library')
+        self.call('GET /api/get_tag_types', 'GET', '/api/get_tag_types')
+        self.call('GET /api/get_tags', 'GET', '/api/get_tags')
+        self.call('GET /api/search_media', 'GET', '/api/search_media',
+                  params={'res_len': 5})
+
+    def search(self):
+        self.call('GET /api/search_media', 'GET', '/api/search_media',
+                  params={'name': self.rnd.choice(SEARCH_TERMS), 'res_len': 10})
+
+    def view_schedule(self):
+        response = self.call('GET /api/schedule', 'GET', '/api/schedule')
+        if response is not None and response.ok:
+            data = response.json()
+            self.schedule = data if isinstance(data, list) else data.get('segments', [])
+
+    def add_track(self):
+        # Like the "В конец" button: no start time, append to the schedule
+        self.call('POST /api/schedule_track', 'POST', '/api/schedule_track', json={
+            'media_id': self.rnd.randint(1, 100),
+        })
+
+    def move_segment(self):
+        if len(self.schedule) < 2:
+            self.view_schedule()
+        if len(self.schedule) < 2:
+            return
+        index = self.rnd.randrange(len(self.schedule) - 1)
+        current, adjacent = self.schedule[index], self.schedule[index + 1]
+        self.call('POST /api/move_segment', 'POST', '/api/move_segment', json={
+            'currentSegmentId': current['id'],
+            'adjacentSegmentId': adjacent['id'],
+            'direction': 'down',
+            'topStartTime': adjacent['end'],
+        })
+        self.schedule = []
+
+    def poll_live(self):
+        self.call('GET /api/get_live_status', 'GET', '/api/get_live_status')
+
+    ACTIONS = [
+        (browse_library, 2),
+        (search, 4),
+        (view_schedule, 4),
+        (add_track, 1),
+        (move_segment, 1),
+        (poll_live, 6),
+    ]
+
+    def run(self, deadline: float, think_time: float):
+        self.login()
+        actions, weights = zip(*self.ACTIONS)
+        while time() < deadline:
+            self.rnd.choices(actions, weights)[0](self)
+            if think_time:
+                threading.Event().wait(self.rnd.uniform(0, 2 * think_time))
+
+
+class Stats:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, route: str, elapsed: float, ok: bool) -> None:
+        with self._lock:
+            self.latencies[route].append(elapsed)
+            if not ok:
+                self.errors[route] += 1
+
+    def total(self) -> int:
+        return sum(len(values) for values in self.latencies.values())
+
+
+def calibrate(base_url: str, upstream) -> dict:
+    """Upstream calls caused by one request to each route, run one at a time."""
+    operator = Operator(base_url, random.Random(0), Stats())
+    upstream.reset_calls()
+    operator.login()
+    result = {'POST /login': upstream.total_calls()}
+    operator.view_schedule()
+    steps = {
+        'GET /media_library': lambda: operator.call('', 'GET', '/media_library'),
+        'GET /api/search_media': operator.search,
+        'GET /api/schedule': operator.view_schedule,
+        'POST /api/schedule_track': operator.add_track,
+        'POST /api/move_segment': operator.move_segment,
+        'GET /api/get_live_status': operator.poll_live,
+        'GET /api/get_tag_types': lambda: operator.call('', 'GET', '/api/get_tag_types'),
+        'GET /api/get_tags': lambda: operator.call('', 'GET', '/api/get_tags'),
+    }
+    for route, step in steps.items():
+        if route == 'POST /api/move_segment':
+            operator.view_schedule()
+        upstream.reset_calls()
+        step()
+        result[route] = upstream.total_calls()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--operators', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=20, help='seconds')
+    parser.add_argument('--think-time', type=float, default=0.2,
+                        help='mean pause between operator actions, seconds')
+    parser.add_argument('--media', type=int, default=5000)
+    parser.add_argument('--segments', type=int, default=200)
+    parser.add_argument('--upstream-latency', type=float, default=0.02,
+                        help='artificial delay of every upstream call, seconds')
+    parser.add_argument('--output', default='load_output.json')
+    args = parser.parse_args(argv)
+
+    upstream = spawn(latency=args.upstream_latency)
+    app_process, base_url = spawn_app(upstream.url)
+    try:
+        upstream.seed(media=args.media, segments=args.segments)
+        per_route = calibrate(base_url, upstream)
+        upstream.seed(media=args.media, segments=args.segments)
+
+        stats = Stats()
+        deadline = time() + args.duration
+        operators = [Operator(base_url, random.Random(i), stats) for i in range(args.operators)]
+        threads = [threading.Thread(target=op.run, args=(deadline, args.think_time))
+                   for op in operators]
+        started = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = perf_counter() - started
+        upstream_calls = upstream.calls()
+    finally:
+        app_process.terminate()
+        upstream.stop()
+
+    total = stats.total()
+    upstream_total = sum(upstream_calls.values())
+    report = {
+        'operators': args.operators,
+        'duration_s': round(elapsed, 3),
+        'requests': total,
+        'throughput_rps': round(total / elapsed, 2),
+        'upstream_requests': upstream_total,
+        'upstream_amplification': round(upstream_total / total, 2) if total else None,
+        'upstream_calls': upstream_calls,
+        'routes': {},
+    }
+    print(f"{args.operators} operators, {total} requests in {elapsed:.1f}s "
+          f"({report['throughput_rps']} req/s), "
+          f"{upstream_total} upstream calls (x{report['upstream_amplification']})")
+    print(f"{'route':28} {'count':>6} {'err':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'upstream':>8}")
+    for route in sorted(stats.latencies):
+        values = stats.latencies[route]
+        row = {
+            'count': len(values),
+            'errors': stats.errors[route],
+            'p50_ms': round(percentile(values, 50) * 1000, 2),
+            'p95_ms': round(percentile(values, 95) * 1000, 2),
+            'p99_ms': round(percentile(values, 99) * 1000, 2),
+            'upstream_per_request': per_route.get(route),
+        }
+        report['routes'][route] = row
+        print(f"{route:28} {row['count']:6} {row['errors']:5} {row['p50_ms']:9.1f} "
+              f"{row['p95_ms']:9.1f} {row['p99_ms']:9.1f} {str(row['upstream_per_request']):>8}")
+
+    with open(args.output, 'w') as wr:
+        json.dump(report, wr, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
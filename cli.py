@@ -0,0 +1,364 @@
+"""Command line tool for batch work on the radio server, e.g. from cron.
+
+    python -m cli [--base-url URL] [--login LOGIN] [--concurrency N] COMMAND ...
+
+    library export [--name TEXT] [--author TEXT] [--tag ID ...]
+    library upload FILE ... [--tag ID ...]
+    schedule export [--from TIME] [--to TIME]
+    schedule add PLAYLIST [--start TIME] [--dry-run]
+    schedule clear --from TIME
+    schedule compact [--from TIME] [--dry-run]
+    tags list | tags types
+    tags create NAME --type ID
+    tags delete ID ...
+    tags retag (--ids ID ... | --name TEXT | --author TEXT) [--add ID ...] [--remove ID ...]
+               [--replace ID ...] [--dry-run]
+
+Every result is written to stdout as soon as it is known, one JSON object per
+line, so output can be piped into `jq` or another script while a long batch
+is still running. Anything the client prints goes to stderr. The exit status
+is 1 when any item failed.
+
+The password is read from RADIO_PASSWORD (and the login from RADIO_LOGIN if
+--login is not given); without them the session or credentials saved by the
+web app or an earlier run for the same server are used. Servers the web app
+knows (the default one, or a station in `stations.json`) share its cache
+directory, any other server gets its own under `.cache/cli/`.
+"""
+import argparse
+import contextlib
+import json
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
+
+from api_client import SEGMENT_TIME_FORMAT, client, extract_metadata_and_remove_artwork, parse_time
+from data_types import Segment
+from retag import apply_retag, describe_changes, plan_retag
+from schedule_tools import apply_moves, describe_moves, live_windows, parse_user_time, plan_compaction
+from stations import StationRegistry
+from transport import PriorityLimiter, in_context
+
+
+class Output:
+    """Writes NDJSON records to `stream` and counts the failed ones."""
+
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self.failed = 0
+
+    def write(self, record: dict) -> None:
+        if record.get('ok') is False:
+            self.failed += 1
+        self.stream.write(json.dumps(record, default=_plain, ensure_ascii=False) + '\n')
+        self.stream.flush()
+
+
+def _plain(obj):
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def _time(value: str) -> datetime:
+    try:
+        return parse_user_time(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'not an ISO time: {value!r}')
+
+
+def _error(e: Exception) -> str:
+    return ' '.join(str(arg) for arg in e.args) if e.args else type(e).__name__
+
+
+def _run_concurrently(args, func, items, out: Output) -> None:
+    """Calls `func` for every item on `--concurrency` threads and writes the
+    records it returns in the order of `items`."""
+    with ThreadPoolExecutor(max_workers=max(1, min(args.concurrency, len(items) or 1))) as executor:
+        for record in executor.map(in_context(func), items):
+            out.write(record)
+
+
+# Library
+
+def library_export(cl: client, args, out: Output) -> None:
+    cl.fetch_all_media()
+    groups = [[tag_id] for tag_id in args.tag or ()]
+    mask = cl.library.mask(tag_groups=groups, name=args.name, author=args.author)
+    for media in cl.library.media(mask):
+        out.write(media.to_dict())
+
+
+def library_upload(cl: client, args, out: Output) -> None:
+    tags = [cl.get_tag_by_id(tag_id).to_dict() for tag_id in args.tag or ()]
+
+    def upload(path):
+        try:
+            meta = extract_metadata_and_remove_artwork(path)
+            if not meta['name'] or not meta['author']:
+                # Fall back to "Author - Name.mp3"
+                stem = os.path.splitext(os.path.basename(path))[0]
+                author, _, name = stem.partition(' - ')
+                meta = {'author': meta['author'] or author.strip(), 'name': meta['name'] or name.strip() or stem}
+            media_id = cl.post_media_with_source(meta['name'], meta['author'], path, tags)
+            if media_id is None:
+                return {'file': path, 'ok': False, 'error': 'not an mp3 file or missing'}
+            return {'file': path, 'ok': True, 'id': media_id, 'name': meta['name'], 'author': meta['author']}
+        except Exception as e:
+            return {'file': path, 'ok': False, 'error': _error(e)}
+
+    _run_concurrently(args, upload, args.files, out)
+
+
+# Schedule
+
+def schedule_export(cl: client, args, out: Output) -> None:
+    start = int(args.start.timestamp()) if args.start else None
+    stop = int(args.stop.timestamp()) if args.stop else None
+    for item in cl.get_schedule(start=start, stop=stop):
+        out.write(item)
+
+
+def read_playlist(path: str, library) -> tuple[list, list]:
+    """Media ids for a playlist file: one media id or "Author - Name" per
+    line, or an M3U playlist whose entries are named "Author - Name.mp3".
+    Returns the ids and the lines that matched no media."""
+    titles = {}
+    for media in library.values():
+        titles.setdefault(f'{media.author} - {media.name}'.casefold(), media.id)
+    ids, unknown = [], []
+    with open(path, encoding='utf-8-sig') as rd:
+        for line in rd:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.isdigit():
+                media_id = int(line) if int(line) in library else None
+            else:
+                title = os.path.basename(line)
+                if title.lower().endswith('.mp3'):
+                    title = title[:-4]
+                media_id = titles.get(title.casefold())
+            if media_id is None:
+                unknown.append(line)
+            else:
+                ids.append(media_id)
+    return ids, unknown
+
+
+def schedule_add(cl: client, args, out: Output) -> None:
+    cl.fetch_all_media()
+    ids, unknown = read_playlist(args.playlist, cl.library)
+    for line in unknown:
+        out.write({'entry': line, 'ok': False, 'error': 'unknown media'})
+
+    now = datetime.now(tz=timezone.utc)
+    start = args.start
+    if start is None:
+        # Right after what is already scheduled
+        schedule = cl.get_schedule()
+        start = max([now] + [parse_time(item['end']) for item in schedule if item.get('end')])
+    segments = []
+    for media_id in ids:
+        media = cl.library[media_id]
+        if not media.duration:
+            out.write({'mediaID': media_id, 'ok': False, 'error': 'unknown duration'})
+            continue
+        segments.append(Segment(mediaID=media_id, start=start.astimezone(timezone.utc).strftime(SEGMENT_TIME_FORMAT),
+                                beginCut=0, stopCut=media.duration))
+        start += timedelta(microseconds=media.duration // 1000)
+    if args.dry_run:
+        for segment in segments:
+            out.write({'mediaID': segment.media_id, 'start': segment.start, 'stopCut': segment.stop_cut, 'dry_run': True})
+        return
+    for segment, segment_id in zip(segments, cl.create_segments(segments, max_workers=args.concurrency)):
+        record = {'mediaID': segment.media_id, 'start': segment.start, 'ok': segment_id != -1}
+        if segment_id == -1:
+            record['error'] = 'segment intersection'
+        else:
+            record['id'] = segment_id
+        out.write(record)
+
+
+def schedule_clear(cl: client, args, out: Output) -> None:
+    cl.clear_schedule_from_timestamp(args.start)
+    out.write({'cleared_from': args.start, 'ok': True})
+
+
+def schedule_compact(cl: client, args, out: Output) -> None:
+    now = datetime.now(tz=timezone.utc)
+    start = max(args.start, now) if args.start else now
+    barriers = live_windows(cl.get_lives())
+    schedule = cl.get_schedule(start=int(start.timestamp()))
+    if not args.start and schedule:
+        # Like the web app: keep the first upcoming segment in place
+        start = max(start, parse_time(schedule[0]['start']))
+    moves = plan_compaction(schedule, start, barriers)
+    described = describe_moves(moves)
+    if args.dry_run:
+        for move in described:
+            out.write({**move, 'dry_run': True})
+        return
+    described = {move['id']: move for move in described}
+    for result in apply_moves(cl, moves):
+        out.write({**described[result['id']], **result})
+
+
+# Tags
+
+def tags_list(cl: client, args, out: Output) -> None:
+    for tag in cl.get_all_registered_tags():
+        out.write(tag.to_dict())
+
+
+def tags_types(cl: client, args, out: Output) -> None:
+    for tag_type in cl.get_available_tag_types():
+        out.write(tag_type.to_dict())
+
+
+def tags_create(cl: client, args, out: Output) -> None:
+    tag_type = next((tag_type for tag_type in cl.get_available_tag_types() if tag_type.id == args.type), None)
+    if tag_type is None:
+        raise SystemExit(f'Unknown tag type {args.type}')
+    tag_id = cl.register_new_tag(args.name, tag_type.to_dict())
+    out.write({'name': args.name, 'ok': True, 'id': tag_id})
+
+
+def tags_delete(cl: client, args, out: Output) -> None:
+    def delete(tag_id):
+        try:
+            cl.delete_tag_by_id(tag_id)
+            return {'id': tag_id, 'ok': True}
+        except Exception as e:
+            return {'id': tag_id, 'ok': False, 'error': _error(e)}
+
+    _run_concurrently(args, delete, args.ids, out)
+
+
+def tags_retag(cl: client, args, out: Output) -> None:
+    cl.fetch_all_media()
+    if args.ids:
+        media = [cl.library[media_id] for media_id in args.ids if media_id in cl.library]
+        for media_id in args.ids:
+            if media_id not in cl.library:
+                out.write({'id': media_id, 'ok': False, 'error': 'unknown media'})
+    else:
+        media = cl.library.media(cl.library.mask(name=args.name, author=args.author))
+    # Tags to remove are matched by id, the others are set as they are
+    tags = {tag_id: cl.get_tag_by_id(tag_id).to_dict() for tag_id in set((args.add or []) + (args.replace or []))}
+    plan = plan_retag(media, add=[tags[tag_id] for tag_id in args.add or ()], remove=args.remove or (),
+                      replace=None if args.replace is None else [tags[tag_id] for tag_id in args.replace])
+    if args.dry_run:
+        for change in describe_changes(plan['changes']):
+            out.write({**change, 'dry_run': True})
+        return
+    for result in apply_retag(cl, plan['changes'], max_workers=args.concurrency):
+        out.write(result)
+
+
+# Arguments
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m cli', description=__doc__.splitlines()[0])
+    parser.add_argument('--base-url', default=os.environ.get('RADIO_BASE_URL', client.base_url))
+    parser.add_argument('--login', default=os.environ.get('RADIO_LOGIN'))
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='upstream calls made at the same time (default: 8)')
+    commands = parser.add_subparsers(dest='group', required=True)
+
+    library = commands.add_parser('library').add_subparsers(dest='command', required=True)
+    export = library.add_parser('export', help='all media as NDJSON')
+    export.add_argument('--name')
+    export.add_argument('--author')
+    export.add_argument('--tag', type=int, nargs='+', help='only media with all of these tag ids')
+    export.set_defaults(func=library_export)
+    upload = library.add_parser('upload', help='upload mp3 files')
+    upload.add_argument('files', nargs='+')
+    upload.add_argument('--tag', type=int, nargs='+')
+    upload.set_defaults(func=library_upload)
+
+    schedule = commands.add_parser('schedule').add_subparsers(dest='command', required=True)
+    export = schedule.add_parser('export', help='upcoming segments as NDJSON')
+    export.add_argument('--from', dest='start', type=_time)
+    export.add_argument('--to', dest='stop', type=_time)
+    export.set_defaults(func=schedule_export)
+    add = schedule.add_parser('add', help='schedule a playlist back to back')
+    add.add_argument('playlist')
+    add.add_argument('--start', type=_time, help='default: after the last scheduled segment')
+    add.add_argument('--dry-run', action='store_true')
+    add.set_defaults(func=schedule_add)
+    clear = schedule.add_parser('clear', help='delete every segment from a time on')
+    clear.add_argument('--from', dest='start', type=_time, required=True)
+    clear.set_defaults(func=schedule_clear)
+    compact = schedule.add_parser('compact', help='close the gaps between segments')
+    compact.add_argument('--from', dest='start', type=_time)
+    compact.add_argument('--dry-run', action='store_true')
+    compact.set_defaults(func=schedule_compact)
+
+    tags = commands.add_parser('tags').add_subparsers(dest='command', required=True)
+    tags.add_parser('list').set_defaults(func=tags_list)
+    tags.add_parser('types').set_defaults(func=tags_types)
+    create = tags.add_parser('create')
+    create.add_argument('name')
+    create.add_argument('--type', type=int, required=True, help='tag type id')
+    create.set_defaults(func=tags_create)
+    delete = tags.add_parser('delete')
+    delete.add_argument('ids', type=int, nargs='+')
+    delete.set_defaults(func=tags_delete)
+    retag = tags.add_parser('retag', help='add, remove or replace tags of many media')
+    which = retag.add_mutually_exclusive_group(required=True)
+    which.add_argument('--ids', type=int, nargs='+')
+    which.add_argument('--name')
+    which.add_argument('--author')
+    retag.add_argument('--add', type=int, nargs='+')
+    retag.add_argument('--remove', type=int, nargs='+')
+    retag.add_argument('--replace', type=int, nargs='*')
+    retag.add_argument('--dry-run', action='store_true')
+    retag.set_defaults(func=tags_retag)
+    return parser
+
+
+def cache_dir(base_url: str) -> str:
+    """Where the client for `base_url` keeps its session and caches: the web
+    app's directory for that server if it has one, else one of our own."""
+    for station in StationRegistry.from_config(None, 'stations.json').stations.values():
+        if station.base_url == base_url:
+            return station.cache_dir
+    parts = urlsplit(base_url)
+    return os.path.join('.cache', 'cli', re.sub(r'[^A-Za-z0-9.-]+', '_', parts.netloc + parts.path).strip('_'))
+
+
+def connect(args) -> client:
+    base_url = args.base_url.rstrip('/')
+    cl = client(base_url=base_url, cache_dir=cache_dir(base_url))
+    # This process is the only user, let it use all of its slots
+    cl.http.limiter = PriorityLimiter(max_concurrent=max(1, args.concurrency), reserve=0, rates={})
+    password = os.environ.get('RADIO_PASSWORD')
+    if args.login and password:
+        if not cl.login(args.login, password):
+            raise SystemExit(f'Login as {args.login} failed')
+    elif not cl.restore_session() and not cl.user_info.get('login'):
+        raise SystemExit('Not logged in: set RADIO_LOGIN and RADIO_PASSWORD')
+    return cl
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    out = Output(sys.stdout)
+    # The client reports some failures with print, keep them out of the NDJSON
+    with contextlib.redirect_stdout(sys.stderr):
+        cl = connect(args)
+        try:
+            args.func(cl, args, out)
+        except (ValueError, OSError) as e:
+            out.write({'ok': False, 'error': _error(e)})
+    return 1 if out.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
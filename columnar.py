@@ -0,0 +1,293 @@
+"""Columnar in-memory media library.
+
+`ColumnarLibrary` replaces the dict of `Media` objects the client used to
+keep. Every media is a row: ids and durations live in parallel `array`s,
+names and authors are indices into one pool of interned strings, and tags
+are stored as CSR (`tag_ptr` row offsets into `tag_ids`) next to one row
+bitmap per tag. Tag dicts themselves are kept once per tag.
+
+Filters are bitmaps over rows held in Python ints, so combining tag,
+duration and text conditions is a handful of big-integer operations rather
+than a loop over `Media` objects; `ids`, `count` and `total_duration` read
+the matching rows with `itertools.compress`. It is still a mapping from
+media id to `Media`, but the `Media` is built from the row when it is read
+and changing it does not change the library: store it again instead.
+
+Rows are never changed in place. Replacing a media marks its old row dead
+and appends a new one; dead rows are dropped once there are as many of
+them as live ones.
+
+A library made `from_dicts` keeps the server's list until it is first
+used, so a download that nobody reads does not pay for the columns.
+"""
+import functools
+import threading
+from array import array
+from collections.abc import MutableMapping
+from itertools import compress
+
+from data_types import Media
+
+_TO_DIGITS = bytes.maketrans(b'\x00\x01', b'01')
+_FROM_DIGITS = bytes.maketrans(b'01', b'\x00\x01')
+NO_DURATION = -1
+
+
+def _mask_from_flags(flags: bytes) -> int:
+    """Bitmap with bit i set where flags[i] is 1."""
+    return int(flags.translate(_TO_DIGITS)[::-1], 2) if flags else 0
+
+
+def _flags_from_mask(mask: int, size: int) -> bytes:
+    """One 0/1 byte per row, the inverse of `_mask_from_flags`."""
+    return format(mask, 'b').zfill(size).encode()[::-1].translate(_FROM_DIGITS)[:size]
+
+
+def _field(item, key):
+    return item.get(key) if isinstance(item, dict) else getattr(item, key)
+
+
+def _loaded(method):
+    """Builds the columns of a `from_dicts` library before `method` runs."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._pending is not None:
+            self._load()
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+class ColumnarLibrary(MutableMapping):
+    def __init__(self, items=()) -> None:
+        self._lock = threading.RLock()
+        # Bumped by every change, tells callers whether what they derived still holds
+        self.version = 0
+        self._pending = None
+        self._reset()
+        self._extend(items)
+
+    @classmethod
+    def from_dicts(cls, items) -> 'ColumnarLibrary':
+        """From media as the server sends them, without building `Media`;
+        the columns are built when the library is first used."""
+        library = cls()
+        library._pending = items
+        return library
+
+    def _load(self) -> None:
+        with self._lock:
+            if self._pending is not None:
+                items, self._pending = self._pending, None
+                self._extend(items)
+
+    def _reset(self) -> None:
+        self._ids = array('q')
+        self._durations = array('q')
+        self._names = array('l')
+        self._authors = array('l')
+        self._tag_ptr = array('l', [0])
+        self._tag_ids = array('l')
+        self._strings = []
+        self._string_index = {}
+        # tag id -> tag dict, and tag id -> bitmap of the live rows with it
+        self._tags = {}
+        self._tag_masks = {}
+        self._live = 0
+        self._rows = {}
+
+    def _intern(self, value) -> int:
+        index = self._string_index.get(value)
+        if index is None:
+            index = self._string_index[value] = len(self._strings)
+            self._strings.append(value)
+        return index
+
+    def _extend(self, items) -> None:
+        """Appends many rows and builds the bitmaps once at the end;
+        updating them row by row would copy every bitmap each time."""
+        ids, durations, names, authors = self._ids, self._durations, self._names, self._authors
+        tag_ptr, tag_ids, tags, rows = self._tag_ptr, self._tag_ids, self._tags, self._rows
+        strings, string_index = self._strings, self._string_index
+        for item in items:
+            if not isinstance(item, dict):
+                self._append(item, bitmaps=False)
+                continue
+            # Inlined `_append` for server dicts, the bulk of every download
+            rows[int(item['id'])] = len(ids)
+            ids.append(int(item['id']))
+            duration = item.get('duration')
+            durations.append(NO_DURATION if duration is None else duration)
+            for column, value in ((names, item.get('name')), (authors, item.get('author'))):
+                index = string_index.get(value)
+                if index is None:
+                    index = string_index[value] = len(strings)
+                    strings.append(value)
+                column.append(index)
+            for tag in item.get('tags') or ():
+                tags[tag['id']] = tag
+                tag_ids.append(tag['id'])
+            tag_ptr.append(len(tag_ids))
+        size = len(self._ids)
+        live = bytearray(size)
+        for row in self._rows.values():
+            live[row] = 1
+        self._live = _mask_from_flags(bytes(live))
+        rows_by_tag = {}
+        for row in self._rows.values():
+            for tag_id in self._tag_ids[self._tag_ptr[row]:self._tag_ptr[row + 1]]:
+                rows_by_tag.setdefault(tag_id, []).append(row)
+        self._tag_masks = {}
+        for tag_id, rows in rows_by_tag.items():
+            flags = bytearray(size)
+            for row in rows:
+                flags[row] = 1
+            self._tag_masks[tag_id] = _mask_from_flags(bytes(flags))
+
+    def _append(self, item, bitmaps: bool = True) -> None:
+        media_id = int(_field(item, 'id'))
+        old = self._rows.get(media_id)
+        if old is not None and bitmaps:
+            self._kill(old)
+        row = len(self._ids)
+        duration = _field(item, 'duration')
+        self._ids.append(media_id)
+        self._durations.append(NO_DURATION if duration is None else int(duration))
+        self._names.append(self._intern(_field(item, 'name')))
+        self._authors.append(self._intern(_field(item, 'author')))
+        for tag in _field(item, 'tags') or []:
+            tag = tag.to_dict() if hasattr(tag, 'to_dict') else tag
+            tag_id = int(tag['id'])
+            self._tags[tag_id] = tag
+            self._tag_ids.append(tag_id)
+            if bitmaps:
+                self._tag_masks[tag_id] = self._tag_masks.get(tag_id, 0) | 1 << row
+        self._tag_ptr.append(len(self._tag_ids))
+        if bitmaps:
+            self._live |= 1 << row
+        self._rows[media_id] = row
+
+    def _kill(self, row: int) -> None:
+        keep = ~(1 << row)
+        self._live &= keep
+        for tag_id in self._tag_ids[self._tag_ptr[row]:self._tag_ptr[row + 1]]:
+            self._tag_masks[tag_id] &= keep
+
+    def _compact_if_needed(self) -> None:
+        dead = len(self._ids) - len(self._rows)
+        if dead > 1024 and dead > len(self._rows):
+            live = [self._media(row) for row in self._rows.values()]
+            self._reset()
+            self._extend(live)
+
+    def _media(self, row: int) -> Media:
+        duration = self._durations[row]
+        return Media(id=self._ids[row], name=self._strings[self._names[row]],
+                     author=self._strings[self._authors[row]],
+                     duration=None if duration == NO_DURATION else duration,
+                     tags=[self._tags[tag_id] for tag_id in self._tag_ids[self._tag_ptr[row]:self._tag_ptr[row + 1]]])
+
+    # Mapping
+
+    @_loaded
+    def __getitem__(self, media_id) -> Media:
+        with self._lock:
+            return self._media(self._rows[int(media_id)])
+
+    @_loaded
+    def __setitem__(self, media_id, media) -> None:
+        if int(media.id) != int(media_id):
+            raise ValueError(f'Media {media.id} stored as {media_id}')
+        with self._lock:
+            self._append(media)
+            self.version += 1
+            self._compact_if_needed()
+
+    @_loaded
+    def __delitem__(self, media_id) -> None:
+        with self._lock:
+            self._kill(self._rows.pop(int(media_id)))
+            self.version += 1
+            self._compact_if_needed()
+
+    @_loaded
+    def __contains__(self, media_id) -> bool:
+        try:
+            return int(media_id) in self._rows
+        except (TypeError, ValueError):
+            return False
+
+    @_loaded
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._rows))
+
+    @_loaded
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    @_loaded
+    def values(self) -> list[Media]:
+        with self._lock:
+            return [self._media(row) for row in self._rows.values()]
+
+    @_loaded
+    def items(self) -> list[tuple]:
+        with self._lock:
+            return [(media_id, self._media(row)) for media_id, row in self._rows.items()]
+
+    # Queries
+
+    @_loaded
+    def mask(self, *, tag_groups=(), min_duration: int = None, max_duration: int = None,
+             name: str = None, author: str = None) -> int:
+        """Bitmap of the live rows that have at least one tag id of every
+        group in `tag_groups`, a duration (ns) within the inclusive bounds
+        and, case insensitively, `name` and `author` in their name and
+        author."""
+        with self._lock:
+            mask = self._live
+            for group in tag_groups:
+                any_of = 0
+                for tag_id in group:
+                    any_of |= self._tag_masks.get(int(tag_id), 0)
+                mask &= any_of
+            if min_duration is not None or max_duration is not None:
+                # Media without a known duration never match a bound
+                bounds = range(max(0, min_duration or 0),
+                               max_duration + 1 if max_duration is not None else 2**63)
+                mask &= _mask_from_flags(bytes(map(bounds.__contains__, self._durations)))
+            for column, text in ((self._names, name), (self._authors, author)):
+                if text:
+                    text = text.lower()
+                    matching = {index for index, value in enumerate(self._strings)
+                                if value is not None and text in value.lower()}
+                    mask &= _mask_from_flags(bytes(map(matching.__contains__, column)))
+            return mask
+
+    def _flags(self, mask: int = None) -> bytes:
+        return _flags_from_mask(self._live if mask is None else mask, len(self._ids))
+
+    @_loaded
+    def ids(self, mask: int = None) -> list[int]:
+        with self._lock:
+            return list(compress(self._ids, self._flags(mask)))
+
+    @_loaded
+    def media(self, mask: int = None) -> list[Media]:
+        with self._lock:
+            return [self._media(row) for row in compress(range(len(self._ids)), self._flags(mask))]
+
+    @_loaded
+    def count(self, mask: int = None) -> int:
+        return (self._live if mask is None else mask).bit_count()
+
+    @_loaded
+    def total_duration(self, mask: int = None) -> int:
+        """Sum of the known durations (ns) of the rows in `mask`."""
+        with self._lock:
+            durations = array('q', compress(self._durations, self._flags(mask)))
+        return sum(durations) + durations.count(NO_DURATION)
+
+    @_loaded
+    def tag(self, tag_id: int) -> dict:
+        return self._tags.get(int(tag_id))
@@ -0,0 +1,253 @@
+"""Conditional-request cache for upstream GETs.
+
+`Transport` keeps the last 200 body of every GET URL here together with its
+validators. The next GET of that URL is sent with If-None-Match /
+If-Modified-Since, and a 304 is answered with the stored body, so nothing
+that has not changed is downloaded again. Servers that send no validators
+still return the full body; its hash then tells whether it changed, and
+either way the response is marked `unchanged` so callers can skip work
+they already did for that body. Bodies that come with validators are not
+hashed, a 304 or the same validators say the same.
+
+Only keys `cacheable` accepts (all by default) go through the cache at all;
+URLs that are hardly ever asked for twice would only cost a copy and a hash
+of their body and push useful entries out.
+
+Entries are kept in memory up to `max_bytes`, least recently used first
+out, and, with a `directory`, those whose key `persist` accepts (all by
+default) are also written to disk, bounded by `max_disk_bytes`, so they
+survive restarts.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from time import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import requests
+
+# Hop-by-hop and transfer headers that do not describe the stored body
+_DROPPED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection', 'keep-alive'}
+
+
+def _digest(body: bytes) -> str:
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+class _Entry:
+    __slots__ = ('headers', 'body', 'encoding', 'digest')
+
+    def __init__(self, headers: dict, body: bytes, encoding: str, digest: str) -> None:
+        self.headers = headers
+        self.body = body
+        self.encoding = encoding
+        self.digest = digest
+
+    @property
+    def size(self) -> int:
+        return len(self.body)
+
+    def validators(self) -> dict:
+        headers = {key.lower(): value for key, value in self.headers.items()}
+        conditional = {}
+        if 'etag' in headers:
+            conditional['If-None-Match'] = headers['etag']
+        if 'last-modified' in headers:
+            conditional['If-Modified-Since'] = headers['last-modified']
+        return conditional
+
+    def response(self, url: str) -> 'requests.Response':
+        """A fresh 200 response with the stored body, one per caller since
+        callers may change what `.json()` returns."""
+        import requests
+        from requests.structures import CaseInsensitiveDict
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.url = url
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.encoding = self.encoding
+        response._content = self.body
+        return response
+
+
+class ResponseCache:
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, directory: str = None,
+                 max_disk_bytes: int = 256 * 1024 * 1024, persist=None, cacheable=None) -> None:
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.persist = persist
+        self.cacheable = cacheable
+        self.revalidated = 0
+        self.unchanged = 0
+        self.changed = 0
+        self.disk_reads = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        # File name -> size of what is on disk, least recently written first
+        self._files = OrderedDict()
+        self._disk_size = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._scan_disk()
+
+    # Memory
+
+    def wants(self, key: str) -> bool:
+        return self.cacheable is None or self.cacheable(key)
+
+    def get(self, key: str) -> _Entry:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        entry = self._read(key)
+        if entry is not None:
+            self.disk_reads += 1
+            self._remember(key, entry)
+        return entry
+
+    def _remember(self, key: str, entry: _Entry) -> None:
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old.size
+            if entry.size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self._size += entry.size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.size
+
+    def update(self, key: str, entry: _Entry, response: 'requests.Response') -> 'requests.Response':
+        """Takes the response to a GET sent with `entry`'s validators: a 304
+        becomes the stored response, a 200 is stored. Both are marked with
+        `unchanged` when the body is the one stored before."""
+        if response.status_code == 304 and entry is not None:
+            self.revalidated += 1
+            cached = entry.response(response.url)
+            cached.unchanged = True
+            return cached
+        if response.status_code != 200:
+            return response
+        body = response.content
+        headers = {name: value for name, value in response.headers.items()
+                   if name.lower() not in _DROPPED_HEADERS}
+        fresh = _Entry(headers, body, response.encoding, None)
+        validators = fresh.validators()
+        if validators:
+            response.unchanged = entry is not None and entry.validators() == validators
+        else:
+            fresh.digest = _digest(body)
+            response.unchanged = entry is not None and entry.digest == fresh.digest
+        if response.unchanged:
+            self.unchanged += 1
+        else:
+            self.changed += 1
+        self._remember(key, fresh)
+        if not response.unchanged or validators != entry.validators():
+            self._write(key, fresh)
+        return response
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self._files.clear()
+            self._disk_size = 0
+        if self.directory is not None:
+            for name in os.listdir(self.directory):
+                os.remove(os.path.join(self.directory, name))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._size, 'max_bytes': self.max_bytes,
+                    'revalidated': self.revalidated, 'unchanged': self.unchanged,
+                    'changed': self.changed, 'disk_reads': self.disk_reads}
+
+    # Disk
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def _persisted(self, key: str) -> bool:
+        return self.directory is not None and (self.persist is None or self.persist(key))
+
+    def _read(self, key: str) -> _Entry:
+        if not self._persisted(key):
+            return None
+        try:
+            with open(self._path(key), 'rb') as rd:
+                meta = json.loads(rd.readline())
+                body = rd.read()
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            print(f'Ignoring broken cache entry for {key}: {e}')
+            return None
+        if meta.get('key') != key:
+            return None
+        if meta.get('digest') is None and len(body) != meta.get('size'):
+            return None
+        if meta.get('digest') is not None and _digest(body) != meta['digest']:
+            return None
+        return _Entry(meta['headers'], body, meta['encoding'], meta['digest'])
+
+    def _write(self, key: str, entry: _Entry) -> None:
+        if not self._persisted(key) or entry.size > self.max_disk_bytes:
+            return
+        meta = {'key': key, 'headers': entry.headers, 'encoding': entry.encoding,
+                'digest': entry.digest, 'size': entry.size, 'stored': time()}
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        header = json.dumps(meta).encode() + b'\n'
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as wr:
+                wr.write(header)
+                wr.write(entry.body)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f'Failed to write cache entry for {key}: {e}')
+            return
+        self._trim_disk(os.path.basename(path), len(header) + entry.size)
+
+    def _scan_disk(self) -> None:
+        """Picks up what earlier runs left on disk; later writes are counted
+        as they happen, so the directory is only listed once."""
+        files = []
+        for name in os.listdir(self.directory):
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+        for _, size, name in sorted(files):
+            self._files[name] = size
+            self._disk_size += size
+        self._trim_disk()
+
+    def _trim_disk(self, written: str = None, size: int = 0) -> None:
+        """Counts the file `written` and removes the least recently written
+        ones while there are more than `max_disk_bytes` on disk."""
+        removed = []
+        with self._lock:
+            if written is not None:
+                self._disk_size += size - self._files.pop(written, 0)
+                self._files[written] = size
+            while self._disk_size > self.max_disk_bytes and self._files:
+                name, old_size = self._files.popitem(last=False)
+                self._disk_size -= old_size
+                removed.append(name)
+        for name in removed:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
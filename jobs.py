@@ -0,0 +1,165 @@
+"""In-process background jobs with progress, cancellation and a cap on how
+many run at once.
+
+A job is a function that takes its `Job`, reports progress with
+`job.report` and checks `job.cancelled` between steps. Every change bumps
+`Job.version` and wakes `JobQueue.watch`, which the SSE endpoint follows.
+"""
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from transport import priority
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = 'queued', 'running', 'succeeded', 'failed', 'cancelled'
+FINISHED = {SUCCEEDED, FAILED, CANCELLED}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, queue, kind: str, description: str = None) -> None:
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.description = description
+        self.status = QUEUED
+        self.progress = 0.0
+        self.message = None
+        self.result = None
+        self.error = None
+        self.created = time()
+        self.started = None
+        self.finished = None
+        self.version = 0
+        self.key = None
+        self._queue = queue
+        self._cancel = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    @property
+    def done(self) -> bool:
+        return self.status in FINISHED
+
+    def report(self, progress: float = None, message: str = None) -> None:
+        """Updates progress (0..1) and raises JobCancelled if the job was
+        cancelled meanwhile, so every report is also a cancellation point."""
+        self._update(progress=self.progress if progress is None else progress,
+                     message=self.message if message is None else message)
+        if self.cancelled:
+            raise JobCancelled()
+
+    def _update(self, **fields) -> None:
+        with self._queue._changed:
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.version += 1
+            self._queue._changed.notify_all()
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'description': self.description,
+            'status': self.status,
+            'progress': round(self.progress, 3),
+            'message': self.message,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class JobQueue:
+    """Runs submitted jobs on at most `max_workers` threads; the rest wait
+    in order. Finished jobs are kept for `keep_for` seconds. Their upstream
+    calls belong to the priority class `priority` (see transport.py)."""
+
+    def __init__(self, max_workers: int = 2, keep_for: float = 3600, priority: str = 'bulk') -> None:
+        self.keep_for = keep_for
+        self.priority = priority
+        self.jobs = {}
+        self._changed = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+
+    def submit(self, kind: str, func, description: str = None, key=None, cleanup=None) -> Job:
+        """Queues `func`. While a job submitted with the same `key` has not
+        finished, that job is returned instead of starting another one.
+        `cleanup` is called once the job has ended, also when it was
+        cancelled before it started."""
+        self._prune()
+        with self._changed:
+            if key is not None:
+                for job in self.jobs.values():
+                    if job.key == key and not job.done:
+                        return job
+            job = Job(self, kind, description)
+            job.key = key
+            self.jobs[job.id] = job
+        self._executor.submit(self._run, job, func, cleanup)
+        return job
+
+    def _run(self, job: Job, func, cleanup) -> None:
+        try:
+            with self._changed:
+                if job.cancelled:
+                    return
+                job._update(status=RUNNING, started=time())
+            try:
+                with priority(self.priority):
+                    result = func(job)
+            except JobCancelled:
+                job._update(status=CANCELLED, finished=time())
+            except Exception as e:
+                job._update(status=FAILED, error=str(e), finished=time())
+            else:
+                job._update(status=SUCCEEDED, progress=1.0, result=result, finished=time())
+        finally:
+            if cleanup is not None:
+                cleanup()
+
+    def get(self, job_id: str) -> Job:
+        with self._changed:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Job:
+        """Asks the job to stop; a queued job never starts, a running one
+        stops at its next `report`."""
+        with self._changed:
+            job = self.jobs.get(job_id)
+            if job is not None and not job.done:
+                job._cancel.set()
+                if job.status == QUEUED:
+                    job._update(status=CANCELLED, finished=time())
+                else:
+                    job._update(message='cancelling')
+        return job
+
+    def watch(self, job: Job, keepalive: float = 15):
+        """Yields the job's state whenever it changes, and None after
+        `keepalive` seconds without change, until the job finishes."""
+        version = -1
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: job.version != version, timeout=keepalive)
+                if job.version == version:
+                    state = None
+                else:
+                    version, state = job.version, job.to_dict()
+            yield state
+            if state is not None and state['status'] in FINISHED:
+                return
+
+    def _prune(self) -> None:
+        now = time()
+        with self._changed:
+            for job_id in [job_id for job_id, job in self.jobs.items()
+                           if job.done and job.finished and now - job.finished > self.keep_for]:
+                del self.jobs[job_id]
@@ -0,0 +1,235 @@
+"""Library statistics kept up to date as media and segments change.
+
+Media count and total duration (ns) are kept per tag, per tag type, per
+author and for the whole library, each split into media that have an
+upcoming segment in the known schedule and media that do not. The client
+reports every change it makes or sees (`put_media`, `remove_media`,
+`put_segment`, `remove_segment`, `set_schedule`) and only the groups of the
+media concerned are adjusted; nothing is recomputed from the full library
+except when a new library download replaces it (`set_library`), and that
+only once the aggregates are next read or a media changes. `set_schedule`
+with the same segments as last time and nothing changed since is skipped.
+"""
+import threading
+from datetime import datetime
+
+
+class _Totals:
+    __slots__ = ('name', 'count', 'duration', 'scheduled_count', 'scheduled_duration')
+
+    def __init__(self, name) -> None:
+        self.name = name
+        self.count = 0
+        self.duration = 0
+        self.scheduled_count = 0
+        self.scheduled_duration = 0
+
+    def add(self, duration: int, scheduled: bool, sign: int) -> None:
+        self.count += sign
+        self.duration += sign * duration
+        if scheduled:
+            self.scheduled_count += sign
+            self.scheduled_duration += sign * duration
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'count': self.count,
+            'duration': self.duration,
+            'scheduled_count': self.scheduled_count,
+            'scheduled_duration': self.scheduled_duration,
+            'unscheduled_count': self.count - self.scheduled_count,
+            'unscheduled_duration': self.duration - self.scheduled_duration,
+        }
+
+
+def _tag_fields(tag) -> tuple:
+    if isinstance(tag, dict):
+        tag_type = tag.get('type') or {}
+        return int(tag['id']), tag.get('name'), tag_type.get('id'), tag_type.get('name')
+    return int(tag.id), tag.name, tag.type.id if tag.type else None, tag.type.name if tag.type else None
+
+
+def _timestamp(value) -> float:
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, str):
+        return datetime.fromisoformat(value).timestamp()
+    return float(value)
+
+
+class LibraryStats:
+    def __init__(self) -> None:
+        # media id -> (duration, author, tags as (id, name, type id, type name))
+        self._media = {}
+        # segment id -> (media id, start timestamp, end timestamp, stopCut)
+        self._segments = {}
+        # media id -> number of known upcoming segments
+        self._plays = {}
+        # Library given to `set_library` and not taken in yet
+        self._pending = None
+        # Segment changes so far, and what the last `set_schedule` saw
+        self._segment_changes = 0
+        self._last_schedule = None
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self) -> None:
+        self.library = _Totals('library')
+        self.by_tag = {}
+        self.by_type = {}
+        self.by_author = {}
+
+    def _apply(self, media_id: int, sign: int) -> None:
+        entry = self._media.get(media_id)
+        if entry is None:
+            return
+        duration, author, tags = entry
+        scheduled = self._plays.get(media_id, 0) > 0
+        self.library.add(duration, scheduled, sign)
+        groups = [(self.by_author, author, author)]
+        groups += [(self.by_tag, tag_id, name) for tag_id, name, _, _ in tags]
+        # A media with several tags of one type counts once for that type
+        groups += [(self.by_type, type_id, type_name)
+                   for type_id, type_name in {(tag[2], tag[3]) for tag in tags}]
+        for totals, key, name in groups:
+            group = totals.get(key)
+            if group is None:
+                group = totals[key] = _Totals(name)
+            group.add(duration, scheduled, sign)
+            if group.count == 0:
+                del totals[key]
+
+    # Media
+
+    def set_library(self, library: dict) -> None:
+        """Starts over from a full library download, keeping the schedule.
+        The library is read when the aggregates are next needed, so it must
+        be the client's own, kept up to date along with these stats."""
+        with self._lock:
+            self._media = {}
+            self._clear()
+            self._pending = library if library is not None else {}
+
+    def _load(self) -> None:
+        if self._pending is None:
+            return
+        library, self._pending = self._pending, None
+        for media in library.values():
+            self._media[int(media.id)] = self._entry(media)
+            self._apply(int(media.id), 1)
+
+    @staticmethod
+    def _entry(media) -> tuple:
+        return (int(media.duration or 0), media.author,
+                tuple(_tag_fields(tag) for tag in media.tags or []))
+
+    def put_media(self, media) -> None:
+        """Adds `media` or replaces what was known about it."""
+        media_id = int(media.id)
+        with self._lock:
+            self._load()
+            self._apply(media_id, -1)
+            self._media[media_id] = self._entry(media)
+            self._apply(media_id, 1)
+
+    def remove_media(self, media_id: int) -> None:
+        media_id = int(media_id)
+        with self._lock:
+            self._load()
+            self._apply(media_id, -1)
+            self._media.pop(media_id, None)
+
+    # Schedule
+
+    def _play(self, media_id: int, delta: int) -> None:
+        before = self._plays.get(media_id, 0)
+        after = before + delta
+        if (before > 0) != (after > 0):
+            self._apply(media_id, -1)
+        if after > 0:
+            self._plays[media_id] = after
+        else:
+            self._plays.pop(media_id, None)
+        if (before > 0) != (after > 0):
+            self._apply(media_id, 1)
+
+    def _put_segment(self, segment_id: int, media_id: int, start, stop_cut: int) -> None:
+        start = _timestamp(start)
+        segment = (media_id, start, start + stop_cut / 1e9, stop_cut)
+        old = self._segments.get(segment_id)
+        if old == segment:
+            return
+        self._segment_changes += 1
+        if old is not None:
+            self._play(old[0], -1)
+        self._segments[segment_id] = segment
+        self._play(media_id, 1)
+
+    def _remove_segment(self, segment_id: int) -> None:
+        old = self._segments.pop(segment_id, None)
+        if old is not None:
+            self._segment_changes += 1
+            self._play(old[0], -1)
+
+    def put_segment(self, segment_id: int, media_id: int, start, stop_cut: int) -> None:
+        with self._lock:
+            self._put_segment(int(segment_id), int(media_id), start, int(stop_cut))
+
+    def remove_segment(self, segment_id: int) -> None:
+        with self._lock:
+            self._remove_segment(int(segment_id))
+
+    def set_schedule(self, items: list, start=None, stop=None) -> None:
+        """Takes `items` (as from `client.get_schedule`) as every segment
+        that starts in [start, stop); segments known there but not among
+        them are gone. Segments that have ended are dropped as well."""
+        start = _timestamp(start) if start is not None else float('-inf')
+        stop = _timestamp(stop) if stop is not None else float('inf')
+        now = datetime.now().timestamp()
+        signature = hash(stop)
+        for item in items or []:
+            signature = hash((signature, item['id'], item['mediaID'], item['start'], item['stopCut']))
+        with self._lock:
+            last = self._last_schedule
+            if last is not None and last[:2] == (signature, self._segment_changes) and last[2] > now:
+                # The same segments as last time, none changed or ended since
+                return
+            seen = set()
+            for item in items or []:
+                seen.add(int(item['id']))
+                self._put_segment(int(item['id']), int(item['mediaID']), item['start'], int(item['stopCut']))
+            for segment_id, (_, segment_start, segment_end, _) in list(self._segments.items()):
+                if segment_end <= now or (segment_id not in seen and start <= segment_start < stop):
+                    self._remove_segment(segment_id)
+            first_end = min((segment[2] for segment in self._segments.values()), default=float('inf'))
+            self._last_schedule = (signature, self._segment_changes, first_end)
+
+    def remove_segments_from(self, start) -> None:
+        """Forgets the segments starting at or after `start`."""
+        start = _timestamp(start)
+        with self._lock:
+            for segment_id, segment in list(self._segments.items()):
+                if segment[1] >= start:
+                    self._remove_segment(segment_id)
+
+    # Reads
+
+    def to_dict(self, authors: int = None) -> dict:
+        """All aggregates; `authors` limits the authors to the ones with the
+        most content."""
+        with self._lock:
+            self._load()
+            by_author = sorted(self.by_author.values(), key=lambda group: group.duration, reverse=True)
+            result = {
+                'library': self.library.to_dict(),
+                'schedule': {'segments': len(self._segments),
+                             'duration': sum(segment[3] for segment in self._segments.values())},
+                'by_type': [dict(group.to_dict(), id=type_id) for type_id, group in self.by_type.items()],
+                'by_tag': [dict(group.to_dict(), id=tag_id) for tag_id, group in self.by_tag.items()],
+                'by_author': [group.to_dict() for group in by_author[:authors]],
+                'authors': len(by_author),
+            }
+        for key in ('by_type', 'by_tag'):
+            result[key].sort(key=lambda group: group['duration'], reverse=True)
+        return result
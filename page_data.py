@@ -0,0 +1,125 @@
+"""Data that pages are rendered with, loaded concurrently.
+
+A page asks for the datasets it needs by name, e.g.
+`load(api_client, 'format_tags', 'podcast_tags')`. Datasets may depend on
+other datasets; every dataset is loaded once per call however many others
+need it, and the ones that do not depend on each other are loaded at the
+same time, so a page waits for its slowest upstream call rather than for
+the sum of them. Upstream calls run with the deadline and priority of the
+request (see transport.in_context).
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from transport import in_context
+
+# name -> (function, names of the datasets it takes as keyword arguments)
+DATASETS = {}
+
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='page-data')
+
+
+def dataset(name: str, *needs: str):
+    """Registers a function computing dataset `name` from the client and the
+    datasets in `needs`, which it gets as keyword arguments."""
+    def register(func):
+        DATASETS[name] = (func, needs)
+        return func
+    return register
+
+
+def _levels(names) -> list[list[str]]:
+    """The datasets `names` need, grouped so that each group only depends
+    on earlier ones."""
+    depth = {}
+
+    def visit(name, path=()):
+        if name in depth:
+            return depth[name]
+        if name not in DATASETS:
+            raise KeyError(f'Unknown page dataset {name!r}')
+        if name in path:
+            raise ValueError(f'Page datasets depend on each other: {" -> ".join(path + (name,))}')
+        needs = DATASETS[name][1]
+        depth[name] = 1 + max((visit(need, path + (name,)) for need in needs), default=-1)
+        return depth[name]
+
+    for name in names:
+        visit(name)
+    levels = [[] for _ in range(max(depth.values(), default=-1) + 1)]
+    for name, level in depth.items():
+        levels[level].append(name)
+    return levels
+
+
+def load(client, *names: str) -> dict:
+    """Loads `names` and what they depend on; returns all of them by name.
+    If any dataset fails, the first error is raised once the others of its
+    group have finished."""
+    loaded = {}
+    for level in _levels(names):
+        def compute(name):
+            func, needs = DATASETS[name]
+            return func(client, **{need: loaded[need] for need in needs})
+
+        if len(level) == 1:
+            loaded[level[0]] = compute(level[0])
+            continue
+        futures = {name: _executor.submit(in_context(compute), name) for name in level}
+        errors = [future.exception() for future in futures.values()]
+        for error in errors:
+            if error is not None:
+                raise error
+        loaded.update((name, future.result()) for name, future in futures.items())
+    return loaded
+
+
+# Datasets
+
+@dataset('tag_types')
+def _tag_types(client):
+    return client.get_available_tag_types()
+
+
+@dataset('tags')
+def _tags(client):
+    return client.get_all_registered_tags()
+
+
+def _tags_of_type(type_name: str, tag_types, tags) -> list:
+    type_id = next((tag_type.id for tag_type in tag_types if tag_type.name == type_name), None)
+    if type_id is None:
+        raise Exception(f'Tag type {type_name!r} not found')
+    return [tag for tag in tags if tag.type.id == type_id]
+
+
+@dataset('format_tags', 'tag_types', 'tags')
+def _format_tags(client, tag_types, tags):
+    return _tags_of_type('format', tag_types, tags)
+
+
+@dataset('podcast_tags', 'tag_types', 'tags')
+def _podcast_tags(client, tag_types, tags):
+    return _tags_of_type('podcast', tag_types, tags)
+
+
+@dataset('media_list')
+def _media_list(client):
+    return client.search_media_in_library()
+
+
+@dataset('library')
+def _library(client):
+    """The library the client has, downloaded if it has none yet."""
+    if client.library is None:
+        client.fetch_all_media()
+    return client.library
+
+
+@dataset('schedule', 'library')
+def _schedule(client, library):
+    """The schedule the client has, downloaded if it has none yet. Segment
+    titles come from the library; without it every media would be fetched
+    one by one, which is slower than waiting for the library."""
+    if client.schedule is None:
+        client.get_schedule()
+    return client.schedule
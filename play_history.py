@@ -0,0 +1,168 @@
+"""Local record of the segments that have aired.
+
+Every aired segment is one fixed-width record (segment id, media id, start
+in microseconds since the epoch, length in ns) appended to a binary file, so
+the history only ever grows at the end and a crash can at most leave one
+torn record behind. On open the file is read into two indexes kept in
+memory: all starts in time order, and the starts of each media. "When was
+this played last" is then a dict lookup and "plays in the last 30 days" a
+bisection; records that other processes append to the same file are picked
+up before every read.
+"""
+import bisect
+import os
+import struct
+import threading
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+RECORD = struct.Struct('<qqqq')
+
+
+def _micros(value) -> int:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return int(value.timestamp() * 1_000_000) if isinstance(value, datetime) else int(value)
+
+
+def _time(micros: int) -> datetime:
+    return datetime.fromtimestamp(micros / 1_000_000, tz=timezone.utc)
+
+
+class PlayHistory:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._offset = 0
+        # Time index: parallel arrays ordered by start
+        self._starts = array('q')
+        self._media = array('q')
+        self._lengths = array('q')
+        # Media index: media id -> its starts, ordered
+        self._by_media = {}
+        self._segments = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            torn = os.path.getsize(path) % RECORD.size
+            if torn:
+                print(f'Dropping a torn record at the end of {path}')
+                with open(path, 'r+b') as f:
+                    f.truncate(os.path.getsize(path) - torn)
+        with self._lock:
+            self._catch_up()
+
+    def _index(self, segment_id: int, media_id: int, start: int, length: int) -> bool:
+        if segment_id in self._segments:
+            return False
+        self._segments.add(segment_id)
+        position = len(self._starts)
+        if position and self._starts[-1] > start:
+            position = bisect.bisect_right(self._starts, start)
+        self._starts.insert(position, start)
+        self._media.insert(position, media_id)
+        self._lengths.insert(position, length)
+        starts = self._by_media.setdefault(media_id, array('q'))
+        if starts and starts[-1] > start:
+            starts.insert(bisect.bisect_right(starts, start), start)
+        else:
+            starts.append(start)
+        return True
+
+    def _catch_up(self) -> None:
+        """Indexes the records appended since the last read, by this or
+        another process."""
+        try:
+            with open(self.path, 'rb') as rd:
+                rd.seek(self._offset)
+                data = rd.read()
+        except FileNotFoundError:
+            return
+        data = data[:len(data) - len(data) % RECORD.size]
+        for record in RECORD.iter_unpack(data):
+            self._index(*record)
+        self._offset += len(data)
+
+    def record(self, items: list) -> int:
+        """Appends the schedule items (dicts as from `client.get_schedule`)
+        that are not in the history yet; returns how many were new."""
+        with self._lock:
+            self._catch_up()
+            new = []
+            for item in items:
+                record = (int(item['id']), int(item['mediaID']), _micros(item['start']), int(item['stopCut']))
+                if self._index(*record):
+                    new.append(RECORD.pack(*record))
+            if new:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                try:
+                    os.write(fd, b''.join(new))
+                finally:
+                    os.close(fd)
+                # Moves past our records, and any another process wrote first
+                self._catch_up()
+            return len(new)
+
+    # Reads
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def last_end(self) -> datetime:
+        """End of the latest aired segment, None when the history is empty."""
+        with self._lock:
+            self._catch_up()
+            if not self._starts:
+                return None
+            return _time(max(start + length // 1000 for start, length in
+                             zip(self._starts[-16:], self._lengths[-16:])))
+
+    def last_played(self, media_id: int) -> datetime:
+        with self._lock:
+            self._catch_up()
+            starts = self._by_media.get(int(media_id))
+            return _time(starts[-1]) if starts else None
+
+    def plays(self, media_id: int, since=None, until=None) -> int:
+        """How often `media_id` started in [since, until)."""
+        with self._lock:
+            self._catch_up()
+            starts = self._by_media.get(int(media_id))
+            if not starts:
+                return 0
+            window = self._slice(starts, since, until)
+            return window.stop - window.start
+
+    @staticmethod
+    def _slice(starts: array, since, until) -> slice:
+        low = bisect.bisect_left(starts, _micros(since)) if since is not None else 0
+        high = bisect.bisect_left(starts, _micros(until)) if until is not None else len(starts)
+        return slice(low, high)
+
+    def counts(self, since=None, until=None) -> Counter:
+        """Plays per media id among the segments started in [since, until)."""
+        with self._lock:
+            self._catch_up()
+            return Counter(self._media[self._slice(self._starts, since, until)])
+
+    def between(self, since=None, until=None) -> list[dict]:
+        """The aired segments started in [since, until), in time order."""
+        with self._lock:
+            self._catch_up()
+            window = self._slice(self._starts, since, until)
+            return [{'mediaID': media_id, 'start': _time(start).isoformat(), 'stopCut': length}
+                    for media_id, start, length in zip(self._media[window], self._starts[window],
+                                                       self._lengths[window])]
+
+    def recent_media(self, limit: int) -> list[int]:
+        """Media ids of the last `limit` plays, oldest first."""
+        with self._lock:
+            self._catch_up()
+            return list(self._media[len(self._media) - limit:]) if limit > 0 else []
+
+    def summary(self, days: int = 30, top: int = 20) -> dict:
+        since = datetime.now(tz=timezone.utc) - timedelta(days=days)
+        counts = self.counts(since)
+        return {'days': days, 'plays': sum(counts.values()), 'media': len(counts),
+                'top': [{'mediaID': media_id, 'plays': plays, 'last_played': self.last_played(media_id).isoformat()}
+                        for media_id, plays in counts.most_common(top)]}
@@ -0,0 +1,77 @@
+"""JSON responses for the API routes that send large payloads.
+
+Model objects (anything with `to_dict`) are handed to the encoder as they
+are and turned into dicts one at a time while encoding, instead of building
+the whole payload as a tree of dicts first. orjson is used when installed;
+brotli is offered next to gzip when the `brotli` module is available.
+Responses carry an ETag of the uncompressed body (weak once compressed) so
+browsers can revalidate with If-None-Match and get a 304.
+"""
+import gzip
+import hashlib
+import json
+
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def _model(obj):
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def dumps(payload) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload, default=_model, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, default=_model, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def _encoding() -> str:
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def json_response(payload, status: int = 200) -> Response:
+    """`payload` as a JSON response, compressed when the client accepts it,
+    or an empty 304 when the client already has this exact body."""
+    body = dumps(payload)
+    etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+    encoding = _encoding() if len(body) >= MIN_COMPRESS_SIZE else None
+    if status == 200 and request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=encoding is not None)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Accept-Encoding')
+        return response
+
+    if encoding == 'br':
+        body = brotli.compress(body, quality=BROTLI_QUALITY)
+    elif encoding == 'gzip':
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+    response = Response(body, status=status, mimetype='application/json')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if status == 200:
+        response.set_etag(etag, weak=encoding is not None)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,97 @@
+"""Adding, removing and replacing tags on many media at once.
+
+`plan_retag` works out the new tag list of every media from what the client
+already has locally and leaves out media the change would not touch;
+`apply_retag` sends the remaining updates concurrently under a rate limit
+and reports the outcome per media instead of stopping at the first error.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from data_types import Media
+from transport import RateLimiter, UpstreamError, in_context
+
+
+def tag_id(tag) -> int:
+    return int(tag['id'] if isinstance(tag, dict) else tag.id)
+
+
+def plan_retag(media: list[Media], add: list = (), remove=(), replace: list = None) -> dict:
+    """Changes that give every media in `media` the requested tags.
+
+    `replace` (tag dicts) becomes the whole tag list, then the tags in `add`
+    (tag dicts) are appended and the ids in `remove` dropped. Tags a media
+    keeps stay in their order. Media whose tags end up the same are counted
+    in `unchanged` and not sent."""
+    remove = {int(item) for item in remove}
+    changes, unchanged = [], 0
+    for item in media:
+        current = list(item.tags or [])
+        tags = list(replace) if replace is not None else list(current)
+        ids = {tag_id(tag) for tag in tags}
+        for tag in add:
+            if tag_id(tag) not in ids:
+                tags.append(tag)
+                ids.add(tag_id(tag))
+        tags = [tag for tag in tags if tag_id(tag) not in remove]
+
+        before = [tag_id(tag) for tag in current]
+        after = [tag_id(tag) for tag in tags]
+        if sorted(before) == sorted(after):
+            unchanged += 1
+            continue
+        changes.append({'media': item, 'tags': tags,
+                        'added': sorted(set(after) - set(before)),
+                        'removed': sorted(set(before) - set(after))})
+    return {'changes': changes, 'unchanged': unchanged}
+
+
+def describe_changes(changes: list) -> list[dict]:
+    return [{'id': change['media'].id,
+             'title': f"{change['media'].author} - {change['media'].name}",
+             'added': change['added'],
+             'removed': change['removed']}
+            for change in changes]
+
+
+def apply_retag(client, changes: list, max_workers: int = 8, rate: float = 20,
+                progress=None) -> list[dict]:
+    """Sends the updates of `plan_retag`, at most `rate` per second on
+    `max_workers` threads. Returns one result per change, in order, with
+    `ok` and the error message of the updates that failed.
+
+    `progress` is called with the number of finished updates after each
+    one; if it raises (e.g. `JobCancelled`), the updates not started yet
+    are skipped and the exception is raised once the running ones end."""
+    if not changes:
+        return []
+    limiter = RateLimiter(rate, burst=max_workers)
+    lock = threading.Lock()
+    stopped = []
+    finished = 0
+
+    def update(change):
+        nonlocal finished
+        media = change['media']
+        if stopped:
+            return {'id': media.id, 'ok': False, 'error': 'skipped'}
+        try:
+            limiter.acquire()
+            client.update_media_information(media.id, media.name, media.author, change['tags'])
+            result = {'id': media.id, 'ok': True}
+        except (UpstreamError, ValueError) as e:
+            result = {'id': media.id, 'ok': False, 'error': str(e)}
+        with lock:
+            finished += 1
+            try:
+                if progress is not None:
+                    progress(finished)
+            except Exception as e:
+                stopped.append(e)
+        return result
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(changes))) as executor:
+        results = list(executor.map(in_context(update), changes))
+    if stopped:
+        raise stopped[0]
+    return results
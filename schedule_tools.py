@@ -0,0 +1,240 @@
+import csv
+import io
+import json
+from datetime import datetime, timedelta, timezone
+
+from api_client import SEGMENT_TIME_FORMAT, parse_time
+from data_types import Segment
+from transport import time_left
+
+
+def segment_length(item: dict) -> timedelta:
+    return timedelta(microseconds=item['stopCut'] // 1000)
+
+
+def live_windows(lives) -> list:
+    """(start, stop) of every live with both ends known, from `client.get_lives`."""
+    if isinstance(lives, dict):
+        lives = lives.get('lives') or []
+    windows = []
+    for live in lives or []:
+        start, stop = live.get('start'), live.get('stop')
+        if not start or not stop:
+            continue
+        if isinstance(start, (int, float)):
+            start = datetime.fromtimestamp(start, tz=timezone.utc)
+            stop = datetime.fromtimestamp(stop, tz=timezone.utc)
+        else:
+            start, stop = parse_time(start), parse_time(stop)
+        windows.append((start, stop))
+    return windows
+
+
+def plan_compaction(schedule: list, start: datetime, barriers: list = ()) -> list:
+    """Moves that shift every segment starting at or after `start` as early as
+    possible, keeping their order.
+
+    Protected segments and `barriers` ((start, stop) pairs, e.g. lives) stay
+    where they are; segments that do not fit in front of one continue right
+    after it. Only segments whose start actually changes are returned, as
+    dicts with the schedule item and its new start.
+    """
+    items = sorted(schedule, key=lambda item: parse_time(item['start']))
+    fixed = sorted(list(barriers) + [(parse_time(item['start']), parse_time(item['end']))
+                                     for item in items if item.get('protected')])
+    cursor = start
+    for item in items:
+        if parse_time(item['start']) < start:
+            cursor = max(cursor, parse_time(item['end']))
+
+    moves = []
+    for item in items:
+        old_start = parse_time(item['start'])
+        if old_start < start or item.get('protected'):
+            continue
+        length = segment_length(item)
+        new_start = cursor
+        for fixed_start, fixed_stop in fixed:
+            if fixed_stop <= new_start:
+                continue
+            if fixed_start >= new_start + length:
+                break
+            new_start = fixed_stop
+        new_start = min(new_start, old_start)
+        if new_start != old_start:
+            moves.append({'segment': item, 'start': new_start})
+        cursor = new_start + length
+    return moves
+
+
+def _segment_at(item: dict, start: datetime) -> Segment:
+    return Segment(mediaID=item['mediaID'],
+                   start=start.astimezone(timezone.utc).strftime(SEGMENT_TIME_FORMAT),
+                   beginCut=item.get('beginCut', 0), stopCut=item['stopCut'])
+
+
+def apply_moves(client, moves: list, progress=None, reserve: float = 5) -> list[dict]:
+    """Moves the segments one at a time in start order, each deleted and
+    recreated at its new start. A segment only ever moves earlier, into
+    room left by the ones before it, so at most one segment is off the
+    schedule at any time.
+
+    Returns one result per move, in start order, with `ok` and the new id,
+    or the error. A segment that could not be recreated is put back where
+    it was (`restoredID`, or `lost` if that failed too). After a failed
+    move the rest are skipped, they were planned to follow it; so are the
+    moves that would start with less than `reserve` seconds of the upstream
+    deadline left, there would be no time to put a segment back. `progress`
+    is called with the number of finished moves after each one."""
+    results = []
+    for move in sorted(moves, key=lambda move: parse_time(move['segment']['start'])):
+        left = time_left()
+        if results and not results[-1]['ok']:
+            results.append({'id': move['segment']['id'], 'ok': False, 'error': 'skipped'})
+        elif left is not None and left < reserve:
+            results.append({'id': move['segment']['id'], 'ok': False, 'error': 'skipped, out of time'})
+        else:
+            results.append(_move(client, move))
+        if progress is not None:
+            progress(len(results))
+    return results
+
+
+def _move(client, move: dict) -> dict:
+    item = move['segment']
+    try:
+        client.delete_segment_by_id(item['id'])
+    except ValueError as e:
+        return {'id': item['id'], 'ok': False, 'error': f'not deleted: {e}'}
+    try:
+        segment_id = client.create_segment(_segment_at(item, move['start']))
+        if segment_id != -1:
+            return {'id': item['id'], 'ok': True, 'newID': segment_id}
+        error = 'segment intersection'
+    except ValueError as e:
+        error = str(e)
+    result = {'id': item['id'], 'ok': False, 'error': error}
+    try:
+        restored = client.create_segment(_segment_at(item, parse_time(item['start'])))
+    except ValueError as e:
+        restored, result['error'] = -1, f'{error}; not put back: {e}'
+    if restored == -1:
+        result['lost'] = True
+    else:
+        result['restoredID'] = restored
+    return result
+
+
+def describe_moves(moves: list) -> list[dict]:
+    return [{'id': move['segment']['id'],
+             'mediaID': move['segment']['mediaID'],
+             'mediaTitle': move['segment'].get('mediaTitle'),
+             'from': move['segment']['start'],
+             'to': move['start'].astimezone(timezone.utc).strftime(SEGMENT_TIME_FORMAT)}
+            for move in moves]
+
+
+def parse_user_time(value: str) -> datetime:
+    """ISO time as typed or exported by people; naive times are UTC."""
+    start = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    return start
+
+
+def parse_desired_schedule(text: str, fmt: str = 'json') -> list[dict]:
+    """Reads a desired schedule from JSON (a list, or {"segments": [...]}) or
+    CSV with a header. Each entry needs a media id (`mediaID` or `media_id`)
+    and a `start`; `stopCut` (ns) or `duration` (seconds) are optional."""
+    if fmt == 'csv':
+        rows = list(csv.DictReader(io.StringIO(text)))
+    else:
+        rows = json.loads(text)
+        if isinstance(rows, dict):
+            rows = rows.get('segments', [])
+    desired = []
+    for row in rows:
+        media_id = row.get('mediaID', row.get('media_id'))
+        stop_cut = row.get('stopCut') or None
+        if stop_cut is None and row.get('duration'):
+            stop_cut = int(float(row['duration']) * 1e9)
+        desired.append({'mediaID': int(media_id),
+                        'start': parse_user_time(str(row['start'])),
+                        'stopCut': int(stop_cut) if stop_cut is not None else None})
+    return sorted(desired, key=lambda item: item['start'])
+
+
+def _sync_key(media_id: int, start: datetime, stop_cut: int) -> tuple:
+    # Millisecond precision, the backend may not keep sub-millisecond starts
+    return int(media_id), round(start.timestamp() * 1000), int(stop_cut)
+
+
+def plan_sync(schedule: list, desired: list, start: datetime, stop: datetime, library: dict) -> dict:
+    """Minimal set of deletes and creates that turns the segments starting in
+    [start, stop) into `desired`. Segments that already match are left
+    alone; protected ones are never deleted."""
+    errors = []
+    wanted = {}
+    for item in desired:
+        stop_cut = item['stopCut']
+        if stop_cut is None:
+            media = library.get(item['mediaID']) if library else None
+            if media is None:
+                errors.append({'mediaID': item['mediaID'], 'error': 'unknown media'})
+                continue
+            stop_cut = media.duration
+        wanted[_sync_key(item['mediaID'], item['start'], stop_cut)] = Segment(
+            mediaID=item['mediaID'],
+            start=item['start'].astimezone(timezone.utc).strftime(SEGMENT_TIME_FORMAT),
+            beginCut=0, stopCut=stop_cut)
+
+    deletes, keep = [], []
+    for item in schedule:
+        item_start = parse_time(item['start'])
+        if not start <= item_start < stop:
+            continue
+        key = _sync_key(item['mediaID'], item_start, item['stopCut'])
+        if key in wanted:
+            keep.append(item)
+            del wanted[key]
+        elif item.get('protected'):
+            keep.append(item)
+        else:
+            deletes.append(item)
+    return {'deletes': deletes, 'creates': list(wanted.values()), 'keep': keep, 'errors': errors}
+
+
+def apply_sync(client, plan: dict) -> list[dict]:
+    """Runs the deletes and creates of `plan_sync` one at a time in start
+    order; a segment is deleted right before the first create that needs
+    its room, so a failure leaves as small a gap as possible.
+
+    Never stops part-way: returns one result per change, deletes as
+    {'op': 'delete', 'id'}, creates as {'op': 'create', 'mediaID', 'start'}
+    with the new `id`, each with `ok` and the error of the ones that failed."""
+    deletes = sorted(plan['deletes'], key=lambda item: parse_time(item['start']))
+    results = []
+
+    def delete(item):
+        try:
+            client.delete_segment_by_id(item['id'])
+            results.append({'op': 'delete', 'id': item['id'], 'ok': True})
+        except ValueError as e:
+            results.append({'op': 'delete', 'id': item['id'], 'ok': False, 'error': str(e)})
+
+    for segment in sorted(plan['creates'], key=lambda segment: parse_time(segment.start)):
+        stop = parse_time(segment.start) + timedelta(microseconds=segment.stop_cut // 1000)
+        while deletes and parse_time(deletes[0]['start']) < stop:
+            delete(deletes.pop(0))
+        result = {'op': 'create', 'mediaID': segment.media_id, 'start': segment.start}
+        try:
+            segment_id = client.create_segment(segment)
+            result.update(ok=segment_id != -1, id=segment_id)
+            if segment_id == -1:
+                result['error'] = 'segment intersection'
+        except ValueError as e:
+            result.update(ok=False, error=str(e))
+        results.append(result)
+    for item in deletes:
+        delete(item)
+    return results
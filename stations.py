@@ -0,0 +1,172 @@
+"""Several radio backends managed from one deployment.
+
+Every station gets a `client` of its own, and with it its own connection
+pool, upstream limiter, token, library, schedule, caches and metrics, kept
+under its own cache directory. The station that calls go to is a context
+variable, so it is set once per UI request (from the session) and followed
+by threads started with `transport.in_context`; `current()` is the client
+of that station, or of the first one outside of any.
+
+`fan_out` runs one operation on several stations at the same time, e.g.
+scheduling the same jingle everywhere or searching all libraries.
+"""
+import contextvars
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from api_client import client
+from transport import in_context
+
+_station = contextvars.ContextVar('station', default=None)
+
+_NAME = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+class Station:
+    def __init__(self, name: str, base_url: str, title: str = None, cache_dir: str = None) -> None:
+        if not _NAME.match(name):
+            raise ValueError(f'Station name {name!r} may only have letters, digits, _ and -')
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.title = title or name
+        self.cache_dir = cache_dir or os.path.join('.cache', 'stations', name)
+
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'title': self.title, 'base_url': self.base_url}
+
+
+class StationRegistry:
+    """The configured stations and their clients, created on first use.
+    `configure` is called with every new client, e.g. to set its limiter."""
+
+    def __init__(self, stations: list[Station], configure=None, max_workers: int = 8) -> None:
+        if not stations:
+            raise ValueError('At least one station is needed')
+        self.stations = {}
+        for station in stations:
+            if station.name in self.stations:
+                raise ValueError(f'Station {station.name!r} is configured twice')
+            self.stations[station.name] = station
+        self.default = stations[0].name
+        self.configure = configure
+        self.max_workers = max_workers
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, stations, path: str = None, configure=None) -> 'StationRegistry':
+        """From a list of {"name", "base_url", "title", "cache_dir"} dicts, else
+        from the JSON file at `path` if there is one. Without either there is
+        one station, 'default', on the client's server and the usual `.cache`,
+        as before stations existed."""
+        if stations is None and path is not None and os.path.exists(path):
+            with open(path) as rd:
+                stations = json.load(rd)
+        if not stations:
+            return cls([Station('default', client.base_url, cache_dir='.cache')], configure=configure)
+        return cls([Station(**item) for item in stations], configure=configure)
+
+    def __contains__(self, name) -> bool:
+        return name in self.stations
+
+    def names(self) -> list[str]:
+        return list(self.stations)
+
+    def client(self, name: str = None) -> client:
+        name = name or self.default
+        station = self.stations[name]
+        with self._lock:
+            cl = self._clients.get(name)
+            if cl is None:
+                cl = self._clients[name] = client(station.base_url, cache_dir=station.cache_dir)
+                if self.configure is not None:
+                    self.configure(cl)
+            return cl
+
+    def attach(self, station_client: client, name: str = None) -> None:
+        """Makes `station_client`, e.g. one logged in elsewhere, the client of
+        station `name` (the default one) from now on."""
+        name = name or self.default
+        if name not in self.stations:
+            raise KeyError(f'Unknown station {name!r}')
+        with self._lock:
+            self._clients[name] = station_client
+
+    def clients(self) -> dict:
+        """The clients created so far, by station."""
+        with self._lock:
+            return dict(self._clients)
+
+    # Current station
+
+    def current_name(self) -> str:
+        name = _station.get()
+        return name if name in self.stations else self.default
+
+    def current(self) -> client:
+        return self.client(self.current_name())
+
+    def select(self, name: str):
+        """Makes `name` (the default one if unknown) the current station of
+        this context; returns a token for `reset`."""
+        return _station.set(name if name in self.stations else self.default)
+
+    @staticmethod
+    def reset(token) -> None:
+        _station.reset(token)
+
+    @contextmanager
+    def use(self, name: str):
+        token = self.select(name)
+        try:
+            yield self.client(self.current_name())
+        finally:
+            self.reset(token)
+
+    # Fan-out
+
+    def fan_out(self, func, names=None) -> dict:
+        """Calls `func(client)` for every station in `names` (all by default)
+        at the same time, each with its station current. Returns by station
+        {'ok': True, 'result': ...} or {'ok': False, 'error': ...}; one
+        station failing does not stop the others."""
+        names = list(names) if names is not None else self.names()
+        unknown = [name for name in names if name not in self.stations]
+        if unknown:
+            raise KeyError(f'Unknown stations: {", ".join(unknown)}')
+
+        def run(name):
+            try:
+                with self.use(name) as cl:
+                    return {'ok': True, 'result': func(cl)}
+            except Exception as e:
+                return {'ok': False, 'error': str(e)}
+
+        if len(names) == 1:
+            return {names[0]: run(names[0])}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(names))) as executor:
+            return dict(zip(names, executor.map(in_context(run), names)))
+
+    def stats(self) -> dict:
+        """Per station: whether it is logged in, its library and schedule
+        sizes, upstream circuit state and cache metrics. Stations nobody has
+        used yet are not connected to for this."""
+        clients = self.clients()
+        stats = {}
+        for name, station in self.stations.items():
+            cl = clients.get(name)
+            entry = {**station.to_dict(), 'connected': cl is not None}
+            if cl is not None:
+                entry.update({
+                    'logged_in': cl.jwt is not None,
+                    'library': len(cl.library) if cl.library is not None else None,
+                    'schedule': len(cl.schedule) if cl.schedule is not None else None,
+                    'circuit': cl.http.breaker.state,
+                    'cache': cl.cache_stats(),
+                })
+            stats[name] = entry
+        return stats
@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+import cli
+from api_client import client
+from benchmarks.fake_upstream import spawn
+
+
+@pytest.fixture
+def upstream(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with spawn() as up:
+        up.seed(media=20, segments=0)
+        monkeypatch.setenv('RADIO_BASE_URL', up.url)
+        monkeypatch.setenv('RADIO_LOGIN', 'test')
+        monkeypatch.setenv('RADIO_PASSWORD', 'test')
+        yield up
+
+
+def read_media(up, media_id):
+    cl = client(base_url=up.url, cache_dir='.cache/check')
+    cl.login('test', 'test')
+    return cl.get_media(media_id)
+
+
+def test_tags_retag_remove(upstream, capsys):
+    tag_ids = [tag['id'] for tag in read_media(upstream, 1).tags]
+
+    assert cli.main(['tags', 'retag', '--ids', '1', '--remove', str(tag_ids[0])]) == 0
+
+    results = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [result['ok'] for result in results] == [True]
+    assert [tag['id'] for tag in read_media(upstream, 1).tags] == tag_ids[1:]
+
+
+def test_connect_keeps_session_per_server(upstream, monkeypatch):
+    args = cli.build_parser().parse_args(['tags', 'list'])
+    cl = cli.connect(args)
+    assert cl.base_url == upstream.url
+    assert cl.cache_dir != '.cache'
+
+    # Later runs without the password use the session saved for this server
+    monkeypatch.delenv('RADIO_PASSWORD')
+    again = cli.connect(cli.build_parser().parse_args(['tags', 'list']))
+    assert again.cache_dir == cl.cache_dir
+    assert again.jwt.token == cl.jwt.token
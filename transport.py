@@ -0,0 +1,448 @@
+"""HTTP transport shared by all `client` calls.
+
+Adds the policies every upstream call should have: timeouts, retries with
+exponential backoff and jitter for idempotent GETs, a circuit breaker that
+fails fast while the upstream is down, and a deadline that nested and
+concurrent calls made on behalf of one UI request share. Identical GETs that
+are in flight at the same time are coalesced into one upstream call, and
+with a `ResponseCache` every GET is sent as a conditional request. With a
+`PriorityLimiter`, calls also wait for a slot by the priority class of the
+context that makes them, so UI requests go ahead of background work.
+"""
+import contextvars
+import random
+import threading
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from time import monotonic, sleep
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # requests (with urllib3 and certifi) is a good part of startup time,
+    # it is imported when the first call is made
+    import requests
+
+_deadline = contextvars.ContextVar('upstream_deadline', default=None)
+
+# Highest first; calls made outside any `priority` block are interactive
+PRIORITIES = ('interactive', 'background', 'bulk')
+_priority = contextvars.ContextVar('upstream_priority', default='interactive')
+
+RETRY_STATUSES = {502, 503, 504}
+
+
+class UpstreamError(ValueError):
+    """The upstream could not be reached or did not answer in time.
+
+    Subclasses ValueError, which is what client methods have always raised
+    for failed calls."""
+
+    def __init__(self, message: str, status: int = None) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+class DeadlineExceeded(UpstreamError):
+    pass
+
+
+# Deadlines
+
+def set_deadline(seconds: float):
+    """Limits the time left for upstream calls in the current context; an
+    outer, earlier deadline still wins. Returns a token for `reset_deadline`."""
+    deadline = monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        deadline = min(deadline, current)
+    return _deadline.set(deadline)
+
+
+def reset_deadline(token) -> None:
+    _deadline.reset(token)
+
+
+@contextmanager
+def deadline(seconds: float):
+    token = set_deadline(seconds)
+    try:
+        yield
+    finally:
+        reset_deadline(token)
+
+
+def time_left():
+    current = _deadline.get()
+    return None if current is None else current - monotonic()
+
+
+def in_context(func):
+    """Wraps `func` to run in a copy of the caller's context, so executor
+    threads see the deadline and priority of the request that started them."""
+    context = contextvars.copy_context()
+
+    def wrapped(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return wrapped
+
+
+# Priorities
+
+@contextmanager
+def priority(name: str):
+    """Upstream calls made in the block, also from threads started with
+    `in_context`, belong to the priority class `name`."""
+    if name not in PRIORITIES:
+        raise ValueError(f'Unknown priority {name!r}, expected one of {PRIORITIES}')
+    token = _priority.set(name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> str:
+    return _priority.get()
+
+
+# Circuit breaker
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures and rejects calls
+    for `reset_timeout` seconds, then lets a single trial call through."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def release(self) -> None:
+        """Forget a call that ended without telling anything about the upstream."""
+        with self._lock:
+            self._trial = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = monotonic()
+
+
+# Single flight
+
+class _Flight:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs one call per key at a time; callers that ask for a key while its
+    call is in flight wait for it and share its result. Nothing is kept once
+    the call has finished."""
+
+    def __init__(self) -> None:
+        self.leaders = 0
+        self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.leaders += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            if not flight.done.wait(timeout=time_left()):
+                raise DeadlineExceeded('upstream deadline exceeded waiting for a shared call')
+            if isinstance(flight.error, DeadlineExceeded) and (time_left() or 1) > 0:
+                # Only the first caller ran out of time, try on our own
+                return func()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response
+
+        try:
+            flight.response = func()
+            return flight.response
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'leaders': self.leaders, 'shared': self.shared, 'in_flight': len(self._flights)}
+
+
+# Rate limiting
+
+class RateLimiter:
+    """Token bucket: lets through `rate` calls per second on average and up
+    to `burst` at once. `acquire` blocks until a call may go, but never past
+    the current deadline."""
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            remaining = time_left()
+            if remaining is not None and remaining < wait:
+                raise DeadlineExceeded('upstream deadline exceeded waiting for the rate limit')
+            sleep(wait)
+
+
+class PriorityLimiter:
+    """Caps the upstream calls in flight at `max_concurrent`.
+
+    A freed slot goes to the longest waiting call of the highest class.
+    Background and bulk calls never take the last `reserve` slots, bulk
+    calls at most half of the rest, so an interactive call only waits for
+    other interactive calls. `rates` limits the calls per second of a class
+    with a token bucket; interactive calls are not rate limited by default."""
+
+    def __init__(self, max_concurrent: int = 16, reserve: int = 4, rates: dict = None) -> None:
+        if not 0 <= reserve < max_concurrent:
+            raise ValueError('reserve must leave at least one slot for background calls')
+        self.max_concurrent = max_concurrent
+        self.caps = {'interactive': max_concurrent, 'background': max_concurrent - reserve,
+                     'bulk': max(1, (max_concurrent - reserve) // 2)}
+        rates = {'background': 50, 'bulk': 20} if rates is None else rates
+        self.buckets = {name: RateLimiter(rate, burst=max(1, int(rate)))
+                        for name, rate in rates.items() if rate is not None}
+        self.in_flight = 0
+        self._running = dict.fromkeys(PRIORITIES, 0)
+        self._waiting = {name: deque() for name in PRIORITIES}
+        self._started = dict.fromkeys(PRIORITIES, 0)
+        self._queued = dict.fromkeys(PRIORITIES, 0)
+        self._wait_time = dict.fromkeys(PRIORITIES, 0.0)
+        self._changed = threading.Condition()
+
+    def _may_start(self, name: str, ticket) -> bool:
+        if self._waiting[name][0] is not ticket or self.in_flight >= self.caps[name]:
+            return False
+        # A waiting call of a higher class goes first
+        higher = PRIORITIES[:PRIORITIES.index(name)]
+        return not any(self._waiting[other] for other in higher)
+
+    @contextmanager
+    def slot(self, name: str = None):
+        """Holds one slot for the block, waiting for it no longer than the
+        current deadline. `name` defaults to the context's priority."""
+        name = name or _priority.get()
+        bucket = self.buckets.get(name)
+        if bucket is not None:
+            bucket.acquire()
+        ticket = object()
+        with self._changed:
+            queue = self._waiting[name]
+            queue.append(ticket)
+            began = monotonic()
+            try:
+                while not self._may_start(name, ticket):
+                    left = time_left()
+                    if left is not None and left <= 0:
+                        raise DeadlineExceeded(f'upstream deadline exceeded waiting for a slot ({name})')
+                    self._changed.wait(timeout=left)
+            finally:
+                queue.remove(ticket)
+                # The next call in line may be able to start now
+                self._changed.notify_all()
+            waited = monotonic() - began
+            self.in_flight += 1
+            self._running[name] += 1
+            self._started[name] += 1
+            if waited > 0.001:
+                self._queued[name] += 1
+                self._wait_time[name] += waited
+        try:
+            yield
+        finally:
+            with self._changed:
+                self.in_flight -= 1
+                self._running[name] -= 1
+                self._changed.notify_all()
+
+    def stats(self) -> dict:
+        with self._changed:
+            return {'in_flight': self.in_flight, 'max_concurrent': self.max_concurrent,
+                    'classes': {name: {'running': self._running[name], 'waiting': len(self._waiting[name]),
+                                       'started': self._started[name], 'queued': self._queued[name],
+                                       'wait_seconds': round(self._wait_time[name], 3)}
+                                for name in PRIORITIES}}
+
+
+# Transport
+
+class Transport:
+    def __init__(self, timeout: tuple = (3.05, 30), retries: int = 3, backoff: float = 0.2,
+                 max_backoff: float = 5, breaker: CircuitBreaker = None, coalesce: bool = True,
+                 cache=None, limiter: PriorityLimiter = None) -> None:
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.flights = SingleFlight() if coalesce else None
+        self.cache = cache
+        self.limiter = limiter
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self) -> 'requests.Session':
+        if self._session is None:
+            import requests
+            with self._session_lock:
+                if self._session is None:
+                    self._session = requests.Session()
+        return self._session
+
+    def _timeout(self, timeout) -> tuple:
+        """The timeout to use and whether the deadline shortened it."""
+        timeout = timeout or self.timeout
+        left = time_left()
+        if left is None:
+            return timeout, False
+        if left <= 0:
+            raise DeadlineExceeded('upstream deadline exceeded')
+        if isinstance(timeout, tuple):
+            return tuple(min(part, left) for part in timeout), left < max(timeout)
+        return min(timeout, left), left < timeout
+
+    def _send(self, method: str, url: str, **kwargs) -> 'requests.Response':
+        # Only the call itself holds a slot, not the sleeps between retries
+        with self.limiter.slot() if self.limiter is not None else nullcontext():
+            return self._send_now(method, url, **kwargs)
+
+    def _send_now(self, method: str, url: str, **kwargs) -> 'requests.Response':
+        import requests
+        kwargs['timeout'], clamped = self._timeout(kwargs.get('timeout'))
+        if not self.breaker.allow():
+            raise CircuitOpenError(f'upstream circuit is open, not calling {method} {url}')
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.Timeout as e:
+            if clamped:
+                # Our own budget ran out, that says nothing about the upstream
+                self.breaker.release()
+                raise DeadlineExceeded(f'upstream deadline exceeded during {method} {url}') from e
+            self.breaker.record_failure()
+            raise UpstreamError(f'{method} {url} timed out: {e}') from e
+        except requests.RequestException as e:
+            self.breaker.record_failure()
+            raise UpstreamError(f'{method} {url} failed: {e}') from e
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def request(self, method: str, url: str, **kwargs) -> 'requests.Response':
+        if method.upper() != 'GET' or (self.flights is None and self.cache is None):
+            return self._request(method, url, **kwargs)
+        import requests
+        prepared = requests.Request('GET', url, params=kwargs.get('params')).prepare()
+        if self.cache is None or not self.cache.wants(prepared.url):
+            fetch = lambda: self._request(method, url, **kwargs)
+        else:
+            fetch = lambda: self._cached_get(prepared.url, url, **kwargs)
+        if self.flights is None:
+            return fetch()
+        # Identical concurrent reads of one priority class share one upstream
+        # call; a UI read does not wait in line behind a bulk one
+        headers = kwargs.get('headers') or {}
+        return self.flights.do((prepared.url, headers.get('Authorization'), _priority.get()), fetch)
+
+    def _cached_get(self, key: str, url: str, **kwargs) -> 'requests.Response':
+        entry = self.cache.get(key)
+        if entry is not None:
+            kwargs['headers'] = {**(kwargs.get('headers') or {}), **entry.validators()}
+        return self.cache.update(key, entry, self._request('GET', url, **kwargs))
+
+    def _request(self, method: str, url: str, **kwargs) -> 'requests.Response':
+        attempts = self.retries if method.upper() == 'GET' else 1
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            try:
+                response = self._send(method, url, **kwargs)
+            except (CircuitOpenError, DeadlineExceeded):
+                raise
+            except UpstreamError:
+                if last:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or last:
+                    return response
+            # Full jitter, and never sleep past the deadline
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            left = time_left()
+            if left is not None and delay >= left:
+                raise DeadlineExceeded(f'upstream deadline exceeded retrying {method} {url}')
+            sleep(delay)
+
+    def get(self, url: str, **kwargs) -> 'requests.Response':
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> 'requests.Response':
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> 'requests.Response':
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> 'requests.Response':
+        return self.request('DELETE', url, **kwargs)
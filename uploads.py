@@ -0,0 +1,153 @@
+"""Resumable chunked uploads.
+
+A file is announced with `init`, sent as numbered chunks in any order and
+possibly in parallel, and assembled with `assemble` once every chunk is
+there. Each chunk comes with the CRC32 of its bytes and is kept only when it
+matches. Chunks live in their own directory until the upload is assembled
+or discarded, so an interrupted upload can continue with the chunks the
+server does not have yet.
+"""
+import json
+import os
+import shutil
+import threading
+import uuid
+import zlib
+from time import time
+
+CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CHUNK_SIZE = 32 * 1024 * 1024
+READ_SIZE = 64 * 1024
+
+
+class UploadError(ValueError):
+    """The request does not fit the upload, reported to the browser as is."""
+
+    def __init__(self, message: str, status: int = 400) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class ChunkedUploads:
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        self._assembling = set()
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def _dir(self, upload_id: str) -> str:
+        if not upload_id.isalnum():
+            raise UploadError('Unknown upload', 404)
+        return os.path.join(self.folder, upload_id)
+
+    def manifest(self, upload_id: str) -> dict:
+        try:
+            with open(os.path.join(self._dir(upload_id), 'manifest.json')) as rd:
+                return json.load(rd)
+        except FileNotFoundError:
+            raise UploadError('Unknown upload', 404)
+
+    def init(self, filename: str, size: int, chunk_size: int = CHUNK_SIZE, meta: dict = None) -> dict:
+        if size <= 0:
+            raise UploadError('File is empty')
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise UploadError(f'Chunk size must be between 1 and {MAX_CHUNK_SIZE} bytes')
+        upload_id = uuid.uuid4().hex
+        manifest = {
+            'id': upload_id,
+            'filename': filename,
+            'size': size,
+            'chunk_size': chunk_size,
+            'total_chunks': -(-size // chunk_size),
+            'meta': meta or {},
+            'created': time(),
+        }
+        os.makedirs(self._dir(upload_id))
+        with open(os.path.join(self._dir(upload_id), 'manifest.json'), 'w') as wr:
+            json.dump(manifest, wr)
+        return manifest
+
+    def received(self, upload_id: str) -> list[int]:
+        return sorted(int(name[:-5]) for name in os.listdir(self._dir(upload_id))
+                      if name.endswith('.part'))
+
+    def status(self, upload_id: str) -> dict:
+        manifest = self.manifest(upload_id)
+        return {key: manifest[key] for key in ('id', 'filename', 'size', 'chunk_size', 'total_chunks')} | {
+            'received': self.received(upload_id)}
+
+    def put_chunk(self, upload_id: str, index: int, stream, crc32: str) -> None:
+        """Stores chunk `index` read from `stream` if its size and CRC32 (hex)
+        are right. Sending a chunk again replaces it."""
+        manifest = self.manifest(upload_id)
+        if not 0 <= index < manifest['total_chunks']:
+            raise UploadError(f'Chunk {index} is out of range')
+        expected_size = min(manifest['chunk_size'], manifest['size'] - index * manifest['chunk_size'])
+        try:
+            expected_crc = int(crc32, 16)
+        except (TypeError, ValueError):
+            raise UploadError('Chunk checksum is missing')
+
+        path = os.path.join(self._dir(upload_id), f'{index}.part')
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        crc, size = 0, 0
+        try:
+            with open(tmp_path, 'wb') as wr:
+                while size <= expected_size:
+                    data = stream.read(READ_SIZE)
+                    if not data:
+                        break
+                    crc = zlib.crc32(data, crc)
+                    size += len(data)
+                    wr.write(data)
+            if size != expected_size:
+                raise UploadError(f'Chunk {index} has {size} bytes, expected {expected_size}')
+            if crc != expected_crc:
+                raise UploadError(f'Chunk {index} checksum mismatch', 422)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def assemble(self, upload_id: str) -> tuple[str, dict]:
+        """Joins the chunks into the final file; returns its path and the
+        manifest. The chunks stay until `discard`, so a failed step after
+        this can be retried."""
+        manifest = self.manifest(upload_id)
+        missing = sorted(set(range(manifest['total_chunks'])) - set(self.received(upload_id)))
+        if missing:
+            raise UploadError(f'Missing chunks: {missing[:20]}', 409)
+        with self._lock:
+            if upload_id in self._assembling:
+                raise UploadError('Upload is already being finalized', 409)
+            self._assembling.add(upload_id)
+        try:
+            directory = self._dir(upload_id)
+            path = os.path.join(directory, manifest['filename'])
+            with open(path, 'wb') as wr:
+                for index in range(manifest['total_chunks']):
+                    with open(os.path.join(directory, f'{index}.part'), 'rb') as rd:
+                        shutil.copyfileobj(rd, wr, READ_SIZE * 16)
+            if os.path.getsize(path) != manifest['size']:
+                os.remove(path)
+                raise UploadError('Assembled file has the wrong size', 500)
+            return path, manifest
+        finally:
+            with self._lock:
+                self._assembling.discard(upload_id)
+
+    def discard(self, upload_id: str) -> None:
+        shutil.rmtree(self._dir(upload_id), ignore_errors=True)
+
+    def purge(self, max_age: float = 24 * 3600) -> int:
+        """Removes uploads started more than `max_age` seconds ago."""
+        removed = 0
+        for upload_id in os.listdir(self.folder):
+            try:
+                started = self.manifest(upload_id)['created']
+            except (UploadError, ValueError, KeyError):
+                continue
+            if time() - started > max_age:
+                self.discard(upload_id)
+                removed += 1
+        return removed
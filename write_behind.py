@@ -0,0 +1,471 @@
+"""Write-behind for schedule and library edits.
+
+Edits are applied to the client's local state right away, appended to a
+journal file and sent upstream by a background thread in batches, so the
+UI does not wait for the radio server and edits survive its short outages
+and restarts of the app. Edits that cancel each other out within a batch
+are never sent: a segment created and deleted again, repeated updates of
+one media, deletes of the same thing twice.
+
+Edits the server rejects (e.g. a segment intersection) are conflicts: they
+are dropped, their local changes are undone and they are kept in
+`WriteBehindQueue.conflicts` for the UI to show.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from time import time
+
+from api_client import SEGMENT_TIME_FORMAT, parse_time
+from data_types import Media, Segment
+from transport import UpstreamError, deadline, in_context, priority
+
+# Segments that are not upstream yet get ids at or below this, they never
+# clash with upstream ids or the -1 returned for an intersection
+TEMP_ID_BASE = -10**9
+
+
+def is_pending_id(segment_id) -> bool:
+    return int(segment_id) <= TEMP_ID_BASE
+
+
+class Conflict(Exception):
+    """The upstream rejected an edit, retrying would not help."""
+
+
+class Journal:
+    """Append-only JSON lines: one per submitted edit ({"seq", "op", "args"})
+    and one per finished edit ({"done": seq, "status", ...})."""
+
+    def __init__(self, path: str, fsync: bool = True) -> None:
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+
+    def load(self) -> tuple[OrderedDict, dict, int]:
+        """Unfinished edits by seq, ids of created segments by seq, and the
+        last seq used."""
+        pending, results, last = OrderedDict(), {}, 0
+        try:
+            with open(self.path) as rd:
+                lines = rd.readlines()
+        except FileNotFoundError:
+            return pending, results, last
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # the torn last line of a crash
+            if 'seq' in entry:
+                pending[entry['seq']] = entry
+                last = max(last, entry['seq'])
+            elif 'done' in entry:
+                pending.pop(entry['done'], None)
+                if entry.get('result') is not None:
+                    results[entry['done']] = entry['result']
+            elif 'base' in entry:
+                last = max(last, entry['base'])
+                results.update({int(seq): result for seq, result in entry.get('results', {}).items()})
+        return pending, results, last
+
+    def append(self, *entries: dict) -> None:
+        with self._lock:
+            with open(self.path, 'a') as wr:
+                for entry in entries:
+                    wr.write(json.dumps(entry) + '\n')
+                wr.flush()
+                if self.fsync:
+                    os.fsync(wr.fileno())
+
+    def compact(self, pending: list, last_seq: int, results: dict) -> None:
+        """Rewrites the journal with only the unfinished edits."""
+        with self._lock:
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as wr:
+                wr.write(json.dumps({'base': last_seq, 'results': results}) + '\n')
+                for entry in pending:
+                    wr.write(json.dumps(entry) + '\n')
+                wr.flush()
+                os.fsync(wr.fileno())
+            os.replace(tmp_path, self.path)
+
+
+class WriteBehindQueue:
+    """Stands in for the mutating `client` methods; reads of pending state
+    go through `get_segment_by_id`, `overlay_schedule` and `overlay_media`."""
+
+    def __init__(self, client, path: str, batch_size: int = 100, flush_interval: float = 0.5,
+                 max_backoff: float = 30, budget: float = 60, max_workers: int = 8) -> None:
+        self.client = client
+        self.journal = Journal(path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self.max_workers = max_workers
+        self.pending, self.results, self.seq = self.journal.load()
+        self.conflicts = deque(maxlen=100)
+        self.flushed = 0
+        self.last_flush = None
+        self.last_error = None
+        self._changed = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._stopped = False
+        self._worker = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._worker.start()
+
+    # Edits
+
+    def _submit(self, op: str, **args) -> int:
+        with self._changed:
+            self.seq += 1
+            entry = {'seq': self.seq, 'op': op, 'args': args, 'ts': time()}
+            self.journal.append(entry)
+            self.pending[self.seq] = entry
+            self._changed.notify_all()
+            return self.seq
+
+    def _pending_ops(self, op: str = None) -> list[dict]:
+        with self._changed:
+            return [entry for entry in self.pending.values() if op is None or entry['op'] == op]
+
+    def _horizon(self) -> datetime:
+        """Where a segment appended now would start, as far as known locally;
+        the flush places appended segments again against a fresh schedule."""
+        horizon = datetime.now(tz=timezone.utc)
+        if self.client.time_horizon is not None:
+            horizon = max(horizon, self.client.time_horizon)
+        for entry in self._pending_ops('create_segment'):
+            end = parse_time(entry['args']['start']) + timedelta(microseconds=entry['args']['stop_cut'] // 1000)
+            horizon = max(horizon, end)
+        return horizon
+
+    def create_new_segment(self, media_id: int, *, time: datetime = None, stop_cut: int = None) -> int:
+        """Like `client.create_new_segment`, but returns the temporary id of
+        the pending segment."""
+        media = self.client.resolve_media([media_id]).get(int(media_id))
+        if media is None:
+            raise ValueError("Unknown media_id.")
+        start = time if time is not None else self._horizon()
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=timezone.utc)  # as the client formats it
+        seq = self._submit('create_segment', media_id=int(media_id),
+                           start=start.astimezone(timezone.utc).strftime(SEGMENT_TIME_FORMAT),
+                           stop_cut=stop_cut or media.duration, append=time is None)
+        return TEMP_ID_BASE - seq
+
+    def delete_segment_by_id(self, segment_id: int) -> None:
+        segment_id = int(segment_id)
+        if is_pending_id(segment_id):
+            seq = TEMP_ID_BASE - segment_id
+            if seq in self.results:
+                segment_id = self.results[seq]
+            elif seq not in self.pending:
+                raise ValueError(404, 'Unknown pending segment')
+        self.client.segment_cache.pop(segment_id)
+        self._submit('delete_segment', segment_id=segment_id)
+
+    def get_segment_by_id(self, segment_id: int) -> Segment:
+        segment_id = int(segment_id)
+        if not is_pending_id(segment_id):
+            return self.client.get_segment_by_id(segment_id)
+        seq = TEMP_ID_BASE - segment_id
+        if seq in self.results:
+            return self.client.get_segment_by_id(self.results[seq])
+        entry = self.pending.get(seq)
+        if entry is None:
+            raise ValueError(404, 'Unknown pending segment')
+        args = entry['args']
+        return Segment(id=segment_id, mediaID=args['media_id'], start=args['start'],
+                       beginCut=0, stopCut=args['stop_cut'])
+
+    def update_media_information(self, media_id: int, name: str, author: str, tags: list) -> None:
+        media_id = int(media_id)
+        known = self.client.media_cache.get(media_id)
+        if known is None and self.client.library is not None:
+            known = self.client.library.get(media_id)
+        if known is not None:
+            updated = Media(id=media_id, name=name, author=author, duration=known.duration, tags=tags)
+            self.client.media_cache.put(media_id, updated)
+            if self.client.library is not None and media_id in self.client.library:
+                self.client.library[media_id] = updated
+                self.client.stats.put_media(updated)
+        self._submit('update_media', media_id=media_id, name=name, author=author,
+                     tags=[tag.to_dict() if hasattr(tag, 'to_dict') else tag for tag in tags or []])
+
+    def delete_media_by_id(self, media_id: int) -> None:
+        media_id = int(media_id)
+        self.client.media_cache.pop(media_id)
+        if self.client.library is not None:
+            self.client.library.pop(media_id, None)
+        self.client.stats.remove_media(media_id)
+        self._submit('delete_media', media_id=media_id)
+
+    # Reads
+
+    def overlay_schedule(self, items: list, start: datetime = None, stop: datetime = None) -> list:
+        """Schedule items (from `client.get_schedule*`) as they will be once
+        the pending edits are flushed: deleted segments are left out and
+        pending ones between `start` and `stop` are added with
+        `pending: True`."""
+        ops = self._pending_ops()
+        if not ops:
+            return items
+        deleted = {entry['args']['segment_id'] for entry in ops if entry['op'] == 'delete_segment'}
+        items = [item for item in items if item['id'] not in deleted]
+        added = []
+        for entry in ops:
+            temp_id = TEMP_ID_BASE - entry['seq']
+            if entry['op'] != 'create_segment' or temp_id in deleted:
+                continue
+            args = entry['args']
+            item_start = parse_time(args['start'])
+            item_end = item_start + timedelta(microseconds=args['stop_cut'] // 1000)
+            if (start is not None and item_end <= start) or (stop is not None and item_start >= stop):
+                continue
+            added.append({'id': temp_id, 'mediaID': args['media_id'], 'start': args['start'],
+                          'beginCut': 0, 'stopCut': args['stop_cut'],
+                          'end': item_end.strftime(r'%Y-%m-%dT%H:%M:%S.%f%z'), 'pending': True})
+        if added:
+            media = self.client.resolve_media(item['mediaID'] for item in added)
+            for item in added:
+                found = media.get(item['mediaID'])
+                item['mediaTitle'] = (found.author + ' - ' + found.name if found is not None
+                                      else f"Unknown media #{item['mediaID']}")
+        return sorted(items + added, key=lambda item: parse_time(item['start']))
+
+    def overlay_media(self, items: list) -> list:
+        """Media dicts as returned by searches, with pending updates applied
+        and pending deletes left out."""
+        ops = self._pending_ops()
+        if not ops:
+            return items
+        deleted = {entry['args']['media_id'] for entry in ops if entry['op'] == 'delete_media'}
+        updates = {entry['args']['media_id']: entry['args'] for entry in ops if entry['op'] == 'update_media'}
+        result = []
+        for item in items:
+            if item['id'] in deleted:
+                continue
+            if item['id'] in updates:
+                update = updates[item['id']]
+                item = dict(item, name=update['name'], author=update['author'], tags=update['tags'])
+            result.append(item)
+        return result
+
+    def status(self) -> dict:
+        with self._changed:
+            return {
+                'pending': len(self.pending),
+                'flushed': self.flushed,
+                'last_flush': self.last_flush,
+                'last_error': self.last_error,
+                'conflicts': list(self.conflicts),
+            }
+
+    # Flushing
+
+    def _coalesce(self, batch: list) -> tuple[list, dict]:
+        """The edits of `batch` that still have to be sent, and the finished
+        status of those that do not."""
+        skipped = {}
+        creates = {entry['seq'] for entry in batch if entry['op'] == 'create_segment'}
+        deleted_media = {entry['args']['media_id'] for entry in batch if entry['op'] == 'delete_media'}
+        last_update = {entry['args']['media_id']: entry['seq'] for entry in batch if entry['op'] == 'update_media'}
+        seen_deletes = set()
+        send = []
+        for entry in batch:
+            op, args = entry['op'], entry['args']
+            if op == 'delete_segment':
+                segment_id = args['segment_id']
+                if is_pending_id(segment_id):
+                    seq = TEMP_ID_BASE - segment_id
+                    if seq in creates:
+                        # Created and deleted before it was ever sent
+                        creates.discard(seq)
+                        skipped[seq] = skipped[entry['seq']] = 'coalesced'
+                        continue
+                    if seq in self.results:
+                        entry = dict(entry, args={'segment_id': self.results[seq]})
+                    elif seq in self.pending:
+                        continue  # its create is in a later batch
+                    else:
+                        skipped[entry['seq']] = 'coalesced'
+                        continue
+                key = ('segment', entry['args']['segment_id'])
+            elif op == 'update_media':
+                if args['media_id'] in deleted_media or last_update[args['media_id']] != entry['seq']:
+                    skipped[entry['seq']] = 'coalesced'
+                    continue
+                key = None
+            elif op == 'delete_media':
+                key = ('media', args['media_id'])
+            else:
+                key = None
+            if key is not None:
+                if key in seen_deletes:
+                    skipped[entry['seq']] = 'coalesced'
+                    continue
+                seen_deletes.add(key)
+            send.append(entry)
+        send = [entry for entry in send if entry['op'] != 'create_segment' or entry['seq'] in creates]
+        return send, skipped
+
+    def _apply(self, entry: dict, start: datetime = None):
+        op, args = entry['op'], entry['args']
+        try:
+            if op == 'delete_segment':
+                self.client.delete_segment_by_id(args['segment_id'])
+            elif op == 'create_segment':
+                segment = Segment(mediaID=args['media_id'], beginCut=0, stopCut=args['stop_cut'],
+                                  start=start.strftime(SEGMENT_TIME_FORMAT) if start else args['start'])
+                segment_id = self.client.create_segment(segment)
+                if segment_id == -1:
+                    raise Conflict('segment intersection')
+                return segment_id
+            elif op == 'update_media':
+                self.client.update_media_information(args['media_id'], args['name'], args['author'], args['tags'])
+            elif op == 'delete_media':
+                self.client.delete_media_by_id(args['media_id'])
+        except (UpstreamError, Conflict):
+            raise
+        except ValueError as e:
+            if op.startswith('delete') and e.args and e.args[0] == 404:
+                return None  # already gone
+            raise Conflict(' '.join(str(arg) for arg in e.args))
+        return None
+
+    def _run_stage(self, entries: list, starts: dict, finished: dict) -> None:
+        """Applies `entries` concurrently, recording each finished one in
+        `finished`; raises the first UpstreamError after the rest ended."""
+        if not entries:
+            return
+        errors = []
+
+        def apply(entry):
+            try:
+                finished[entry['seq']] = ('ok', self._apply(entry, starts.get(entry['seq'])))
+            except Conflict as e:
+                finished[entry['seq']] = ('conflict', str(e))
+            except UpstreamError as e:
+                errors.append(e)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(in_context(apply), entries))
+        if errors:
+            raise errors[0]
+
+    def flush(self) -> int:
+        """Sends up to `batch_size` pending edits upstream; returns how many
+        finished. Raises UpstreamError if the upstream is unreachable, the
+        edits that did not get through stay pending."""
+        with self._flush_lock:
+            with self._changed:
+                batch = list(self.pending.values())[:self.batch_size]
+            if not batch:
+                return 0
+            send, skipped = self._coalesce(batch)
+            finished = {}
+            try:
+                # Deletes first, they make room for the creates
+                self._run_stage([e for e in send if e['op'] == 'delete_segment'], {}, finished)
+                creates = [e for e in send if e['op'] == 'create_segment']
+                starts = {}
+                if any(e['args']['append'] for e in creates):
+                    self.client.get_schedule()
+                    horizon = max(self.client.time_horizon or datetime.now(tz=timezone.utc),
+                                  datetime.now(tz=timezone.utc))
+                    for entry in creates:
+                        if entry['args']['append']:
+                            starts[entry['seq']] = horizon
+                            horizon += timedelta(microseconds=entry['args']['stop_cut'] // 1000)
+                self._run_stage(creates, starts, finished)
+                self._run_stage([e for e in send if e['op'] == 'update_media'], {}, finished)
+                self._run_stage([e for e in send if e['op'] == 'delete_media'], {}, finished)
+            finally:
+                self._finish(batch, skipped, finished)
+            return len(skipped) + len(finished)
+
+    def _finish(self, batch: list, skipped: dict, finished: dict) -> None:
+        entries = {entry['seq']: entry for entry in batch}
+        records = [{'done': seq, 'status': status} for seq, status in skipped.items()]
+        conflicts = []
+        for seq, (status, value) in finished.items():
+            if status == 'ok':
+                records.append({'done': seq, 'status': 'ok', 'result': value})
+                if value is not None:
+                    self.results[seq] = value
+            else:
+                records.append({'done': seq, 'status': 'conflict', 'error': value})
+                conflicts.append(dict(entries[seq], error=value, time=time()))
+        if not records:
+            return
+        self.journal.append(*records)
+        # Before the edits stop being pending, so waiting for the queue to
+        # be idle also waits for the library to be put back
+        for conflict in conflicts:
+            self._undo(conflict)
+        with self._changed:
+            for record in records:
+                self.pending.pop(record['done'], None)
+            self.conflicts.extend(conflicts)
+            self.flushed += len(records)
+            self.last_flush = time()
+            if not self.pending:
+                self.journal.compact([], self.seq, dict(list(self.results.items())[-1000:]))
+            self._changed.notify_all()
+
+    def _undo(self, entry: dict) -> None:
+        """Forgets local changes of an edit the upstream rejected; segment
+        edits only ever live in the overlay, media is read again and put
+        back into the library as the upstream has it."""
+        if entry['op'] not in ('update_media', 'delete_media'):
+            return
+        media_id = entry['args']['media_id']
+        self.client.media_cache.pop(media_id)
+        try:
+            media = self.client.get_media(media_id)
+        except (UpstreamError, ValueError):
+            media = None  # gone upstream too, or read again on next use
+        if self.client.library is not None:
+            if media is not None:
+                self.client.library[media_id] = media
+            else:
+                self.client.library.pop(media_id, None)
+        if media is not None:
+            self.client.stats.put_media(media)
+        else:
+            self.client.stats.remove_media(media_id)
+
+    def _run(self) -> None:
+        backoff = 0
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self.pending or self._stopped)
+                if self._stopped:
+                    return
+                # Give edits made together the chance to go in one batch, and
+                # back off while the upstream is failing
+                if self._changed.wait_for(lambda: self._stopped, timeout=self.flush_interval + backoff):
+                    return
+            try:
+                with deadline(self.budget), priority('background'):
+                    self.flush()
+                backoff = 0
+                self.last_error = None
+            except Exception as e:
+                backoff = min(self.max_backoff, backoff * 2 or 1)
+                self.last_error = str(e)
+
+    def wait_idle(self, timeout: float = None) -> bool:
+        """Waits until nothing is pending; False on timeout."""
+        with self._changed:
+            return self._changed.wait_for(lambda: not self.pending, timeout=timeout)
+
+    def stop(self) -> None:
+        with self._changed:
+            self._stopped = True
+            self._changed.notify_all()
+        self._worker.join()